@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""NBD device allocation under a boot storm: connects serialized by the bitmap lock vs in parallel
+
+N threads, each standing in for a VDI.attach of a VM that boots, allocate an NBD device and connect
+it at the same moment. Connecting (qemu-nbd -c, rbd-nbd map) is faked by sleeping connect_ms and
+creating /sys/block/nbdN/pid in a scratch sysfs. v3.x held the bitmap lock until the device was
+connected, so the attaches ran one after the other; the allocator now holds it only to pick the
+device and guards the device with its own lock while connecting.
+
+    python benchmarks/bench_attach_storm.py [attaches] [connect_ms]
+"""
+
+from __future__ import division
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+
+from time import sleep, time
+
+import benchenv
+benchenv.setup()
+
+from xapi.storage.libs.xcpng.librbd import nbd_utils
+
+
+def make_sysfs(nbds_max):
+    sysfs = tempfile.mkdtemp(prefix='rbdsr-bench-sys-')
+    nbd_utils.SYS_BLOCK_DIR = os.path.join(sysfs, 'block')
+    nbd_utils.SYS_NBD_MODULE_DIR = os.path.join(sysfs, 'module', 'nbd')
+    os.makedirs(nbd_utils.SYS_BLOCK_DIR)
+    os.makedirs(os.path.join(nbd_utils.SYS_NBD_MODULE_DIR, 'parameters'))
+    with open(os.path.join(nbd_utils.SYS_NBD_MODULE_DIR, 'parameters', 'nbds_max'), 'w') as f:
+        f.write("%s\n" % nbds_max)
+    return sysfs
+
+
+def connect(nbd_dev, connect):
+    sleep(connect)
+    device_dir = os.path.join(nbd_utils.SYS_BLOCK_DIR, os.path.basename(nbd_dev))
+    os.makedirs(device_dir)
+    with open(os.path.join(device_dir, 'pid'), 'w') as f:
+        f.write("%s\n" % os.getpid())
+
+
+def storm(run_dir, attaches, connect_time, serialized):
+    """Returns the attach latencies and the devices they got"""
+    latencies = []
+    devices = []
+    barrier = threading.Event()
+
+    def _attach_():
+        barrier.wait()
+        start = time()
+        allocator = nbd_utils.NBDAllocator(run_dir)
+        if serialized:
+            fd = nbd_utils._lock_file(run_dir, os.path.join(run_dir, 'serial.lock'))
+            try:
+                with allocator.allocate('bench') as nbd_dev:
+                    connect(nbd_dev, connect_time)
+            finally:
+                os.close(fd)
+        else:
+            with allocator.allocate('bench') as nbd_dev:
+                connect(nbd_dev, connect_time)
+        latencies.append(time() - start)
+        devices.append(nbd_dev)
+
+    threads = [threading.Thread(target=_attach_) for n in range(attaches)]
+    for thread in threads:
+        thread.start()
+    barrier.set()
+    for thread in threads:
+        thread.join()
+    return sorted(latencies), devices
+
+
+def main():
+    attaches = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    connect_time = (float(sys.argv[2]) if len(sys.argv) > 2 else 150) / 1000
+
+    print("%d simultaneous attaches, %.0f ms per connect" % (attaches, connect_time * 1000))
+    print("%-24s %10s %10s %10s %10s" % ('allocation', 'wall s', 'mean ms', 'p50 ms', 'max ms'))
+    for label, serialized in (('bitmap lock held (v3.x)', True), ('device lock', False)):
+        sysfs = make_sysfs(attaches)
+        run_dir = tempfile.mkdtemp(prefix='rbdsr-bench-run-')
+        try:
+            start = time()
+            latencies, devices = storm(run_dir, attaches, connect_time, serialized)
+            elapsed = time() - start
+            if len(set(devices)) != attaches:
+                raise Exception("%s handed out a device twice" % label)
+            print("%-24s %10.2f %10.1f %10.1f %10.1f"
+                  % (label, elapsed, sum(latencies) * 1000 / attaches, latencies[attaches // 2] * 1000,
+                     latencies[-1] * 1000))
+        finally:
+            shutil.rmtree(sysfs)
+            shutil.rmtree(run_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""Provisioning and removal throughput of many VDIs: one at a time against the bulk operations
+
+One at a time is what VolumeOperations.create/destroy did per VDI: a create, then a remove that
+returns only once every object of the image is deleted. The bulk operations create the images
+concurrently on one IoCtx and move them to the RBD trash, the objects being deleted later by the pool
+worker (timed separately as "purge"). The fake cluster sleeps LATENCY seconds per call, every data
+object of a removed image being one call.
+
+    python benchmarks/bench_bulk_volumes.py [images] [objects_per_image] [latency_ms]
+"""
+
+from __future__ import division
+
+import sys
+
+from time import time
+
+import benchenv
+benchenv.setup()
+
+import rados
+
+from xapi.storage.libs.xcpng.librbd import rbd_utils
+
+CLUSTER = 'ceph'
+POOL = 'RBD_XenStorage-00000000-0000-0000-0000-000000000001'
+IMAGE_SIZE = 10 << 30
+
+
+def fill(cluster, names, objects):
+    latency, rados.LATENCY = rados.LATENCY, 0
+    for name in names:
+        with cluster.image(POOL, name) as image:
+            for obj_no in range(objects):
+                image.write(b'x', obj_no << rbd_utils.RBD_IMAGE_ORDER)
+    rados.LATENCY = latency
+
+
+def timed(label, images, func):
+    rados.STATS.clear()
+    start = time()
+    func()
+    elapsed = time() - start
+    print("%-24s %10.2f %10d %10.1f" % (label, elapsed, sum(rados.STATS.values()), images / elapsed))
+
+
+def main():
+    images = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    objects = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+    rados.LATENCY = float(sys.argv[3]) / 1000 if len(sys.argv) > 3 else 0.2 / 1000
+
+    cluster = rbd_utils.ceph_cluster('bench', CLUSTER)
+    cluster.connect()
+    cluster.create_pool(POOL)
+    names = ["RAW-%08d" % n for n in range(images)]
+
+    print("%d images, %d objects each, %.2f ms per call" % (images, objects, rados.LATENCY * 1000))
+    print("%-24s %10s %10s %10s" % ('operation', 'seconds', 'calls', 'images/s'))
+
+    timed('create one at a time', images,
+          lambda: [rbd_utils.rbd_create('bench', cluster, POOL, name, IMAGE_SIZE) for name in names])
+    fill(cluster, names, objects)
+    timed('remove one at a time', images,
+          lambda: [rbd_utils.rbd_remove('bench', cluster, POOL, name) for name in names])
+
+    timed('rbd_create_many', images,
+          lambda: rbd_utils.rbd_create_many('bench', cluster, POOL, [(name, IMAGE_SIZE) for name in names]))
+    fill(cluster, names, objects)
+    timed('rbd_trash_many', images, lambda: rbd_utils.rbd_trash_many('bench', cluster, POOL, names))
+    timed('purge (background)', images, lambda: rbd_utils.rbd_trash_purge('bench', cluster, POOL))
+
+    cluster.shutdown()
+
+
+if __name__ == '__main__':
+    main()
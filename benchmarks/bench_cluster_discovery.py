@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""SR.probe with an unreachable cluster: time to the pool list and to the exit of the process
+
+Runs clusters_pool_list over a reachable fake cluster and one whose connects hang (UNREACHABLE) in
+a child process, as a plugin command would, and times both the call and the whole process up to its
+exit, which includes the atexit shutdown of the pooled connections. Both have to stay within the
+discovery timeout: a probe that answers on time but whose process is held by the hung connect
+still makes xapi wait. Exits with an error when the process takes longer than the timeout plus
+slack.
+
+    python benchmarks/bench_cluster_discovery.py [hang_seconds] [timeout_seconds]
+"""
+
+from __future__ import division
+
+import subprocess
+import sys
+
+from time import time
+
+SLACK = 1.5  # seconds of interpreter start-up and tear-down allowed on top of the timeout
+
+
+def child(hang, timeout):
+    import benchenv
+    benchenv.setup(('reachable', 'unreachable'))
+
+    import rados
+    rados.UNREACHABLE['unreachable'] = hang
+
+    from xapi.storage.libs.xcpng.librbd import rbd_utils
+
+    start = time()
+    pools = rbd_utils.clusters_pool_list('bench', ['reachable', 'unreachable'], timeout)
+    sys.stdout.write("%.3f %s\n" % (time() - start, sorted(pools)))
+    sys.stdout.flush()
+
+
+def main():
+    hang = float(sys.argv[1]) if len(sys.argv) > 1 else 8
+    timeout = float(sys.argv[2]) if len(sys.argv) > 2 else 1
+
+    start = time()
+    output = subprocess.check_output([sys.executable, __file__, '--child', str(hang), str(timeout)],
+                                     stderr=open('/dev/null', 'w'))
+    process = time() - start
+    call, clusters = output.decode().strip().split(' ', 1)
+    print("connect hang: %.1fs  discovery timeout: %.1fs" % (hang, timeout))
+    print("%-24s %8.3fs  clusters: %s" % ('clusters_pool_list', float(call), clusters))
+    print("%-24s %8.3fs" % ('process exit', process))
+    if process > timeout + SLACK:
+        print("process outlived the discovery timeout by %.3fs" % (process - timeout))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--child']:
+        child(float(sys.argv[2]), float(sys.argv[3]))
+    else:
+        main()
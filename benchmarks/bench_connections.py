@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""Counts cluster connects made by a burst of plugin-style operations
+
+Runs the same sequence of rbd_utils calls twice against the in-memory fake cluster: once with the
+pooled ClusterConnectionManager and once with an idle timeout of zero, which closes every connection
+on release exactly like the old connect()/shutdown() pairs did.
+
+    python benchmarks/bench_connections.py [operations]
+"""
+
+import sys
+
+from time import time
+
+import benchenv
+benchenv.setup()
+
+import rados
+
+from xapi.storage.libs.xcpng.librbd import rbd_utils
+
+CLUSTER = 'ceph'
+POOL = 'RBD_XenStorage-bench'
+
+
+def run(operations, idle_timeout):
+    rados.reset()
+    manager = rbd_utils.ClusterConnectionManager(idle_timeout=idle_timeout)
+
+    cluster = rbd_utils.CephCluster('bench', CLUSTER, manager)
+    cluster.connect()
+    cluster.create_pool(POOL)
+    cluster.shutdown()
+
+    start = time()
+    for n in range(operations):
+        cluster = rbd_utils.CephCluster('bench', CLUSTER, manager)
+        cluster.connect()
+        try:
+            rbd_utils.rbd_create('bench', cluster, POOL, "vdi-%s" % n, 1 << 30)
+            rbd_utils.rbd_exists('bench', cluster, POOL, "vdi-%s" % n)
+        finally:
+            cluster.shutdown()
+    elapsed = time() - start
+
+    manager.shutdown_all()
+    return rados.STATS['connect'], elapsed
+
+
+def main():
+    operations = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+
+    for label, idle_timeout in (('per-call connections', 0),
+                                ('pooled connections', rbd_utils.CONNECTION_IDLE_TIMEOUT)):
+        connects, elapsed = run(operations, idle_timeout)
+        print("%-22s operations: %6d  connects: %6d  wall: %.3fs" % (label, operations, connects, elapsed))
+
+
+if __name__ == '__main__':
+    main()
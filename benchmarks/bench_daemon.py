@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+"""Per-call latency of plugin commands: a Python process per call vs forwarded to the plugin daemon
+
+Sets up a scratch plugin directory whose SR.stat is linked to client.py like the installed ones, and
+whose sr.py stands in for the xcpng script: it imports the plugin modules, connects to the (fake)
+cluster, reads the SR config and lists the pool. The command is run <calls> times in a row without a
+daemon, so every call runs sr.py in a fresh process, then with a daemon on a scratch socket.
+
+The fake cluster sleeps latency_ms per call, connect included. The real rados and rbd bindings and
+a real monitor handshake cost more than the fakes, so the gain on a host is larger: compare
+`time /usr/libexec/xapi-storage-script/volume/org.xen.xapi.storage.rbdsr/SR.stat ...` with the
+rbdsr-daemon service stopped and started.
+
+    python benchmarks/bench_daemon.py [calls] [latency_ms]
+"""
+
+from __future__ import division
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from time import sleep, time
+
+import benchenv
+
+CLIENT = os.path.join(benchenv.LIBRBD_PARENT_DIR, 'librbd', 'client.py')
+SR_URI = 'rbd+raw+qdisk://ceph/00000000-0000-0000-0000-000000000001'
+
+# Stand-in for the xcpng sr.py: the same imports, a connect and two cluster reads
+SR_SCRIPT = """
+import json
+import sys
+
+if 'benchenv' not in sys.modules:
+    sys.path.insert(0, %(bench_dir)r)
+    import benchenv
+    benchenv.setup()
+
+import rados
+rados.LATENCY = %(latency)r
+
+from xapi.storage.libs.xcpng.utils import get_cluster_name_by_uri, get_sr_name_by_uri
+from xapi.storage.libs.xcpng.librbd import datapath, meta, sr, volume
+from xapi.storage.libs.xcpng.librbd.rbd_utils import ceph_cluster, rbd_list, rados_omap_get
+
+uri = sys.argv[1]
+cluster = ceph_cluster('bench', get_cluster_name_by_uri('bench', uri))
+cluster.connect()
+try:
+    pool = get_sr_name_by_uri('bench', uri)
+    if pool not in cluster.list_pools():
+        cluster.create_pool(pool)
+    config = rados_omap_get('bench', cluster, pool, meta.SR_CONFIG_OBJECT)
+    print(json.dumps({'uri': uri, 'config': config, 'vdis': rbd_list('bench', cluster, pool)}))
+finally:
+    cluster.shutdown()
+"""
+
+# Runs the daemon with the scratch plugin root and socket
+DAEMON = """
+import sys
+sys.path.insert(0, %(bench_dir)r)
+import benchenv
+benchenv.setup()
+from xapi.storage.libs.xcpng.librbd import daemon
+daemon.PLUGIN_ROOT = %(plugin_root)r
+sys.exit(daemon.main(%(socket)r))
+"""
+
+
+def timed_calls(command, calls, env):
+    latencies = []
+    for n in range(calls):
+        start = time()
+        output = subprocess.check_output([command, SR_URI], env=env)
+        latencies.append(time() - start)
+        if b'"vdis"' not in output:
+            raise Exception("Unexpected output %r" % output)
+    return sorted(latencies)
+
+
+def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    latency = (float(sys.argv[2]) if len(sys.argv) > 2 else 0.5) / 1000
+
+    plugin_root = tempfile.mkdtemp(prefix='rbdsr-bench-plugins-')
+    plugin_dir = os.path.join(plugin_root, 'volume', 'org.xen.xapi.storage.rbdsr')
+    os.makedirs(plugin_dir)
+    with open(os.path.join(plugin_dir, 'sr.py'), 'w') as f:
+        f.write(SR_SCRIPT % {'bench_dir': benchenv.BENCH_DIR, 'latency': latency})
+    command = os.path.join(plugin_dir, 'SR.stat')
+    os.symlink(CLIENT, command)
+    socket_path = os.path.join(plugin_root, 'plugin.sock')
+    env = dict(os.environ, RBDSR_DAEMON_SOCKET=socket_path)
+
+    print("%d calls of SR.stat, %.2f ms per cluster call" % (calls, latency * 1000))
+    print("%-24s %10s %10s %10s" % ('', 'mean ms', 'p50 ms', 'max ms'))
+    daemon = None
+    try:
+        for label in ('process per call', 'plugin daemon'):
+            if label == 'plugin daemon':
+                daemon = subprocess.Popen([sys.executable, '-c', DAEMON % {'bench_dir': benchenv.BENCH_DIR,
+                                                                             'plugin_root': plugin_root,
+                                                                             'socket': socket_path}])
+                while not os.path.exists(socket_path):
+                    sleep(0.05)
+                timed_calls(command, 1, env)  # the first call compiles sr.py
+            latencies = timed_calls(command, calls, env)
+            print("%-24s %10.1f %10.1f %10.1f" % (label, sum(latencies) * 1000 / calls,
+                                                  latencies[calls // 2] * 1000, latencies[-1] * 1000))
+    finally:
+        if daemon is not None:
+            daemon.terminate()
+            daemon.wait()
+        shutil.rmtree(plugin_root)
+
+
+if __name__ == '__main__':
+    main()
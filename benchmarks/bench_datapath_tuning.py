@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""fio comparison of the qemu-nbd options of the datapath tuning profile
+
+Serves a local sparse image file with qemu-nbd once per combination of the qemu-nbd-* options and
+runs benchmarks/fio/datapath-tuning.fio against the /dev/nbdN device. A local file takes the
+network out of the picture, so only the cost of the qemu-nbd options themselves is compared. The
+rbd-* librbd settings need a cluster and are not covered. Needs root, the nbd module, qemu-nbd and fio.
+
+    python benchmarks/bench_datapath_tuning.py [image_size_gib]
+"""
+
+from __future__ import division
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+from itertools import product
+from subprocess import check_call, check_output
+
+QEMU_NBD = '/usr/lib64/qemu-dp-xcpng/bin/qemu-nbd'
+FIO_JOB = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fio', 'datapath-tuning.fio')
+NBD_DEVICE = '/dev/nbd15'
+
+PROFILES = {
+    'qemu-nbd-cache': ('none', 'writeback'),
+    'qemu-nbd-aio': ('threads', 'native'),
+    'qemu-nbd-detect-zeroes': ('off', 'unmap'),
+}
+
+
+def run_fio(device):
+    env = dict(os.environ, DEVICE=device)
+    output = check_output(['fio', '--output-format=json', FIO_JOB], env=env)
+    results = {}
+    for job in json.loads(output.decode())['jobs']:
+        side = job['read'] if job['read']['io_bytes'] else job['write']
+        results[job['jobname']] = (side['iops'], side['clat_ns']['mean'] / 1000)
+    return results
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    workdir = tempfile.mkdtemp(prefix='rbdsr-fio-')
+    image = os.path.join(workdir, 'image.raw')
+    with open(image, 'wb') as f:
+        f.truncate(size << 30)
+
+    keys = sorted(PROFILES)
+    try:
+        check_call(['/usr/sbin/modprobe', 'nbd'])
+        print("%-40s %-14s %12s %14s" % ('profile', 'job', 'IOPS', 'mean clat us'))
+        for values in product(*[PROFILES[key] for key in keys]):
+            options = ["--%s=%s" % (key[len('qemu-nbd-'):], value) for key, value in zip(keys, values)]
+            if '--aio=native' in options and '--cache=none' not in options:
+                continue  # native AIO requires O_DIRECT
+            check_call([QEMU_NBD, '-c', NBD_DEVICE, '-f', 'raw', '--discard=unmap'] + options + [image])
+            try:
+                results = run_fio(NBD_DEVICE)
+            finally:
+                check_call([QEMU_NBD, '-d', NBD_DEVICE])
+            label = ','.join(values)
+            for job in sorted(results):
+                iops, clat = results[job]
+                print("%-40s %-14s %12.0f %14.1f" % (label, job, iops, clat))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""Copy of a VDI to another pool: every byte against the diff stream, in full and incrementally
+
+"Every byte" reads the whole image in DIFF_CHUNK pieces and writes each to the target, as a copy
+through the NBD device does. The diff stream sends only allocated extents, and the incremental
+one only the extents changed since the previous snapshot. The stream goes through a pipe from the
+exporting to the importing thread, as it would through ssh. The fake cluster sleeps LATENCY seconds
+per call.
+
+    python benchmarks/bench_diff_export.py [image_gib] [allocated_percent] [changed_percent] [latency_ms]
+"""
+
+from __future__ import division
+
+import os
+import sys
+import threading
+
+from time import time
+
+import benchenv
+benchenv.setup()
+
+import rados
+
+from xapi.storage.libs.xcpng.librbd import rbd_utils
+from xapi.storage.libs.xcpng.librbd.diffstream import DIFF_CHUNK, export_diff, import_diff
+
+CLUSTER = 'ceph'
+SOURCE = 'RBD_XenStorage-00000000-0000-0000-0000-000000000001'
+TARGET = 'RBD_XenStorage-00000000-0000-0000-0000-000000000002'
+NAME = 'RAW-00000000'
+OBJECT_SIZE = 1 << rbd_utils.RBD_IMAGE_ORDER
+
+
+def fill(cluster, objects):
+    latency, rados.LATENCY = rados.LATENCY, 0
+    data = os.urandom(OBJECT_SIZE)
+    with cluster.image(SOURCE, NAME) as image:
+        for obj_no in objects:
+            image.write(data, obj_no * OBJECT_SIZE)
+    rados.LATENCY = latency
+
+
+def copy_every_byte(cluster, size):
+    with cluster.image(SOURCE, NAME) as source, cluster.image(TARGET, NAME + '-copy') as target:
+        for offset in range(0, size, DIFF_CHUNK):
+            target.write(source.read(offset, DIFF_CHUNK), offset)
+    return size
+
+
+def stream(cluster, snapshot, from_snapshot=None):
+    """Exports to a pipe in one thread and imports from it in another, returns the bytes of the stream"""
+    read_fd, write_fd = os.pipe()
+    reader, writer = os.fdopen(read_fd, 'rb'), os.fdopen(write_fd, 'wb')
+    received = []
+
+    class _Counted(object):
+        def __init__(self, f):
+            self.f = f
+            self.bytes = 0
+
+        def read(self, length):
+            data = self.f.read(length)
+            self.bytes += len(data)
+            return data
+
+    def _import_():
+        counted = _Counted(reader)
+        import_diff('bench', cluster, TARGET, NAME, counted)
+        received.append(counted.bytes)
+
+    importer = threading.Thread(target=_import_)
+    importer.start()
+    try:
+        export_diff('bench', cluster, SOURCE, NAME, snapshot, writer, from_snapshot)
+    finally:
+        writer.close()
+        importer.join()
+        reader.close()
+    return received[0]
+
+
+def timed(label, func):
+    rados.STATS.clear()
+    start = time()
+    transferred = func()
+    elapsed = time() - start
+    print("%-24s %10.2f %10d %12.1f %10.1f" % (label, elapsed, sum(rados.STATS.values()), transferred / (1 << 20),
+                                               transferred / (1 << 20) / elapsed))
+
+
+def main():
+    size = (int(sys.argv[1]) if len(sys.argv) > 1 else 2) << 30
+    allocated = float(sys.argv[2]) if len(sys.argv) > 2 else 15
+    changed = float(sys.argv[3]) if len(sys.argv) > 3 else 1
+    rados.LATENCY = float(sys.argv[4]) / 1000 if len(sys.argv) > 4 else 0.2 / 1000
+
+    cluster = rbd_utils.ceph_cluster('bench', CLUSTER)
+    cluster.connect()
+    cluster.create_pool(SOURCE)
+    cluster.create_pool(TARGET)
+    rbd_utils.rbd_create('bench', cluster, SOURCE, NAME, size)
+    rbd_utils.rbd_create('bench', cluster, TARGET, NAME + '-copy', size)
+    objects = size // OBJECT_SIZE
+    fill(cluster, range(0, objects, int(100 / allocated)))
+    rbd_utils.rbd_snapshot('bench', cluster, SOURCE, NAME, 'backup-1')
+
+    print("%d GiB image, %s%% allocated, %s%% changed, %.2f ms per call"
+          % (size >> 30, allocated, changed, rados.LATENCY * 1000))
+    print("%-24s %10s %10s %12s %10s" % ('copy', 'seconds', 'calls', 'MiB moved', 'MiB/s'))
+    timed('every byte', lambda: copy_every_byte(cluster, size))
+    timed('diff stream, full', lambda: stream(cluster, 'backup-1'))
+
+    fill(cluster, range(1, objects, int(100 / changed)))
+    rbd_utils.rbd_snapshot('bench', cluster, SOURCE, NAME, 'backup-2')
+    timed('diff stream, incremental', lambda: stream(cluster, 'backup-2', 'backup-1'))
+
+    cluster.shutdown()
+
+
+if __name__ == '__main__':
+    main()
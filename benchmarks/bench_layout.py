@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+"""fio comparison of RBD image layouts: object size, striping and data pool
+
+Creates a scratch image per layout in an existing pool of a live cluster, with the same arguments
+VDI.create would pass for the rbd-* device-config keys, and runs benchmarks/fio/layout.fio against
+it through librbd (fio's rbd engine). Small objects favour small random I/O, big objects and wide
+stripes large sequential I/O. Set DATA_POOL to an erasure coded pool (allow_ec_overwrites) to add
+the EC layouts. Needs the cluster's ceph.conf and admin keyring, python-rbd and fio built with rbd.
+
+    python benchmarks/bench_layout.py <pool> [cluster] [image_size_gib]
+
+With --check it only creates an image of each layout on the in-memory fake cluster and checks the
+striping it ends up with, and exits with an error if librbd would refuse or change a layout:
+
+    python benchmarks/bench_layout.py --check
+"""
+
+from __future__ import division
+
+import json
+import os
+import sys
+
+from subprocess import check_output
+
+CHECK = '--check' in sys.argv
+if CHECK:
+    import benchenv
+    benchenv.setup()
+
+import rados
+import rbd
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FIO_JOB = os.path.join(BENCH_DIR, 'fio', 'layout.fio')
+
+if not CHECK:
+    import xapi.storage.libs.xcpng
+    xapi.storage.libs.xcpng.__path__.insert(0, os.path.join(os.path.dirname(BENCH_DIR), 'src', 'xapi', 'storage',
+                                                            'libs', 'xcpng'))
+from xapi.storage.libs.xcpng.librbd.layout import get_layout_profile, merge_layout_profiles, object_size, \
+                                                  rbd_create_options
+
+IMAGE = 'rbdsr-bench-layout'
+
+LAYOUTS = [
+    {'rbd-object-size': '65536'},
+    {'rbd-object-size': '1048576'},
+    {},  # 2 MiB objects, the default
+    {'rbd-object-size': '4194304'},
+    {'rbd-object-size': '16777216'},
+    {'rbd-object-size': '4194304', 'rbd-stripe-unit': '65536', 'rbd-stripe-count': '16'},
+    {'rbd-object-size': '4194304', 'rbd-stripe-unit': '1048576', 'rbd-stripe-count': '4'},
+    {'rbd-object-size': '4194304', 'rbd-stripe-count': '4'},  # the stripe unit is the object size
+]
+
+
+def run_fio(cluster_name, pool):
+    env = dict(os.environ, CLUSTER=cluster_name, POOL=pool, IMAGE=IMAGE)
+    output = check_output(['fio', '--output-format=json', FIO_JOB], env=env)
+    results = {}
+    for job in json.loads(output.decode())['jobs']:
+        side = job['read'] if job['read']['io_bytes'] else job['write']
+        results[job['jobname']] = (side['iops'], side['bw'] / 1024, side['clat_ns']['mean'] / 1000)
+    return results
+
+
+def label(layout):
+    return ','.join("%s=%s" % (key[len('rbd-'):], layout[key]) for key in sorted(layout)) or 'default'
+
+
+def check():
+    cluster = rados.Rados()
+    cluster.connect()
+    cluster.create_pool('bench')
+    ioctx = cluster.open_ioctx('bench')
+    failed = 0
+    for layout in LAYOUTS:
+        profile = merge_layout_profiles(get_layout_profile('bench', layout))
+        expected = (int(profile['rbd-stripe-unit']) or object_size(profile), int(profile['rbd-stripe-count']))
+        try:
+            rbd.RBD().create(ioctx, IMAGE, 1 << 30, old_format=False, **rbd_create_options(profile))
+            image = rbd.Image(ioctx, IMAGE)
+            try:
+                striping = (image.stripe_unit(), image.stripe_count())
+            finally:
+                image.close()
+            rbd.RBD().remove(ioctx, IMAGE)
+        except Exception as e:
+            striping = e
+        if striping != expected:
+            failed += 1
+        print("%-64s %s" % (label(layout), 'ok' if striping == expected else "expected %s/%s, got %s"
+                                                                            % (expected + (striping,))))
+    ioctx.close()
+    cluster.shutdown()
+    return failed
+
+
+def main():
+    if CHECK:
+        sys.exit(1 if check() else 0)
+
+    pool = sys.argv[1]
+    cluster_name = sys.argv[2] if len(sys.argv) > 2 else 'ceph'
+    size = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+
+    layouts = list(LAYOUTS)
+    if os.environ.get('DATA_POOL'):
+        layouts += [dict(layout, **{'rbd-data-pool': os.environ['DATA_POOL']}) for layout in LAYOUTS]
+
+    cluster = rados.Rados(conffile="/etc/ceph/%s.conf" % cluster_name)
+    cluster.connect()
+    try:
+        ioctx = cluster.open_ioctx(pool)
+        try:
+            print("%-64s %-14s %10s %10s %14s" % ('layout', 'job', 'IOPS', 'MiB/s', 'mean clat us'))
+            for layout in layouts:
+                options = rbd_create_options(merge_layout_profiles(get_layout_profile('bench', layout)))
+                rbd.RBD().create(ioctx, IMAGE, size << 30, old_format=False, **options)
+                try:
+                    results = run_fio(cluster_name, pool)
+                finally:
+                    rbd.RBD().remove(ioctx, IMAGE)
+                for job in sorted(results):
+                    iops, bw, clat = results[job]
+                    print("%-64s %-14s %10.0f %10.1f %14.1f" % (label(layout), job, iops, bw, clat))
+        finally:
+            ioctx.close()
+    finally:
+        cluster.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""Contended lock handoff latency of LocksOpsMgr
+
+N threads, each standing in for a host with its own cluster connection, take turns holding the same
+VDI lock for a few milliseconds. Handoff latency is the time from one holder calling unlock() to the
+next waiter returning from lock(). Three waiting strategies are compared:
+
+    v3.0 polling    fixed 1 second sleep between attempts
+    backoff         jittered exponential backoff without watch/notify
+    watch/notify    backoff cut short by the release notification
+
+    python benchmarks/bench_locks.py [waiters] [hold_ms]
+"""
+
+from __future__ import division
+
+import sys
+import threading
+
+from time import sleep, time
+
+import benchenv
+benchenv.setup()
+
+import rados
+
+from xapi.storage.libs.xcpng.utils import get_sr_name_by_uri, get_vdi_name_by_uri
+from xapi.storage.libs.xcpng.librbd import locks, rbd_utils
+
+CLUSTER = 'ceph'
+URI = "rbd+raw+qdisk://%s/00000000-0000-0000-0000-000000000001/00000000-0000-0000-0000-0000000000aa" % CLUSTER
+
+_host = threading.local()
+
+
+def _host_cluster(dbg, cluster_name):
+    return rbd_utils.CephCluster(dbg, cluster_name, _host.manager)
+
+
+def host(start, hold, events):
+    _host.manager = rbd_utils.ClusterConnectionManager()
+    mgr = locks.LocksOpsMgr()
+    start.wait()
+    mgr.lock('bench', URI, timeout=600)
+    events.append(('acquired', time()))
+    sleep(hold)
+    events.append(('released', time()))
+    mgr.unlock('bench', URI)
+    _host.manager.shutdown_all()
+
+
+def run(waiters, hold):
+    rados.reset()
+    cluster = rbd_utils.CephCluster('bench', CLUSTER, rbd_utils.ClusterConnectionManager())
+    cluster.connect()
+    cluster.create_pool(get_sr_name_by_uri('bench', URI))
+    rbd_utils.rbd_create('bench', cluster, get_sr_name_by_uri('bench', URI), '__lock__', 0)
+    rbd_utils.rbd_create('bench', cluster, get_sr_name_by_uri('bench', URI), get_vdi_name_by_uri('bench', URI), 0)
+
+    start = threading.Event()
+    events = []
+    threads = [threading.Thread(target=host, args=(start, hold, events)) for n in range(waiters)]
+    for thread in threads:
+        thread.start()
+    start.set()
+    for thread in threads:
+        thread.join()
+    cluster.shutdown()
+
+    events.sort(key=lambda event: event[1])
+    handoffs = [events[n + 1][1] - events[n][1] for n in range(1, len(events) - 1, 2)]
+    return sum(handoffs) / len(handoffs), max(handoffs), events[-1][1] - events[0][1]
+
+
+def main():
+    waiters = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    hold = (float(sys.argv[2]) if len(sys.argv) > 2 else 10) / 1000
+
+    locks.ceph_cluster = _host_cluster
+    watch = rados.Ioctx.watch
+    uniform = locks.uniform
+    min_delay, max_delay = locks.LOCK_RETRY_MIN_DELAY, locks.LOCK_RETRY_MAX_DELAY
+
+    print("%-14s %8s %16s %16s %10s" % ('strategy', 'waiters', 'avg handoff ms', 'max handoff ms', 'total s'))
+    for label in ('v3.0 polling', 'backoff', 'watch/notify'):
+        if label == 'watch/notify':
+            rados.Ioctx.watch = watch
+        elif hasattr(rados.Ioctx, 'watch'):
+            del rados.Ioctx.watch
+        if label == 'v3.0 polling':
+            locks.LOCK_RETRY_MIN_DELAY = locks.LOCK_RETRY_MAX_DELAY = 1.0
+            locks.uniform = lambda low, high: high
+        else:
+            locks.LOCK_RETRY_MIN_DELAY, locks.LOCK_RETRY_MAX_DELAY = min_delay, max_delay
+            locks.uniform = uniform
+        avg, worst, total = run(waiters, hold)
+        print("%-14s %8d %16.1f %16.1f %10.2f" % (label, waiters, avg * 1000, worst * 1000, total))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+"""Single-VDI MetaDB update cost as the number of VDIs in the SR grows
+
+For every SR size the same update (one VDI document changes) is dumped with the v3.0 layout, which
+rewrites the whole length-prefixed blob in the __meta__ image, and with the omap layout of
+MetaDBOperations, which writes only the changed document.
+
+Then the updates are repeated with writes to the VDI images and the SR config in between, as a live
+pool has. The fake cluster versions objects per placement group like RADOS, so the MetaDB cache must
+survive that I/O: the run exits with an error if any of those loads had to read the whole DB again.
+
+    python benchmarks/bench_metadb.py [updates]
+"""
+
+import sys
+
+from json import dumps, loads
+from struct import pack, unpack
+from time import time
+
+import benchenv
+benchenv.setup()
+
+import rados
+
+from xapi.storage.libs.xcpng.utils import get_sr_name_by_uri
+from xapi.storage.libs.xcpng.librbd import rbd_utils
+from xapi.storage.libs.xcpng.librbd import meta
+from xapi.storage.libs.xcpng.librbd.meta import MetaDBOperations
+
+CLUSTER = 'ceph'
+SR_UUID = '00000000-0000-0000-0000-000000000001'
+URI = "rbd+raw+qdisk://%s/%s" % (CLUSTER, SR_UUID)
+VDI_COUNTS = (10, 100, 1000, 10000)
+
+
+def make_db(vdis):
+    db = {'_default': {}, 'sr': {'1': {'uuid': SR_UUID, 'name': 'bench', 'description': ''}}, 'vdis': {}}
+    for n in range(vdis):
+        db['vdis'][str(n + 1)] = {'uuid': "vdi-%08d" % n, 'key': "vdi-%08d" % n, 'name': "VDI %d" % n,
+                                  'description': '', 'virtual_size': 10 << 30, 'image_uuid': "img-%08d" % n,
+                                  'read_write': True, 'sharable': False, 'keys': {}, 'nbd_dev': None}
+    return db
+
+
+def setup_pool(pool):
+    cluster = rbd_utils.ceph_cluster('bench', CLUSTER)
+    cluster.connect()
+    cluster.create_pool(pool)
+    return cluster
+
+
+def legacy_load(cluster, pool):
+    length = unpack('!I', rbd_utils.rbd_read('bench', cluster, pool, '__meta__', 0, 4))[0]
+    return unpack('!%ss' % length, rbd_utils.rbd_read('bench', cluster, pool, '__meta__', 4, length))[0]
+
+
+def legacy_dump(cluster, pool, json):
+    json = json.encode()
+    length = len(json)
+    rbd_utils.rbd_write('bench', cluster, pool, '__meta__', pack("!I%ss" % length, length, json), 0, length + 4)
+
+
+def run(vdis, updates):
+    rados.reset()
+    rbd_utils.CONNECTIONS.shutdown_all()
+    pool = get_sr_name_by_uri('bench', URI)
+    cluster = setup_pool(pool)
+    db = make_db(vdis)
+
+    rbd_utils.rbd_create('bench', cluster, pool, '__meta__', 1 << 30)
+    legacy_dump(cluster, pool, dumps(db))
+    start = time()
+    for n in range(updates):
+        db = loads(legacy_load(cluster, pool))
+        db['vdis'][str(n % vdis + 1)]['nbd_dev'] = "/dev/nbd%d" % n
+        legacy_dump(cluster, pool, dumps(db))
+    legacy = (time() - start) / updates
+
+    meta = MetaDBOperations()
+    meta.create('bench', URI, dumps(db))
+    written = rados.STATS['omap_bytes_written']
+    start = time()
+    for n in range(updates):
+        db = loads(meta.load('bench', URI))
+        db['vdis'][str(n % vdis + 1)]['nbd_dev'] = None
+        meta.dump('bench', URI, dumps(db))
+    sharded = (time() - start) / updates
+    per_update_bytes = (rados.STATS['omap_bytes_written'] - written) // updates
+
+    cluster.shutdown()
+    return legacy, len(dumps(db)) + 4, sharded, per_update_bytes
+
+
+def cache_under_io(vdis, updates):
+    """Returns the MetaDB cache invalidations of updates interleaved with unrelated writes"""
+    rados.reset()
+    rbd_utils.CONNECTIONS.shutdown_all()
+    pool = get_sr_name_by_uri('bench', URI)
+    cluster = setup_pool(pool)
+    for n in range(vdis):
+        rbd_utils.rbd_create('bench', cluster, pool, "RAW-img-%08d" % n, 1 << 30)
+
+    meta_ops = MetaDBOperations()
+    meta_ops.create('bench', URI, dumps(make_db(vdis)))
+    invalidations = meta.META_CACHE.stats()['invalidations']
+    for n in range(updates):
+        db = loads(meta_ops.load('bench', URI))
+        db['vdis'][str(n % vdis + 1)]['nbd_dev'] = "/dev/nbd%d" % n
+        meta_ops.dump('bench', URI, dumps(db))
+        for m in range(vdis):
+            rbd_utils.rbd_write('bench', cluster, pool, "RAW-img-%08d" % m, b'x', (n * vdis + m) << 22, 1)
+        rbd_utils.rados_omap_set('bench', cluster, pool, meta.SR_CONFIG_OBJECT, {'updates': str(n)})
+
+    cluster.shutdown()
+    return meta.META_CACHE.stats()['invalidations'] - invalidations
+
+
+def main():
+    updates = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    print("%8s  %14s  %14s  %14s  %14s" % ('VDIs', 'blob bytes/upd', 'omap bytes/upd', 'blob upd ms', 'omap upd ms'))
+    for vdis in VDI_COUNTS:
+        legacy, legacy_bytes, sharded, sharded_bytes = run(vdis, updates)
+        print("%8d  %14d  %14d  %14.3f  %14.3f" % (vdis, legacy_bytes, sharded_bytes, legacy * 1000, sharded * 1000))
+
+    invalidations = cache_under_io(10, updates)
+    print("MetaDB cache invalidations over %d updates with VDI and SR config I/O in between: %d"
+          % (updates, invalidations))
+    if invalidations:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+"""Attach latency and memory of per-VDI qemu-nbd processes vs the shared NBD server
+
+Needs a real host: root, the nbd module, qemu-dp, nbd-client and a reachable Ceph cluster. Creates
+<count> thin images in <pool>, attaches all of them to /dev/nbdN in each mode, reports the mean
+attach time and the resident memory of the serving processes, then detaches and removes them.
+
+    python benchmarks/bench_nbd_attach.py <cluster> <pool> [count]
+"""
+
+from __future__ import division
+
+import os
+import sys
+
+from subprocess import check_call, check_output
+from time import time
+
+from rados import Rados
+from rbd import RBD
+
+from xapi.storage.libs.xcpng.librbd.nbd_utils import NBDAllocator, NBDServer
+
+QEMU_NBD = '/usr/lib64/qemu-dp-xcpng/bin/qemu-nbd'
+IMAGE_SIZE = 1 << 30
+
+
+def rss_kb(pids):
+    total = 0
+    for pid in pids:
+        with open("/proc/%s/status" % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    total += int(line.split()[1])
+    return total
+
+
+def pids_of(pattern):
+    try:
+        return check_output(['pgrep', '-f', pattern]).decode().split()
+    except Exception:
+        return []
+
+
+def per_vdi(cluster, pool, images):
+    allocator = NBDAllocator()
+    devices = []
+    start = time()
+    for image in images:
+        with allocator.allocate('bench') as nbd_dev:
+            check_call([QEMU_NBD, '-c', nbd_dev, '-f', 'raw',
+                        "rbd:%s/%s:conf=/etc/ceph/%s.conf" % (pool, image, cluster)])
+        devices.append(nbd_dev)
+    elapsed = time() - start
+    rss = rss_kb(pids_of("%s -c" % QEMU_NBD))
+    for nbd_dev in devices:
+        check_call([QEMU_NBD, '-d', nbd_dev])
+        allocator.release('bench', nbd_dev)
+    return elapsed, rss
+
+
+def shared(cluster, pool, images):
+    allocator = NBDAllocator()
+    server = NBDServer('bench', cluster)
+    devices = []
+    start = time()
+    for image in images:
+        export = server.add_export(pool, image)
+        with allocator.allocate('bench') as nbd_dev:
+            server.connect_device(nbd_dev, export)
+        devices.append((nbd_dev, image))
+    elapsed = time() - start
+    with open(server.pid_path) as f:
+        rss = rss_kb([f.read().strip()] + pids_of("nbd-client -unix %s" % server.nbd_path))
+    for nbd_dev, image in devices:
+        server.disconnect_device(nbd_dev)
+        allocator.release('bench', nbd_dev)
+        server.remove_export(pool, image)
+    return elapsed, rss
+
+
+def main():
+    cluster, pool = sys.argv[1], sys.argv[2]
+    count = int(sys.argv[3]) if len(sys.argv) > 3 else 16
+    images = ["bench-nbd-%s-%s" % (os.getpid(), n) for n in range(count)]
+
+    rados = Rados(conffile="/etc/ceph/%s.conf" % cluster)
+    rados.connect()
+    ioctx = rados.open_ioctx(pool)
+    try:
+        for image in images:
+            RBD().create(ioctx, image, IMAGE_SIZE)
+        for label, attach in (('qemu-nbd per VDI', per_vdi), ('shared NBD server', shared)):
+            elapsed, rss = attach(cluster, pool, images)
+            print("%-18s VDIs: %4d  attach: %7.1f ms/VDI  RSS: %8d KiB total %7.1f KiB/VDI"
+                  % (label, count, elapsed * 1000 / count, rss, rss / count))
+    finally:
+        for image in images:
+            try:
+                RBD().remove(ioctx, image)
+            except Exception:
+                pass
+        ioctx.close()
+        rados.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""fio comparison of the persistent write-back cache against the uncached path
+
+Creates a scratch image in an existing pool and runs benchmarks/fio/persistent-cache.fio against
+it through librbd (fio's rbd engine), first as VDIs are attached without rbd-persistent-cache, then
+with the librbd settings map_vol adds for it (pcache.cache_options) in a ceph.conf of its own. The
+cache only pays off when the cluster is slower than the local device, so without a production
+cluster a single-node test cluster whose OSDs sit on loop devices stands in for it, with the cache
+directory on the host's SSD. After the cached run the cache state left in the image metadata is
+printed: fio closed the image, so it must be clean. Needs the cluster's ceph.conf and admin keyring,
+python-rbd, fio built with rbd and librbd with the pwl_cache plugin (Ceph Pacific or later).
+
+    python benchmarks/bench_persistent_cache.py <pool> [cluster] [image_size_gib] [cache_dir]
+
+cache_dir defaults to PERSISTENT_CACHE_DIR of the host settings.
+"""
+
+from __future__ import division
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+from subprocess import check_output
+
+import rados
+import rbd
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FIO_JOB = os.path.join(BENCH_DIR, 'fio', 'persistent-cache.fio')
+
+import xapi.storage.libs.xcpng
+xapi.storage.libs.xcpng.__path__.insert(0, os.path.join(os.path.dirname(BENCH_DIR), 'src', 'xapi', 'storage', 'libs',
+                                                        'xcpng'))
+from xapi.storage.libs.xcpng.librbd import pcache
+
+IMAGE = 'rbdsr-bench-pcache'
+
+
+def write_conf(cluster_name, options, scratch):
+    """Returns a copy of the cluster's ceph.conf with options in its [client] section"""
+    path = os.path.join(scratch, "%s.conf" % cluster_name)
+    with open("/etc/ceph/%s.conf" % cluster_name) as f:
+        conf = f.read()
+    with open(path, 'w') as f:
+        f.write(conf)
+        f.write("\n[client]\n")
+        for option in options:
+            f.write("%s = %s\n" % option)
+    return path
+
+
+def run_fio(cluster_name, pool, conf):
+    env = dict(os.environ, CLUSTER=cluster_name, POOL=pool, IMAGE=IMAGE, CEPH_CONF=conf)
+    output = check_output(['fio', '--output-format=json', FIO_JOB], env=env)
+    results = {}
+    for job in json.loads(output.decode())['jobs']:
+        side = job['read'] if job['read']['io_bytes'] else job['write']
+        results[job['jobname']] = (side['iops'], side['bw'] / 1024, side['clat_ns']['mean'] / 1000,
+                                   side['clat_ns'].get('percentile', {}).get('99.000000', 0) / 1000)
+    return results
+
+
+def cache_state(ioctx):
+    image = rbd.Image(ioctx, IMAGE)
+    try:
+        return pcache.is_dirty(json.loads(image.metadata_get(pcache.PCACHE_STATE_KEY)))
+    except KeyError:
+        return None
+    finally:
+        image.close()
+
+
+def main():
+    pool = sys.argv[1]
+    cluster_name = sys.argv[2] if len(sys.argv) > 2 else 'ceph'
+    size = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+    if len(sys.argv) > 4:
+        settings = {'PERSISTENT_CACHE_DIR': sys.argv[4]}
+        pcache.get_host_config = lambda dbg, name, default: settings.get(name, default)
+    options = pcache.cache_options('bench')
+    if not options:
+        sys.exit("No cache directory: give one or set PERSISTENT_CACHE_DIR in the host settings")
+
+    scratch = tempfile.mkdtemp(prefix='rbdsr-bench-pcache-')
+    cluster = rados.Rados(conffile="/etc/ceph/%s.conf" % cluster_name)
+    cluster.connect()
+    try:
+        ioctx = cluster.open_ioctx(pool)
+        try:
+            print("%-10s %-14s %10s %10s %14s %14s" % ('cache', 'job', 'IOPS', 'MiB/s', 'mean clat us',
+                                                      'p99 clat us'))
+            for label, cache in (('none', []), ('pwl', options)):
+                rbd.RBD().create(ioctx, IMAGE, size << 30, old_format=False,
+                                 features=rbd.RBD_FEATURE_LAYERING | rbd.RBD_FEATURE_EXCLUSIVE_LOCK)
+                try:
+                    results = run_fio(cluster_name, pool, write_conf(cluster_name, cache, scratch))
+                    dirty = cache_state(ioctx) if cache else None
+                finally:
+                    rbd.RBD().remove(ioctx, IMAGE)
+                for job in sorted(results):
+                    print("%-10s %-14s %10.0f %10.1f %14.1f %14.1f" % ((label, job) + results[job]))
+                if cache:
+                    print("cache state after close: %s" % {None: 'none', False: 'clean', True: 'DIRTY'}[dirty])
+        finally:
+            ioctx.close()
+    finally:
+        cluster.shutdown()
+        shutil.rmtree(scratch)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+"""SR scan of a pool of 5,000 images: per-VDI queries against the one-pass rbd_scan
+
+The per-VDI scan does what SR.ls did through VolumeOperations: for every image a connect, an
+Image open for the size, another for the parent and another for the utilization. rbd_scan lists the
+pool once and queries the images concurrently on one IoCtx. The fake cluster sleeps LATENCY seconds
+per call to stand in for the network round trip. A tenth of the images are clones, one in a hundred
+has no fast-diff and takes a scan of its objects.
+
+    python benchmarks/bench_sr_scan.py [images] [latency_ms]
+"""
+
+from __future__ import division
+
+import sys
+
+from time import time
+
+import benchenv
+benchenv.setup()
+
+import rados
+import rbd
+
+from xapi.storage.libs.xcpng.librbd import rbd_utils
+
+CLUSTER = 'ceph'
+POOL = 'RBD_XenStorage-00000000-0000-0000-0000-000000000001'
+PREFIX = 'RAW-'
+IMAGE_SIZE = 1 << 30
+
+
+def setup_pool(images):
+    cluster = rbd_utils.ceph_cluster('bench', CLUSTER)
+    cluster.connect()
+    cluster.create_pool(POOL)
+    with cluster.ioctx(POOL) as ioctx:
+        rbd.RBD().create(ioctx, "%sbase" % PREFIX, IMAGE_SIZE, order=rbd_utils.RBD_IMAGE_ORDER,
+                         features=rbd_utils.RBD_DEFAULT_FEATURES)
+        with rbd.Image(ioctx, "%sbase" % PREFIX) as base:
+            base.create_snap('base')
+            base.protect_snap('base')
+        for n in range(images - 1):
+            name = "%s%08d" % (PREFIX, n)
+            if n % 10 == 0:
+                rbd.RBD().clone(ioctx, "%sbase" % PREFIX, 'base', ioctx, name)
+            else:
+                features = rbd_utils.RBD_KRBD_FEATURES if n % 100 == 1 else rbd_utils.RBD_DEFAULT_FEATURES
+                rbd.RBD().create(ioctx, name, IMAGE_SIZE, order=rbd_utils.RBD_IMAGE_ORDER, features=features)
+            with rbd.Image(ioctx, name) as image:
+                for offset in range(0, (n % 8) << 27, 1 << 27):
+                    image.write(b'x', offset)
+    cluster.shutdown()
+
+
+def per_vdi_scan():
+    vdis = {}
+    for name in _list():
+        if not name.startswith(PREFIX):
+            continue
+        cluster = rbd_utils.ceph_cluster('bench', CLUSTER)
+        cluster.connect()
+        try:
+            with cluster.ioctx(POOL) as ioctx:
+                with rbd.Image(ioctx, name) as image:
+                    size = image.size()
+                with rbd.Image(ioctx, name) as image:
+                    try:
+                        parent = image.parent_info()
+                    except rbd.ImageNotFound:
+                        parent = None
+                with rbd.Image(ioctx, name) as image:
+                    used = rbd_utils._image_utilization('bench', image, size)
+            vdis[name] = {'size': size, 'parent': parent, 'utilization': used}
+        finally:
+            cluster.shutdown()
+    return vdis
+
+
+def _list():
+    cluster = rbd_utils.ceph_cluster('bench', CLUSTER)
+    cluster.connect()
+    try:
+        return rbd_utils.rbd_list('bench', cluster, POOL)
+    finally:
+        cluster.shutdown()
+
+
+def batched_scan():
+    cluster = rbd_utils.ceph_cluster('bench', CLUSTER)
+    cluster.connect()
+    try:
+        return rbd_utils.rbd_scan('bench', cluster, POOL, PREFIX, utilization=True)
+    finally:
+        cluster.shutdown()
+
+
+def measure(scan):
+    rbd_utils.UTILIZATION_CACHE = rbd_utils.UtilizationCache()
+    rados.STATS.clear()
+    start = time()
+    vdis = scan()
+    return time() - start, sum(rados.STATS.values()), vdis
+
+
+def main():
+    images = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    latency = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.2 / 1000
+
+    setup_pool(images)
+    rados.LATENCY = latency
+
+    print("%d images, %.2f ms per call" % (images, latency * 1000))
+    print("%-10s %10s %10s %10s" % ('scan', 'seconds', 'calls', 'VDIs/s'))
+    results = {}
+    for label, scan in (('per-VDI', per_vdi_scan), ('rbd_scan', batched_scan)):
+        elapsed, calls, results[label] = measure(scan)
+        print("%-10s %10.2f %10d %10.0f" % (label, elapsed, calls, len(results[label]) / elapsed))
+    if results['per-VDI'] != dict(results['rbd_scan']):
+        print("results differ")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+"""Regression suite of the plugin's hot paths, run against the in-memory fake cluster
+
+Every scenario drives the plugin's own SROperations, VolumeOperations, MetaDBOperations and
+LocksOpsMgr the way the SMAPIv3 calls of a host do, the fake cluster sleeping latency_ms per call:
+
+    boot_storm      VDIs attached at once by as many threads: VDI lock, MetaDB load, SR config,
+                    MetaDB update, unlock
+    create_destroy  VDIs created then destroyed one SMAPI call at a time under the SR lock, then one
+                    round of the pool worker, as the destroys meanwhile only flag it
+    sr_scan         SR.ls of a populated SR: MetaDB load, VDI list and the utilization of each VDI,
+                    SR size and free space
+    lock_contention hosts, each with its own cluster connection, taking turns holding one VDI lock
+
+and reports the cluster round trips, connects, wall time and peak memory of its timed part (Python
+allocations with tracemalloc, the process peak RSS without it). Round trips and connects don't
+depend on the machine, so CI keeps a baseline of them and fails when a change makes a hot path
+talk to the cluster more:
+
+    python benchmarks/bench_suite.py --json results.json
+    python benchmarks/bench_suite.py --baseline benchmarks/baseline.json
+
+Wall time is only compared with --wall-tolerance, on runners quiet enough for it.
+
+    python benchmarks/bench_suite.py [--size N] [--latency-ms MS] [--only SCENARIO ...] [--calls]
+
+--calls lists the cluster calls of every scenario, to find the one that grew.
+"""
+
+from __future__ import division
+
+import argparse
+import json
+import shutil
+import sys
+import tempfile
+import threading
+
+from time import sleep, time
+
+import benchenv
+benchenv.setup()
+
+import rados
+
+try:
+    import tracemalloc
+except ImportError:
+    import resource
+    tracemalloc = None
+
+from xapi.storage.libs.xcpng.meta import IMAGE_UUID_TAG
+from xapi.storage.libs.xcpng.utils import get_sr_name_by_uri
+from xapi.storage.libs.xcpng.librbd import flatten, locks, meta, rbd_utils, sr, stats, volume
+from xapi.storage.libs.xcpng.librbd.locks import LocksOpsMgr
+from xapi.storage.libs.xcpng.librbd.meta import MetaDBOperations, get_sr_config
+from xapi.storage.libs.xcpng.librbd.sr import SROperations
+from xapi.storage.libs.xcpng.librbd.volume import VolumeOperations
+
+CLUSTER = 'ceph'
+SR_URI = "rbd+raw+qdisk://%s/00000000-0000-0000-0000-%012d"
+VDI_SIZE = 10 << 30
+# Calls the fake cluster counts that don't leave the client
+LOCAL_CALLS = ('shutdown', 'ioctx_close', 'image_close')
+METRICS = ('round_trips', 'connects', 'wall_s', 'peak_kib')
+
+_host = threading.local()
+_worker_pools = set()  # (cluster name, pool) the destroys scheduled the pool worker for
+
+
+class _MetadataHandler(object):
+    """The VDI lookups of xcpng's MetadataHandler, on the SR's MetaDB"""
+
+    def __init__(self, metadb):
+        self.metadb = metadb
+
+    def get_vdi_meta(self, dbg, uri):
+        sr_uri, vdi_uuid = uri.rsplit('/', 1)
+        for doc in json.loads(self.metadb.load(dbg, sr_uri))['vdis'].values():
+            if doc['uuid'] == vdi_uuid:
+                return doc
+        raise Exception("VDI %s not found" % uri)
+
+    def update_vdi_meta(self, dbg, uri, update):
+        sr_uri, vdi_uuid = uri.rsplit('/', 1)
+        db = json.loads(self.metadb.load(dbg, sr_uri))
+        for doc in db['vdis'].values():
+            if doc['uuid'] == vdi_uuid:
+                doc.update(update)
+        self.metadb.dump(dbg, sr_uri, json.dumps(db))
+
+
+def _vdi_uuid(n):
+    return "00000000-0000-0000-0001-%012d" % n
+
+
+def _vdi_doc(n):
+    return {'uuid': _vdi_uuid(n), 'key': _vdi_uuid(n), 'name': "VDI %d" % n, 'description': '',
+            'virtual_size': VDI_SIZE, IMAGE_UUID_TAG: _vdi_uuid(n), 'read_write': True, 'sharable': False,
+            'keys': {}, 'nbd_dev': None}
+
+
+def _volume_ops(metadb):
+    ops = VolumeOperations()
+    ops.MetadataHandler = _MetadataHandler(metadb)
+    return ops
+
+
+def _host_cluster(dbg, cluster_name):
+    manager = getattr(_host, 'manager', None)
+    return rbd_utils.CephCluster(dbg, cluster_name, rbd_utils.CONNECTIONS if manager is None else manager)
+
+
+def make_sr(n, vdis):
+    """Creates SR number n with vdis VDIs, returns its uri"""
+    uri = SR_URI % (CLUSTER, n)
+    SROperations().create('bench', uri, {'cluster': CLUSTER})
+    metadb = MetaDBOperations()
+    db = {'_default': {}, 'sr': {'1': {'uuid': uri.rsplit('/', 1)[1], 'name': 'bench', 'description': ''}},
+          'vdis': dict((str(v + 1), _vdi_doc(v)) for v in range(vdis))}
+    metadb.create('bench', uri, json.dumps(db))
+    if vdis:
+        _volume_ops(metadb).create_many('bench', [("%s/%s" % (uri, _vdi_uuid(v)), VDI_SIZE) for v in range(vdis)])
+    return uri
+
+
+def prepare_boot_storm(size):
+    return make_sr(1, size), size
+
+
+def boot_storm(state):
+    uri, vdis = state
+    barrier = threading.Event()
+    errors = []
+
+    def _attach_(n):
+        vdi_uri = "%s/%s" % (uri, _vdi_uuid(n))
+        lock_mgr = LocksOpsMgr()
+        handler = _MetadataHandler(MetaDBOperations())
+        barrier.wait()
+        try:
+            lock_mgr.lock('bench', vdi_uri, timeout=60)
+            try:
+                handler.get_vdi_meta('bench', vdi_uri)
+                get_sr_config('bench', vdi_uri)
+                handler.update_vdi_meta('bench', vdi_uri, {'nbd_dev': "/dev/nbd%d" % n})
+            finally:
+                lock_mgr.unlock('bench', vdi_uri)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=_attach_, args=(n,)) for n in range(vdis)]
+    for thread in threads:
+        thread.start()
+    barrier.set()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+def prepare_create_destroy(size):
+    return make_sr(2, 0), size
+
+
+def create_destroy(state):
+    uri, vdis = state
+    lock_mgr = LocksOpsMgr()
+    metadb = MetaDBOperations()
+    ops = _volume_ops(metadb)
+    for n in range(vdis):
+        lock_mgr.lock('bench', uri)
+        try:
+            db = json.loads(metadb.load('bench', uri))
+            db['vdis'][str(n + 1)] = _vdi_doc(n)
+            metadb.dump('bench', uri, json.dumps(db))
+            ops.create('bench', "%s/%s" % (uri, _vdi_uuid(n)), VDI_SIZE)
+        finally:
+            lock_mgr.unlock('bench', uri)
+    for n in range(vdis):
+        lock_mgr.lock('bench', uri)
+        try:
+            ops.destroy('bench', "%s/%s" % (uri, _vdi_uuid(n)))
+            db = json.loads(metadb.load('bench', uri))
+            del db['vdis'][str(n + 1)]
+            metadb.dump('bench', uri, json.dumps(db))
+        finally:
+            lock_mgr.unlock('bench', uri)
+    for cluster_name, pool in sorted(_worker_pools):
+        flatten.work_pool('bench', cluster_name, pool)
+    _worker_pools.clear()
+
+
+def prepare_sr_scan(size):
+    uri = make_sr(3, size)
+    # Half the VDIs hold data, as many blocks as their number modulo 8
+    cluster = rbd_utils.ceph_cluster('bench', CLUSTER)
+    cluster.connect()
+    try:
+        for n in range(0, size, 2):
+            for block in range(n % 8):
+                rbd_utils.rbd_write('bench', cluster, get_sr_name_by_uri('bench', uri),
+                                    "RAW-%s" % _vdi_uuid(n), b'x', block << rbd_utils.RBD_IMAGE_ORDER, 1)
+    finally:
+        cluster.shutdown()
+    return uri, size
+
+
+def sr_scan(state):
+    uri, vdis = state
+    metadb = MetaDBOperations()
+    ops = _volume_ops(metadb)
+    sr_ops = SROperations()
+    db = json.loads(metadb.load('bench', uri))
+    images = sr_ops.get_vdi_list('bench', uri)
+    if len(images) != vdis:
+        raise Exception("Scanned %d of %d VDIs" % (len(images), vdis))
+    for doc in db['vdis'].values():
+        ops.get_phisical_utilization('bench', "%s/%s" % (uri, doc['uuid']))
+    sr_ops.get_size('bench', uri)
+    sr_ops.get_free_space('bench', uri)
+
+
+def prepare_lock_contention(size):
+    uri = make_sr(4, 1)
+    return "%s/%s" % (uri, _vdi_uuid(0)), min(size, 16)
+
+
+def lock_contention(state):
+    vdi_uri, hosts = state
+    barrier = threading.Event()
+    errors = []
+
+    def _host_():
+        _host.manager = rbd_utils.ClusterConnectionManager()
+        lock_mgr = LocksOpsMgr()
+        barrier.wait()
+        try:
+            lock_mgr.lock('bench', vdi_uri, timeout=600)
+            sleep(0.005)
+            lock_mgr.unlock('bench', vdi_uri)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            _host.manager.shutdown_all()
+
+    threads = [threading.Thread(target=_host_) for n in range(hosts)]
+    for thread in threads:
+        thread.start()
+    barrier.set()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+SCENARIOS = (
+    ('boot_storm', prepare_boot_storm, boot_storm),
+    ('create_destroy', prepare_create_destroy, create_destroy),
+    ('sr_scan', prepare_sr_scan, sr_scan),
+    ('lock_contention', prepare_lock_contention, lock_contention),
+)
+
+
+def reset(run_dir):
+    """Forgets the fake clusters and every connection and cache of the previous scenario"""
+    rbd_utils.CONNECTIONS.shutdown_all()
+    rados.reset()
+    rbd_utils.POOL_LIST_CACHE.invalidate(CLUSTER)
+    rbd_utils.UTILIZATION_CACHE = rbd_utils.UtilizationCache()
+    meta.META_CACHE = meta.MetaDBCache()
+    sr.POOL_STATS = stats.PoolStatsService(run_dir)
+
+
+def _schedule_pool_worker(dbg, cluster_name, pool):
+    # In place of starting the pool worker process, which would import the real bindings
+    _worker_pools.add((cluster_name, pool))
+
+
+def measure(prepare, scenario, size, latency, run_dir):
+    reset(run_dir)
+    rados.LATENCY = 0
+    state = prepare(size)
+    rbd_utils.CONNECTIONS.shutdown_all()  # the scenario's first call connects, as on a host
+    rados.LATENCY = latency
+    rados.STATS.clear()
+    if tracemalloc is not None:
+        tracemalloc.start()
+    start = time()
+    scenario(state)
+    elapsed = time() - start
+    if tracemalloc is not None:
+        peak = tracemalloc.get_traced_memory()[1] // 1024
+        tracemalloc.stop()
+    else:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {'round_trips': sum(count for call, count in rados.STATS.items()
+                               if call not in LOCAL_CALLS and not call.endswith('_bytes_read')
+                               and not call.endswith('_bytes_written')),
+            'connects': rados.STATS['connect'],
+            'wall_s': round(elapsed, 3),
+            'peak_kib': peak}
+
+
+def regressions(results, baseline, tolerance, wall_tolerance):
+    """Returns a line for every metric of results worse than baseline by more than the tolerance"""
+    lines = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        checked = [('round_trips', tolerance), ('connects', tolerance)]
+        if wall_tolerance is not None:
+            checked.append(('wall_s', wall_tolerance))
+        for metric, allowed in checked:
+            before = baseline[name][metric]
+            if result[metric] > before * (1 + allowed) and result[metric] > before:
+                lines.append("%s %s: %s, baseline %s" % (name, metric, result[metric], before))
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline regression suite of the plugin hot paths')
+    parser.add_argument('--size', type=int, default=64, help='VDIs (boot_storm, create_destroy, sr_scan) and '
+                                                             'hosts (lock_contention, at most 16) per scenario')
+    parser.add_argument('--latency-ms', type=float, default=0.2, help='fake cluster latency per call')
+    parser.add_argument('--only', nargs='+', choices=[name for name, prepare, scenario in SCENARIOS])
+    parser.add_argument('--calls', action='store_true', help='list the cluster calls of each scenario')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--baseline', help='fail if round trips or connects exceed those of this results file')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed increase over the baseline')
+    parser.add_argument('--wall-tolerance', type=float, help='also compare wall time, allowing this increase')
+    args = parser.parse_args()
+
+    locks.ceph_cluster = _host_cluster
+    volume.schedule_pool_worker = _schedule_pool_worker
+    run_dir = tempfile.mkdtemp(prefix='rbdsr-bench-run-')
+    results = {}
+    print("size %d, %.2f ms per cluster call, peak memory %s" % (args.size, args.latency_ms,
+                                                               'of tracemalloc' if tracemalloc else 'RSS'))
+    print("%-16s %12s %10s %10s %10s" % ('scenario', 'round trips', 'connects', 'wall s', 'peak KiB'))
+    try:
+        for name, prepare, scenario in SCENARIOS:
+            if args.only and name not in args.only:
+                continue
+            results[name] = measure(prepare, scenario, args.size, args.latency_ms / 1000, run_dir)
+            print("%-16s %12d %10d %10.3f %10d" % ((name,) + tuple(results[name][metric] for metric in METRICS)))
+            if args.calls:
+                for call, count in sorted(rados.STATS.items(), key=lambda item: (-item[1], item[0])):
+                    print("%28s %12d" % (call, count))
+    finally:
+        rbd_utils.CONNECTIONS.shutdown_all()
+        shutil.rmtree(run_dir)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'size': args.size, 'latency_ms': args.latency_ms, 'results': results}, f,
+                      indent=2, separators=(',', ': '), sort_keys=True)
+            f.write('\n')
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if (baseline['size'], baseline['latency_ms']) != (args.size, args.latency_ms):
+            print("Baseline was taken with size %s and %s ms latency" % (baseline['size'], baseline['latency_ms']))
+            return 2
+        lines = regressions(results, baseline['results'], args.tolerance, args.wall_tolerance)
+        for line in lines:
+            print("REGRESSION %s" % line)
+        return 1 if lines else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""Cost of the plugin's debug logging and latency histograms per cluster operation
+
+Runs a burst of rbd_utils calls against the in-memory fake cluster with debug messages written to a
+log file, as syslog receives them on a host, then with LOG_DEBUG off, which skips formatting them
+and asking the cluster for its fsid. The fake cluster answers in microseconds, so what's left is the
+plugin's own overhead per call; the part of it spent timing the call into the histograms is shown
+on its own. Finally the histograms are flushed to a scratch METRICS_DIR and the start of the
+Prometheus file is printed.
+
+    python benchmarks/bench_trace.py [operations]
+"""
+
+from __future__ import division
+
+import logging
+import os
+import shutil
+import sys
+import tempfile
+
+from time import time
+
+import benchenv
+benchenv.setup()
+
+import rados
+
+from xapi.storage import log
+from xapi.storage.libs.xcpng.librbd import rbd_utils, trace
+
+CLUSTER = 'ceph'
+POOL = 'RBD_XenStorage-bench'
+
+
+def burst(cluster, operations):
+    start = time()
+    for n in range(operations):
+        name = "vdi-%s" % n
+        rbd_utils.rbd_create('bench', cluster, POOL, name, 1 << 30)
+        rbd_utils.rbd_utilization('bench', cluster, POOL, name)
+        rbd_utils.rbd_remove('bench', cluster, POOL, name)
+    return (time() - start) / (operations * 3)
+
+
+def observe_cost(operations):
+    histograms = trace.Histograms()
+    start = time()
+    for n in range(operations):
+        histograms.observe('rbd_create', 'ok', 0.004)
+    return (time() - start) / operations
+
+
+def main():
+    operations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+    scratch = tempfile.mkdtemp(prefix='rbdsr-bench-trace-')
+    logger = logging.getLogger('rbdsr-bench')
+    logger.addHandler(logging.FileHandler(os.path.join(scratch, 'SMlog')))
+    logger.setLevel(logging.DEBUG)
+    log.debug = logger.debug
+
+    rados.reset()
+    cluster = rbd_utils.ceph_cluster('bench', CLUSTER)
+    cluster.connect()
+    try:
+        cluster.create_pool(POOL)
+        print("%d operations x 3 calls" % operations)
+        print("%-28s %12s" % ('', 'us per call'))
+        for label, log_debug in (('LOG_DEBUG=yes', True), ('LOG_DEBUG=no', False)):
+            trace.LOG_DEBUG = log_debug
+            burst(cluster, 100)
+            print("%-28s %12.1f" % (label, burst(cluster, operations) * 1e6))
+        print("%-28s %12.1f" % ('of which histogram update', observe_cost(operations * 3) * 1e6))
+    finally:
+        cluster.shutdown()
+
+    try:
+        trace.METRICS.flush('bench', scratch)
+        with open(os.path.join(scratch, trace.PROMETHEUS_FILE)) as f:
+            print('')
+            print(''.join(f.readlines()[:6]).rstrip())
+    finally:
+        shutil.rmtree(scratch)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+"""Import-path setup shared by the benchmarks
+
+Puts the in-memory fake rados/rbd modules in front of the real bindings and makes
+xapi.storage.libs.xcpng.librbd resolve to this working tree, while the rest of xapi.storage
+(log, xcpng-storage-libs) comes from the installed packages.
+"""
+
+import os
+import sys
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+LIBRBD_PARENT_DIR = os.path.join(os.path.dirname(BENCH_DIR), 'src', 'xapi', 'storage', 'libs', 'xcpng')
+
+
+def setup(clusters=('ceph',)):
+    """Also points rbd_utils at a scratch config dir holding an empty <name>.conf per fake cluster"""
+    sys.path.insert(0, os.path.join(BENCH_DIR, 'fakeceph'))
+    import xapi.storage.libs.xcpng
+    xapi.storage.libs.xcpng.__path__.insert(0, LIBRBD_PARENT_DIR)
+
+    from xapi.storage.libs.xcpng.librbd import rbd_utils
+    rbd_utils.CEPH_CONF_DIR = tempfile.mkdtemp(prefix='rbdsr-bench-')
+    for cluster in clusters:
+        open(os.path.join(rbd_utils.CEPH_CONF_DIR, "%s.conf" % cluster), 'w').close()
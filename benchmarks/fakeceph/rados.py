@@ -0,0 +1,387 @@
+#!/usr/bin/env python
+"""In-memory stand-in for the python-rados binding
+
+Only the calls made by the librbd plugin are implemented. All Rados handles of the process share one
+set of clusters, so data written through one connection is visible through another, as it would be on
+a real cluster. Every call is counted in STATS so benchmarks can report round trips and connects.
+Setting LATENCY makes every counted call sleep that many seconds, as a network round trip would.
+A cluster named in UNREACHABLE hangs every connect for that many seconds and then times out.
+Object versions are those of a placement group, as RADOS user versions are: a write to any object of
+the PG, RBD data included, moves the version of every other object in it.
+"""
+
+import errno
+import json
+import threading
+import zlib
+
+from time import sleep
+
+from collections import defaultdict
+
+STATS = defaultdict(int)
+LATENCY = 0
+UNREACHABLE = {}  # cluster name -> seconds a connect hangs before it times out
+PG_NUM = 8  # placement groups of a pool
+LIBRADOS_CMPXATTR_OP_EQ = 1
+LIBRADOS_CREATE_EXCLUSIVE = 1
+ECANCELED = getattr(errno, 'ECANCELED', 125)  # missing from Python 2's errno
+CLUSTER_SIZE = 1 << 40
+CLUSTERS = {}
+_lock = threading.RLock()
+
+
+def reset():
+    with _lock:
+        STATS.clear()
+        CLUSTERS.clear()
+
+
+def count(name):
+    with _lock:
+        STATS[name] += 1
+    if LATENCY:
+        sleep(LATENCY)
+
+
+class Error(Exception):
+    pass
+
+
+class ObjectNotFound(Error):
+    pass
+
+
+class ObjectExists(Error):
+    pass
+
+
+class PermissionError(Error):
+    pass
+
+
+class TimedOut(Error):
+    pass
+
+
+class OSError(Error):
+
+    def __init__(self, message, errno=None):
+        super(OSError, self).__init__(message)
+        self.errno = errno
+
+
+class ConnectionShutdown(Error):
+    pass
+
+
+class _Cluster(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.fsid = "00000000-0000-0000-0000-%012d" % len(CLUSTERS)
+        self.pools = {}
+
+
+class _Pool(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.objects = {}
+        self.omaps = {}
+        self.pg_versions = [0] * PG_NUM
+        self.watchers = {}
+        self.images = {}
+        self.trash = {}
+        self.quota_max_bytes = 0
+
+    def _pg(self, oid):
+        return (zlib.crc32(oid.encode()) & 0xffffffff) % len(self.pg_versions)
+
+    def version(self, oid):
+        return self.pg_versions[self._pg(oid)]
+
+    def bump(self, oid):
+        """Counts a write to oid, returns the new version of its PG"""
+        pg = self._pg(oid)
+        self.pg_versions[pg] += 1
+        return self.pg_versions[pg]
+
+    def used(self):
+        return sum(len(data) for data in self.objects.values()) + \
+            sum(len(data) for image in self.images.values() for data in image.objects.values())
+
+
+class WriteOpCtx(object):
+
+    def __init__(self, *args):
+        self.ops = []
+        self.cmps = []
+        self.create = None
+
+    def new(self, exclusive=None):
+        self.create = exclusive
+
+    def omap_cmp(self, key, val, cmp_op=LIBRADOS_CMPXATTR_OP_EQ):
+        self.cmps.append((key, val, cmp_op))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        return False
+
+
+class ReadOpCtx(object):
+
+    def __init__(self, *args):
+        self.ops = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        return False
+
+
+class _OmapIter(object):
+
+    def __init__(self):
+        self.items = []
+
+    def __iter__(self):
+        return iter(self.items)
+
+
+class Watch(object):
+
+    def __init__(self, ioctx, oid, callback):
+        self.ioctx = ioctx
+        self.oid = oid
+        self.callback = callback
+
+    def close(self):
+        with _lock:
+            watchers = self.ioctx.pool.watchers.get(self.oid, [])
+            if self in watchers:
+                watchers.remove(self)
+
+
+def _cluster_for(conffile):
+    name = conffile.split('/')[-1].rsplit('.', 1)[0] if conffile else 'ceph'
+    with _lock:
+        if name not in CLUSTERS:
+            CLUSTERS[name] = _Cluster(name)
+        return CLUSTERS[name]
+
+
+class Rados(object):
+
+    def __init__(self, conffile=None, conf=None, name=None, rados_id=None, clustername=None):
+        self.conffile = conffile
+        self.state = 'configuring'
+        self._cluster = _cluster_for(conffile)
+
+    def _require_connected(self):
+        if self.state != 'connected':
+            raise ConnectionShutdown("Rados handle is not connected")
+
+    def connect(self, timeout=0):
+        count('connect')
+        if self._cluster.name in UNREACHABLE:
+            sleep(UNREACHABLE[self._cluster.name])
+            raise TimedOut("cluster %s didn't answer" % self._cluster.name)
+        self.state = 'connected'
+
+    def shutdown(self):
+        if self.state == 'connected':
+            count('shutdown')
+        self.state = 'shutdown'
+
+    def get_instance_id(self):
+        return id(self)
+
+    def get_fsid(self):
+        self._require_connected()
+        return self._cluster.fsid
+
+    def list_pools(self):
+        self._require_connected()
+        count('list_pools')
+        return list(self._cluster.pools.keys())
+
+    def pool_exists(self, pool_name):
+        self._require_connected()
+        count('pool_exists')
+        return pool_name in self._cluster.pools
+
+    def create_pool(self, pool_name, *args, **kwargs):
+        self._require_connected()
+        count('create_pool')
+        with _lock:
+            if pool_name in self._cluster.pools:
+                raise ObjectExists(pool_name)
+            self._cluster.pools[pool_name] = _Pool(pool_name)
+
+    def delete_pool(self, pool_name):
+        self._require_connected()
+        count('delete_pool')
+        with _lock:
+            self._cluster.pools.pop(pool_name, None)
+
+    def get_cluster_stats(self):
+        self._require_connected()
+        count('get_cluster_stats')
+        used = 0
+        for pool in self._cluster.pools.values():
+            used += sum(len(data) for data in pool.objects.values())
+        return {'kb': 1 << 30, 'kb_used': used >> 10, 'kb_avail': (1 << 30) - (used >> 10), 'num_objects': 0}
+
+    def mon_command(self, cmd, inbuf, timeout=0, target=None):
+        """Answers the `df` and `osd pool ls detail` JSON commands"""
+        self._require_connected()
+        count('mon_command')
+        command = json.loads(cmd)
+        with _lock:
+            pools = list(self._cluster.pools.values())
+            avail = CLUSTER_SIZE - sum(pool.used() for pool in pools)
+            if command['prefix'] == 'df':
+                out = {'pools': [{'name': pool.name, 'stats': {'stored': pool.used(), 'max_avail': avail}}
+                                 for pool in pools]}
+            elif command['prefix'] == 'osd pool ls':
+                out = [{'pool_name': pool.name, 'quota_max_bytes': pool.quota_max_bytes} for pool in pools]
+            else:
+                return -22, b'', "unknown command %s" % command['prefix']
+        return 0, json.dumps(out).encode(), ''
+
+    def open_ioctx(self, pool_name):
+        self._require_connected()
+        count('open_ioctx')
+        if pool_name not in self._cluster.pools:
+            raise ObjectNotFound("pool %s doesn't exist" % pool_name)
+        return Ioctx(self, self._cluster.pools[pool_name])
+
+
+class Ioctx(object):
+
+    def __init__(self, rados, pool):
+        self.rados = rados
+        self.pool = pool
+        self.state = 'open'
+        self.last_version = 0
+
+    def _require_open(self):
+        if self.state != 'open':
+            raise Error("Ioctx is closed")
+
+    def close(self):
+        if self.state == 'open':
+            count('ioctx_close')
+        self.state = 'closed'
+
+    def get_pool_name(self):
+        return self.pool.name
+
+    def get_last_version(self):
+        return self.last_version
+
+    def _bump(self, key):
+        self.last_version = self.pool.bump(key)
+
+    def write_full(self, key, data):
+        self._require_open()
+        count('write_full')
+        with _lock:
+            self.pool.objects[key] = data
+            self._bump(key)
+
+    def read(self, key, length=8192, offset=0):
+        self._require_open()
+        count('read')
+        if key not in self.pool.objects:
+            raise ObjectNotFound(key)
+        return self.pool.objects[key][offset:offset + length]
+
+    def remove_object(self, key):
+        self._require_open()
+        count('remove_object')
+        with _lock:
+            if key not in self.pool.objects:
+                raise ObjectNotFound(key)
+            del self.pool.objects[key]
+            self.pool.omaps.pop(key, None)
+        return True
+
+    def set_omap(self, write_op, keys, values):
+        write_op.ops.append(('set', list(zip(keys, values))))
+
+    def remove_omap_keys(self, write_op, keys):
+        write_op.ops.append(('remove', list(keys)))
+
+    def operate_write_op(self, write_op, oid, mtime=0, flags=0):
+        self._require_open()
+        count('operate_write_op')
+        with _lock:
+            if write_op.create == LIBRADOS_CREATE_EXCLUSIVE and oid in self.pool.objects:
+                raise ObjectExists(oid)
+            for key, val, cmp_op in write_op.cmps:
+                if cmp_op != LIBRADOS_CMPXATTR_OP_EQ or self.pool.omaps.get(oid, {}).get(key) != val:
+                    raise OSError("Failed to operate write op for oid %s" % oid, errno=ECANCELED)
+            omap = self.pool.omaps.setdefault(oid, {})
+            self.pool.objects.setdefault(oid, b'')
+            for op, args in write_op.ops:
+                if op == 'set':
+                    for key, value in args:
+                        STATS['omap_bytes_written'] += len(key) + len(value)
+                        omap[key] = value
+                else:
+                    for key in args:
+                        omap.pop(key, None)
+            self._bump(oid)
+
+    def get_omap_vals(self, read_op, start_after, filter_prefix, max_return):
+        it = _OmapIter()
+        read_op.ops.append(('vals', (start_after, filter_prefix, max_return), it))
+        return it, 0
+
+    def get_omap_vals_by_keys(self, read_op, keys):
+        it = _OmapIter()
+        read_op.ops.append(('keys', tuple(keys), it))
+        return it, 0
+
+    def operate_read_op(self, read_op, oid, flag=0):
+        self._require_open()
+        count('operate_read_op')
+        with _lock:
+            if oid not in self.pool.objects:
+                raise ObjectNotFound(oid)
+            omap = self.pool.omaps.get(oid, {})
+            self.last_version = self.pool.version(oid)
+            for op, args, it in read_op.ops:
+                if op == 'vals':
+                    start_after, filter_prefix, max_return = args
+                    keys = [key for key in sorted(omap) if key > start_after and key.startswith(filter_prefix)]
+                    it.items = [(key, omap[key]) for key in keys[:max_return]]
+                else:
+                    it.items = [(key, omap[key]) for key in args if key in omap]
+                for key, value in it.items:
+                    STATS['omap_bytes_read'] += len(key) + len(value)
+
+    def watch(self, obj, callback, error_callback=None, timeout=None):
+        self._require_open()
+        count('watch')
+        with _lock:
+            if obj not in self.pool.objects:
+                raise ObjectNotFound(obj)
+            watch = Watch(self, obj, callback)
+            self.pool.watchers.setdefault(obj, []).append(watch)
+        return watch
+
+    def notify(self, obj, msg='', timeout_ms=5000):
+        self._require_open()
+        count('notify')
+        with _lock:
+            watchers = list(self.pool.watchers.get(obj, []))
+        for n, watch in enumerate(watchers):
+            watch.callback(n, 0, id(watch), msg)
+        return True
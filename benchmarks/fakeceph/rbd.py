@@ -0,0 +1,547 @@
+#!/usr/bin/env python
+"""In-memory stand-in for the python-rbd binding
+
+Images live in the pools of the fake rados module. Data is kept sparsely per object, so thousands of
+large thin images cost almost nothing.
+"""
+
+import threading
+
+from rados import count, _lock
+
+RBD_FEATURE_LAYERING = 1
+RBD_FEATURE_STRIPINGV2 = 2
+RBD_FEATURE_EXCLUSIVE_LOCK = 4
+RBD_FEATURE_OBJECT_MAP = 8
+RBD_FEATURE_FAST_DIFF = 16
+RBD_FEATURE_DEEP_FLATTEN = 32
+
+RBD_FLAG_OBJECT_MAP_INVALID = 1
+RBD_FLAG_FAST_DIFF_INVALID = 2
+
+RBD_TRASH_IMAGE_SOURCE_USER = 0
+
+RBD_LOCK_MODE_EXCLUSIVE = 0
+RBD_LOCK_MODE_SHARED = 1
+
+
+class Error(Exception):
+    pass
+
+
+class ImageNotFound(Error):
+    pass
+
+
+class ImageExists(Error):
+    pass
+
+
+class ImageBusy(Error):
+    pass
+
+
+class ImageHasSnapshots(Error):
+    pass
+
+
+class InvalidArgument(Error):
+    pass
+
+
+_ids = [0]
+
+
+class _ImageData(object):
+
+    def __init__(self, name, size, order, features):
+        _ids[0] += 1
+        self.id = "%012x" % _ids[0]
+        self.name = name
+        self.size = size
+        self.order = order
+        self.features = features
+        self.objects = {}
+        self.snaps = []
+        self.snap_objects = {}  # snapshot name -> {obj_no: data}, sharing the data with the head
+        self.protected = set()
+        self.lockers = {}
+        self.lock_exclusive = False
+        self.lock_tag = ''
+        self.metadata = {}
+        self.watchers = {}  # id of the open Image -> instance id of its Rados handle
+        self.lock_owner = None  # (id of the open Image, client) holding the exclusive-lock feature's lock
+        self.parent = None
+        self.stripe_unit = 1 << order
+        self.stripe_count = 1
+        self.data_pool = None
+
+
+def _set_layout(image, stripe_unit, stripe_count, data_pool):
+    if stripe_unit or stripe_count:
+        # librbd wants both set, and a stripe unit that divides the object size
+        if not image.features & RBD_FEATURE_STRIPINGV2 or not stripe_unit or not stripe_count or \
+                (1 << image.order) % stripe_unit:
+            raise InvalidArgument("invalid striping %s/%s" % (stripe_unit, stripe_count))
+        image.stripe_unit = stripe_unit
+        image.stripe_count = stripe_count
+    image.data_pool = data_pool
+
+
+def _delete_objects(image):
+    # Every data object is a delete round trip, this is what makes removing a big image slow
+    for obj_no in list(image.objects):
+        count('object_remove')
+
+
+class RBD(object):
+
+    def create(self, ioctx, name, size, order=None, old_format=False, features=None, stripe_unit=None,
+               stripe_count=None, data_pool=None):
+        ioctx._require_open()
+        count('rbd_create')
+        with _lock:
+            if name in ioctx.pool.images:
+                raise ImageExists(name)
+            image = _ImageData(name, size, order or 22, features or RBD_FEATURE_LAYERING)
+            _set_layout(image, stripe_unit, stripe_count, data_pool)
+            ioctx.pool.images[name] = image
+            ioctx.pool.objects["rbd_id.%s" % name] = b''
+
+    def remove(self, ioctx, name, *args, **kwargs):
+        ioctx._require_open()
+        count('rbd_remove')
+        with _lock:
+            if name not in ioctx.pool.images:
+                raise ImageNotFound(name)
+            image = ioctx.pool.images[name]
+            if image.snaps:
+                raise ImageHasSnapshots(name)
+            if image.lockers or image.watchers:
+                raise ImageBusy(name)
+            del ioctx.pool.images[name]
+            ioctx.pool.objects.pop("rbd_id.%s" % name, None)
+        _delete_objects(image)
+
+    def trash_move(self, ioctx, name, delay=0):
+        ioctx._require_open()
+        count('trash_move')
+        with _lock:
+            if name not in ioctx.pool.images:
+                raise ImageNotFound(name)
+            image = ioctx.pool.images[name]
+            if image.snaps:
+                raise ImageHasSnapshots(name)
+            if image.lockers or image.watchers:
+                raise ImageBusy(name)
+            del ioctx.pool.images[name]
+            ioctx.pool.objects.pop("rbd_id.%s" % name, None)
+            ioctx.pool.trash[image.id] = image
+
+    def trash_list(self, ioctx):
+        ioctx._require_open()
+        count('trash_list')
+        return [{'id': image.id, 'name': image.name, 'source': RBD_TRASH_IMAGE_SOURCE_USER}
+                for image in list(ioctx.pool.trash.values())]
+
+    def trash_remove(self, ioctx, image_id, force=False):
+        ioctx._require_open()
+        count('trash_remove')
+        with _lock:
+            if image_id not in ioctx.pool.trash:
+                raise ImageNotFound(image_id)
+            image = ioctx.pool.trash.pop(image_id)
+        _delete_objects(image)
+
+    def list(self, ioctx):
+        ioctx._require_open()
+        count('rbd_list')
+        return list(ioctx.pool.images.keys())
+
+    def rename(self, ioctx, src, dest):
+        ioctx._require_open()
+        count('rbd_rename')
+        with _lock:
+            if src not in ioctx.pool.images:
+                raise ImageNotFound(src)
+            if dest in ioctx.pool.images:
+                raise ImageExists(dest)
+            image = ioctx.pool.images.pop(src)
+            image.name = dest
+            ioctx.pool.images[dest] = image
+            ioctx.pool.objects["rbd_id.%s" % dest] = ioctx.pool.objects.pop("rbd_id.%s" % src, b'')
+
+    def clone(self, p_ioctx, p_name, p_snapname, c_ioctx, c_name, features=None, order=None, stripe_unit=None,
+              stripe_count=None, data_pool=None):
+        count('rbd_clone')
+        with _lock:
+            if p_name not in p_ioctx.pool.images:
+                raise ImageNotFound(p_name)
+            parent = p_ioctx.pool.images[p_name]
+            if p_snapname not in parent.protected:
+                raise InvalidArgument("snapshot %s is not protected" % p_snapname)
+            if c_name in c_ioctx.pool.images:
+                raise ImageExists(c_name)
+            child = _ImageData(c_name, parent.size, order or parent.order, features or parent.features)
+            _set_layout(child, stripe_unit, stripe_count, data_pool)
+            child.parent = (p_ioctx.pool.name, p_name, p_snapname)
+            child.metadata = dict(parent.metadata)  # librbd copies the parent's image metadata
+            c_ioctx.pool.images[c_name] = child
+            c_ioctx.pool.objects["rbd_id.%s" % c_name] = b''
+
+
+class Image(object):
+
+    def __init__(self, ioctx, name, snapshot=None, read_only=False):
+        ioctx._require_open()
+        count('image_open')
+        with _lock:
+            if name not in ioctx.pool.images:
+                raise ImageNotFound(name)
+            self._data = ioctx.pool.images[name]
+            if snapshot is not None and snapshot not in self._data.snaps:
+                raise ImageNotFound("%s@%s" % (name, snapshot))
+        self.ioctx = ioctx
+        self.name = name
+        self.snapshot = snapshot
+        self.closed = False
+        self._client = "client.%d" % id(ioctx.rados)
+        if snapshot is None and not read_only:
+            # Like librbd, only a read-write open of the head watches the header
+            with _lock:
+                self._data.watchers[id(self)] = ioctx.rados.get_instance_id()
+
+    def _require_open(self):
+        if self.closed:
+            raise Error("Image %s is closed" % self.name)
+
+    def close(self):
+        if not self.closed:
+            count('image_close')
+            with _lock:
+                self._data.watchers.pop(id(self), None)
+                if self._data.lock_owner is not None and self._data.lock_owner[0] == id(self):
+                    self._data.lock_owner = None
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        self.close()
+        return False
+
+    def id(self):
+        return self._data.id
+
+    def size(self):
+        self._require_open()
+        count('image_size')
+        return self._data.size
+
+    def stat(self):
+        self._require_open()
+        count('image_stat')
+        obj_size = 1 << self._data.order
+        return {'size': self._data.size,
+                'obj_size': obj_size,
+                'num_objs': (self._data.size + obj_size - 1) // obj_size,
+                'order': self._data.order,
+                'block_name_prefix': "rbd_data.%s" % self._data.id,
+                'parent_pool': -1,
+                'parent_name': ''}
+
+    def features(self):
+        return self._data.features
+
+    def watchers_list(self):
+        self._require_open()
+        count('watchers_list')
+        with _lock:
+            return [{'addr': "127.0.0.1:0/%d" % instance_id, 'id': instance_id, 'cookie': cookie}
+                    for cookie, instance_id in sorted(self._data.watchers.items())]
+
+    def lock_get_owners(self):
+        self._require_open()
+        count('lock_get_owners')
+        with _lock:
+            if self._data.lock_owner is None:
+                return []
+            return [{'mode': RBD_LOCK_MODE_EXCLUSIVE, 'owner': self._data.lock_owner[1]}]
+
+    def _acquire_lock(self):
+        # librbd takes the exclusive lock on the first write, asking the owner to hand it over
+        if self._data.features & RBD_FEATURE_EXCLUSIVE_LOCK:
+            self._data.lock_owner = (id(self), self._client)
+
+    def metadata_list(self):
+        self._require_open()
+        count('metadata_list')
+        with _lock:
+            return sorted(self._data.metadata.items())
+
+    def metadata_get(self, key):
+        self._require_open()
+        count('metadata_get')
+        with _lock:
+            if key not in self._data.metadata:
+                raise KeyError(key)
+            return self._data.metadata[key]
+
+    def metadata_set(self, key, value):
+        self._require_open()
+        count('metadata_set')
+        with _lock:
+            self._data.metadata[key] = value
+            self.ioctx.pool.bump("rbd_header.%s" % self._data.id)
+
+    def metadata_remove(self, key):
+        self._require_open()
+        count('metadata_remove')
+        with _lock:
+            if key not in self._data.metadata:
+                raise KeyError(key)
+            del self._data.metadata[key]
+            self.ioctx.pool.bump("rbd_header.%s" % self._data.id)
+
+    def stripe_unit(self):
+        return self._data.stripe_unit
+
+    def stripe_count(self):
+        return self._data.stripe_count
+
+    def flags(self):
+        return 0
+
+    def _objects(self):
+        if self.snapshot is None:
+            return self._data.objects
+        return self._data.snap_objects[self.snapshot]
+
+    def _own_object(self, obj_no):
+        """Returns the head's object for writing, copied first if a snapshot shares it"""
+        obj = self._data.objects.get(obj_no)
+        if obj is None or any(objects.get(obj_no) is obj for objects in self._data.snap_objects.values()):
+            obj = self._data.objects[obj_no] = bytearray(obj or b'')
+        return obj
+
+    def diff_iterate(self, offset, length, from_snapshot, iterate_cb, include_parent=True, whole_object=False):
+        """Reports the objects of the range that hold data, or that changed since from_snapshot
+
+        With fast-diff the object map answers in one round trip, otherwise every object of the range is
+        probed, which is what makes a full scan of a big image slow on a real cluster.
+        """
+        self._require_open()
+        obj_size = 1 << self._data.order
+        first, last = offset // obj_size, (offset + length - 1) // obj_size
+        if self._data.features & RBD_FEATURE_FAST_DIFF:
+            count('diff_iterate_object_map')
+        else:
+            for obj_no in range(first, last + 1):
+                count('object_stat')
+        current = self._objects()
+        objects = set(current)
+        if include_parent and from_snapshot is None:
+            parent = self._parent()
+            while parent is not None:
+                objects.update(parent.objects)
+                parent = self._parent(parent)
+        if from_snapshot is not None:
+            since = self._data.snap_objects[from_snapshot]
+            objects = set(obj_no for obj_no in objects | set(since) if current.get(obj_no) is not since.get(obj_no))
+        for obj_no in sorted(objects):
+            if first <= obj_no <= last:
+                start = max(offset, obj_no * obj_size)
+                end = min(offset + length, (obj_no + 1) * obj_size)
+                iterate_cb(start, end - start, obj_no in current or from_snapshot is None)
+
+    def resize(self, size):
+        self._require_open()
+        count('image_resize')
+        with _lock:
+            self._data.size = size
+
+    def read(self, offset, length):
+        self._require_open()
+        count('image_read')
+        obj_size = 1 << self._data.order
+        out = bytearray(length)
+        pos = offset
+        while pos < offset + length:
+            obj_no, obj_off = divmod(pos, obj_size)
+            chunk = min(obj_size - obj_off, offset + length - pos)
+            data = self._objects().get(obj_no)
+            if data is not None:
+                # Objects only grow as far as they were written, the rest reads as zeros
+                piece = data[obj_off:obj_off + chunk]
+                out[pos - offset:pos - offset + len(piece)] = piece
+            pos += chunk
+        return bytes(out)
+
+    def write(self, data, offset):
+        self._require_open()
+        count('image_write')
+        obj_size = 1 << self._data.order
+        pos = 0
+        with _lock:
+            self._acquire_lock()
+            while pos < len(data):
+                obj_no, obj_off = divmod(offset + pos, obj_size)
+                chunk = min(obj_size - obj_off, len(data) - pos)
+                obj = self._own_object(obj_no)
+                if len(obj) < obj_off + chunk:
+                    obj.extend(bytearray(obj_off + chunk - len(obj)))
+                obj[obj_off:obj_off + chunk] = data[pos:pos + chunk]
+                self.ioctx.pool.bump("rbd_data.%s.%016x" % (self._data.id, obj_no))
+                pos += chunk
+        return len(data)
+
+    def discard(self, offset, length):
+        self._require_open()
+        count('image_discard')
+        obj_size = 1 << self._data.order
+        pos = offset
+        with _lock:
+            self._acquire_lock()
+            while pos < offset + length:
+                obj_no, obj_off = divmod(pos, obj_size)
+                chunk = min(obj_size - obj_off, offset + length - pos)
+                if obj_no in self._data.objects:
+                    if chunk == obj_size:
+                        del self._data.objects[obj_no]
+                    else:
+                        obj = self._own_object(obj_no)
+                        end = min(len(obj), obj_off + chunk)
+                        obj[obj_off:end] = bytearray(max(0, end - obj_off))
+                    self.ioctx.pool.bump("rbd_data.%s.%016x" % (self._data.id, obj_no))
+                pos += chunk
+
+    def lock_exclusive(self, cookie):
+        self._require_open()
+        count('lock_exclusive')
+        with _lock:
+            if self._data.lockers:
+                if (self._client, cookie) in self._data.lockers:
+                    raise ImageExists(self.name)
+                raise ImageBusy(self.name)
+            self._data.lockers[(self._client, cookie)] = '127.0.0.1:0/0'
+            self._data.lock_exclusive = True
+
+    def lock_shared(self, cookie, tag):
+        self._require_open()
+        count('lock_shared')
+        with _lock:
+            if self._data.lockers and (self._data.lock_exclusive or self._data.lock_tag != tag):
+                raise ImageBusy(self.name)
+            if (self._client, cookie) in self._data.lockers:
+                raise ImageExists(self.name)
+            self._data.lockers[(self._client, cookie)] = '127.0.0.1:0/0'
+            self._data.lock_exclusive = False
+            self._data.lock_tag = tag
+
+    def unlock(self, cookie):
+        self._require_open()
+        count('unlock')
+        with _lock:
+            if (self._client, cookie) not in self._data.lockers:
+                raise ImageNotFound(self.name)
+            del self._data.lockers[(self._client, cookie)]
+
+    def list_lockers(self):
+        self._require_open()
+        count('list_lockers')
+        if not self._data.lockers:
+            return []
+        return {'tag': self._data.lock_tag,
+                'exclusive': self._data.lock_exclusive,
+                'lockers': [(client, cookie, addr) for (client, cookie), addr in self._data.lockers.items()]}
+
+    def create_snap(self, name):
+        self._require_open()
+        count('create_snap')
+        with _lock:
+            if name in self._data.snaps:
+                raise ImageExists(name)
+            self._data.snaps.append(name)
+            self._data.snap_objects[name] = dict(self._data.objects)
+
+    def remove_snap(self, name):
+        self._require_open()
+        count('remove_snap')
+        with _lock:
+            if name in self._data.protected:
+                raise ImageBusy(name)
+            self._data.snaps.remove(name)
+            self._data.snap_objects.pop(name, None)
+
+    def protect_snap(self, name):
+        self._require_open()
+        count('protect_snap')
+        self._data.protected.add(name)
+
+    def unprotect_snap(self, name):
+        self._require_open()
+        count('unprotect_snap')
+        with _lock:
+            if any(image.parent == (self.ioctx.pool.name, self.name, name)
+                   for pool in self.ioctx.rados._cluster.pools.values()
+                   for image in list(pool.images.values()) + list(pool.trash.values())):
+                raise ImageBusy("snapshot %s has clones" % name)
+        self._data.protected.discard(name)
+
+    def is_protected_snap(self, name):
+        self._require_open()
+        count('is_protected_snap')
+        return name in self._data.protected
+
+    def list_snaps(self):
+        self._require_open()
+        count('list_snaps')
+        return [{'id': n, 'name': name, 'size': self._data.size} for n, name in enumerate(self._data.snaps)]
+
+    def _parent(self, data=None):
+        data = data or self._data
+        if data.parent is None:
+            return None
+        pool, name, snapshot = data.parent
+        return self.ioctx.rados._cluster.pools[pool].images[name]
+
+    def list_children(self):
+        self._require_open()
+        count('list_children')
+        with _lock:
+            return [(pool.name, image.name) for pool in self.ioctx.rados._cluster.pools.values()
+                    for image in pool.images.values()
+                    if image.parent == (self.ioctx.pool.name, self.name, self.snapshot)]
+
+    def flatten(self, on_progress=None):
+        """Copies up the parent's objects the clone doesn't have, reporting each one to on_progress"""
+        self._require_open()
+        count('flatten')
+        parent = self._parent()
+        if parent is None:
+            raise InvalidArgument("%s has no parent" % self.name)
+        chain = []
+        while parent is not None:
+            chain.append(parent)
+            parent = self._parent(parent)
+        total = (self._data.size + (1 << self._data.order) - 1) >> self._data.order
+        for obj_no in range(total):
+            if obj_no not in self._data.objects:
+                for ancestor in chain:
+                    if obj_no in ancestor.objects:
+                        count('flatten_copyup')
+                        with _lock:
+                            self._data.objects[obj_no] = bytearray(ancestor.objects[obj_no])
+                        break
+            if on_progress is not None:
+                on_progress(obj_no + 1, total)
+        with _lock:
+            self._data.parent = None
+
+    def parent_info(self):
+        self._require_open()
+        count('parent_info')
+        if self._data.parent is None:
+            raise ImageNotFound("%s has no parent" % self.name)
+        return self._data.parent
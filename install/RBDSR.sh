@@ -118,6 +118,18 @@ function downgradeDeps {
     yum history undo -q -y `yum history packages-list glibc | head -4 | tail -1 | awk -F\| '{gsub(/ /, "", $0); print $1}'`
 }
 
+# Usage: attachedVDIs
+# Prints the number of NBD and kernel RBD devices on this host serving a VDI
+function attachedVDIs {
+    count=0
+    for device in /sys/block/nbd*/pid /sys/bus/rbd/devices/*; do
+        if [ -e "${device}" ]; then
+            count=$((count + 1))
+        fi
+    done
+    echo ${count}
+}
+
 function installFiles {
     echo "Install RBDSR Files"
     rm -rf /usr/libexec/xapi-storage-script/volume/org.xen.xapi.storage.rbdsr
@@ -128,62 +140,98 @@ function installFiles {
     ln -s /lib/python2.7/site-packages/xapi/storage/libs/xcpng/scripts/plugin.py /usr/libexec/xapi-storage-script/volume/org.xen.xapi.storage.rbdsr/plugin.py
     ln -s /lib/python2.7/site-packages/xapi/storage/libs/xcpng/scripts/sr.py /usr/libexec/xapi-storage-script/volume/org.xen.xapi.storage.rbdsr/sr.py
     ln -s /lib/python2.7/site-packages/xapi/storage/libs/xcpng/scripts/volume.py /usr/libexec/xapi-storage-script/volume/org.xen.xapi.storage.rbdsr/volume.py
+    ln -s /lib/python2.7/site-packages/xapi/storage/libs/xcpng/librbd/client.py /usr/libexec/xapi-storage-script/volume/org.xen.xapi.storage.rbdsr/client.py
+
+    ln -s client.py /usr/libexec/xapi-storage-script/volume/org.xen.xapi.storage.rbdsr/Plugin.diagnostics
+    ln -s client.py /usr/libexec/xapi-storage-script/volume/org.xen.xapi.storage.rbdsr/Plugin.Query
+    ln -s client.py /usr/libexec/xapi-storage-script/volume/org.xen.xapi.storage.rbdsr/SR.probe
+    ln -s client.py /usr/libexec/xapi-storage-script/volume/org.xen.xapi.storage.rbdsr/SR.attach
+    ln -s client.py /usr/libexec/xapi-storage-script/volume/org.xen.xapi.storage.rbdsr/SR.create
+    ln -s client.py /usr/libexec/xapi-storage-script/volume/org.xen.xapi.storage.rbdsr/SR.destroy
+    ln -s client.py /usr/libexec/xapi-storage-script/volume/org.xen.xapi.storage.rbdsr/SR.detach
+    ln -s client.py /usr/libexec/xapi-storage-script/volume/org.xen.xapi.storage.rbdsr/SR.ls
+    ln -s client.py /usr/libexec/xapi-storage-script/volume/org.xen.xapi.storage.rbdsr/SR.stat
+    ln -s client.py /usr/libexec/xapi-storage-script/volume/org.xen.xapi.storage.rbdsr/SR.set_description
+    ln -s client.py /usr/libexec/xapi-storage-script/volume/org.xen.xapi.storage.rbdsr/SR.set_name
+    ln -s client.py /usr/libexec/xapi-storage-script/volume/org.xen.xapi.storage.rbdsr/Volume.clone
+    ln -s client.py /usr/libexec/xapi-storage-script/volume/org.xen.xapi.storage.rbdsr/Volume.create
+    ln -s client.py /usr/libexec/xapi-storage-script/volume/org.xen.xapi.storage.rbdsr/Volume.destroy
+    ln -s client.py /usr/libexec/xapi-storage-script/volume/org.xen.xapi.storage.rbdsr/Volume.resize
+    ln -s client.py /usr/libexec/xapi-storage-script/volume/org.xen.xapi.storage.rbdsr/Volume.set
+    ln -s client.py /usr/libexec/xapi-storage-script/volume/org.xen.xapi.storage.rbdsr/Volume.set_description
+    ln -s client.py /usr/libexec/xapi-storage-script/volume/org.xen.xapi.storage.rbdsr/Volume.set_name
+    ln -s client.py /usr/libexec/xapi-storage-script/volume/org.xen.xapi.storage.rbdsr/Volume.snapshot
+    ln -s client.py /usr/libexec/xapi-storage-script/volume/org.xen.xapi.storage.rbdsr/Volume.stat
+    ln -s client.py /usr/libexec/xapi-storage-script/volume/org.xen.xapi.storage.rbdsr/Volume.unset
+
+    for datapath in rbd+qcow2+qdisk rbd+raw+krbd rbd+raw+rbdnbd; do
+        rm -rf /usr/libexec/xapi-storage-script/datapath/${datapath}
+        mkdir -p /usr/libexec/xapi-storage-script/datapath/${datapath}
 
-    ln -s plugin.py /usr/libexec/xapi-storage-script/volume/org.xen.xapi.storage.rbdsr/Plugin.diagnostics
-    ln -s plugin.py /usr/libexec/xapi-storage-script/volume/org.xen.xapi.storage.rbdsr/Plugin.Query
-    ln -s sr.py /usr/libexec/xapi-storage-script/volume/org.xen.xapi.storage.rbdsr/SR.probe
-    ln -s sr.py /usr/libexec/xapi-storage-script/volume/org.xen.xapi.storage.rbdsr/SR.attach
-    ln -s sr.py /usr/libexec/xapi-storage-script/volume/org.xen.xapi.storage.rbdsr/SR.create
-    ln -s sr.py /usr/libexec/xapi-storage-script/volume/org.xen.xapi.storage.rbdsr/SR.destroy
-    ln -s sr.py /usr/libexec/xapi-storage-script/volume/org.xen.xapi.storage.rbdsr/SR.detach
-    ln -s sr.py /usr/libexec/xapi-storage-script/volume/org.xen.xapi.storage.rbdsr/SR.ls
-    ln -s sr.py /usr/libexec/xapi-storage-script/volume/org.xen.xapi.storage.rbdsr/SR.stat
-    ln -s sr.py /usr/libexec/xapi-storage-script/volume/org.xen.xapi.storage.rbdsr/SR.set_description
-    ln -s sr.py /usr/libexec/xapi-storage-script/volume/org.xen.xapi.storage.rbdsr/SR.set_name
-    ln -s volume.py /usr/libexec/xapi-storage-script/volume/org.xen.xapi.storage.rbdsr/Volume.clone
-    ln -s volume.py /usr/libexec/xapi-storage-script/volume/org.xen.xapi.storage.rbdsr/Volume.create
-    ln -s volume.py /usr/libexec/xapi-storage-script/volume/org.xen.xapi.storage.rbdsr/Volume.destroy
-    ln -s volume.py /usr/libexec/xapi-storage-script/volume/org.xen.xapi.storage.rbdsr/Volume.resize
-    ln -s volume.py /usr/libexec/xapi-storage-script/volume/org.xen.xapi.storage.rbdsr/Volume.set
-    ln -s volume.py /usr/libexec/xapi-storage-script/volume/org.xen.xapi.storage.rbdsr/Volume.set_description
-    ln -s volume.py /usr/libexec/xapi-storage-script/volume/org.xen.xapi.storage.rbdsr/Volume.set_name
-    ln -s volume.py /usr/libexec/xapi-storage-script/volume/org.xen.xapi.storage.rbdsr/Volume.snapshot
-    ln -s volume.py /usr/libexec/xapi-storage-script/volume/org.xen.xapi.storage.rbdsr/Volume.stat
-    ln -s volume.py /usr/libexec/xapi-storage-script/volume/org.xen.xapi.storage.rbdsr/Volume.unset
-
-    rm -rf /usr/libexec/xapi-storage-script/datapath/rbd+qcow2+qdisk
-    mkdir -p /usr/libexec/xapi-storage-script/datapath/rbd+qcow2+qdisk
-
-    copyFile "src/datapath/rbd+qcow2+qdisk/plugin.json" "/usr/libexec/xapi-storage-script/datapath/rbd+qcow2+qdisk/plugin.json"
-
-    ln -s /lib/python2.7/site-packages/xapi/storage/libs/xcpng/scripts/plugin.py /usr/libexec/xapi-storage-script/datapath/rbd+qcow2+qdisk/plugin.py
-    ln -s /lib/python2.7/site-packages/xapi/storage/libs/xcpng/scripts/datapath.py /usr/libexec/xapi-storage-script/datapath/rbd+qcow2+qdisk/datapath.py
-    ln -s /lib/python2.7/site-packages/xapi/storage/libs/xcpng/scripts/data.py /usr/libexec/xapi-storage-script/datapath/rbd+qcow2+qdisk/data.py
-
-    ln -s datapath.py /usr/libexec/xapi-storage-script/datapath/rbd+qcow2+qdisk/Datapath.activate
-    ln -s datapath.py /usr/libexec/xapi-storage-script/datapath/rbd+qcow2+qdisk/Datapath.attach
-    ln -s datapath.py /usr/libexec/xapi-storage-script/datapath/rbd+qcow2+qdisk/Datapath.close
-    ln -s datapath.py /usr/libexec/xapi-storage-script/datapath/rbd+qcow2+qdisk/Datapath.deactivate
-    ln -s datapath.py /usr/libexec/xapi-storage-script/datapath/rbd+qcow2+qdisk/Datapath.detach
-    ln -s datapath.py /usr/libexec/xapi-storage-script/datapath/rbd+qcow2+qdisk/Datapath.open
-    ln -s plugin.py /usr/libexec/xapi-storage-script/datapath/rbd+qcow2+qdisk/Plugin.Query
+        copyFile "src/datapath/${datapath}/plugin.json" "/usr/libexec/xapi-storage-script/datapath/${datapath}/plugin.json"
+
+        ln -s /lib/python2.7/site-packages/xapi/storage/libs/xcpng/scripts/plugin.py /usr/libexec/xapi-storage-script/datapath/${datapath}/plugin.py
+        ln -s /lib/python2.7/site-packages/xapi/storage/libs/xcpng/scripts/datapath.py /usr/libexec/xapi-storage-script/datapath/${datapath}/datapath.py
+        ln -s /lib/python2.7/site-packages/xapi/storage/libs/xcpng/scripts/data.py /usr/libexec/xapi-storage-script/datapath/${datapath}/data.py
+        ln -s /lib/python2.7/site-packages/xapi/storage/libs/xcpng/librbd/client.py /usr/libexec/xapi-storage-script/datapath/${datapath}/client.py
+
+        ln -s client.py /usr/libexec/xapi-storage-script/datapath/${datapath}/Datapath.activate
+        ln -s client.py /usr/libexec/xapi-storage-script/datapath/${datapath}/Datapath.attach
+        ln -s client.py /usr/libexec/xapi-storage-script/datapath/${datapath}/Datapath.close
+        ln -s client.py /usr/libexec/xapi-storage-script/datapath/${datapath}/Datapath.deactivate
+        ln -s client.py /usr/libexec/xapi-storage-script/datapath/${datapath}/Datapath.detach
+        ln -s client.py /usr/libexec/xapi-storage-script/datapath/${datapath}/Datapath.open
+        ln -s client.py /usr/libexec/xapi-storage-script/datapath/${datapath}/Plugin.Query
+    done
 
     rm -rf /lib/python2.7/site-packages/xapi/storage/libs/xcpng/librbd
     mkdir /lib/python2.7/site-packages/xapi/storage/libs/xcpng/librbd
 
     copyFile "src/xapi/storage/libs/xcpng/librbd/__init__.py" "/lib/python2.7/site-packages/xapi/storage/libs/xcpng/librbd/__init__.py"
+    copyFile "src/xapi/storage/libs/xcpng/librbd/client.py" "/lib/python2.7/site-packages/xapi/storage/libs/xcpng/librbd/client.py"
+    copyFile "src/xapi/storage/libs/xcpng/librbd/daemon.py" "/lib/python2.7/site-packages/xapi/storage/libs/xcpng/librbd/daemon.py"
     copyFile "src/xapi/storage/libs/xcpng/librbd/datapath.py" "/lib/python2.7/site-packages/xapi/storage/libs/xcpng/librbd/datapath.py"
+    copyFile "src/xapi/storage/libs/xcpng/librbd/diffstream.py" "/lib/python2.7/site-packages/xapi/storage/libs/xcpng/librbd/diffstream.py"
+    copyFile "src/xapi/storage/libs/xcpng/librbd/flatten.py" "/lib/python2.7/site-packages/xapi/storage/libs/xcpng/librbd/flatten.py"
+    copyFile "src/xapi/storage/libs/xcpng/librbd/host.py" "/lib/python2.7/site-packages/xapi/storage/libs/xcpng/librbd/host.py"
+    copyFile "src/xapi/storage/libs/xcpng/librbd/layout.py" "/lib/python2.7/site-packages/xapi/storage/libs/xcpng/librbd/layout.py"
     copyFile "src/xapi/storage/libs/xcpng/librbd/locks.py" "/lib/python2.7/site-packages/xapi/storage/libs/xcpng/librbd/locks.py"
     copyFile "src/xapi/storage/libs/xcpng/librbd/meta.py" "/lib/python2.7/site-packages/xapi/storage/libs/xcpng/librbd/meta.py"
+    copyFile "src/xapi/storage/libs/xcpng/librbd/nbd_utils.py" "/lib/python2.7/site-packages/xapi/storage/libs/xcpng/librbd/nbd_utils.py"
+    copyFile "src/xapi/storage/libs/xcpng/librbd/pcache.py" "/lib/python2.7/site-packages/xapi/storage/libs/xcpng/librbd/pcache.py"
+    copyFile "src/xapi/storage/libs/xcpng/librbd/qos.py" "/lib/python2.7/site-packages/xapi/storage/libs/xcpng/librbd/qos.py"
     copyFile "src/xapi/storage/libs/xcpng/librbd/rbd_utils.py" "/lib/python2.7/site-packages/xapi/storage/libs/xcpng/librbd/rbd_utils.py"
     copyFile "src/xapi/storage/libs/xcpng/librbd/sr.py" "/lib/python2.7/site-packages/xapi/storage/libs/xcpng/librbd/sr.py"
+    copyFile "src/xapi/storage/libs/xcpng/librbd/stats.py" "/lib/python2.7/site-packages/xapi/storage/libs/xcpng/librbd/stats.py"
+    copyFile "src/xapi/storage/libs/xcpng/librbd/tuning.py" "/lib/python2.7/site-packages/xapi/storage/libs/xcpng/librbd/tuning.py"
+    copyFile "src/xapi/storage/libs/xcpng/librbd/trace.py" "/lib/python2.7/site-packages/xapi/storage/libs/xcpng/librbd/trace.py"
     copyFile "src/xapi/storage/libs/xcpng/librbd/volume.py" "/lib/python2.7/site-packages/xapi/storage/libs/xcpng/librbd/volume.py"
+
+    cp install/rbdsr-daemon.service /etc/systemd/system/rbdsr-daemon.service
+    systemctl daemon-reload
+    # A running daemon keeps the modules it imported, restart it to serve the new ones.
+    # Leave that to the admin while VDIs are attached, their datapath processes are its children
+    if [ "$(attachedVDIs)" -eq 0 ]; then
+        systemctl try-restart rbdsr-daemon
+    else
+        echo "VDIs are attached, run 'systemctl try-restart rbdsr-daemon' once they are detached"
+    fi
 }
 
 function removeFiles {
   echo "Removing RBDSR Files"
+  systemctl disable rbdsr-daemon
+  if [ "$(attachedVDIs)" -eq 0 ]; then
+      systemctl stop rbdsr-daemon
+  else
+      echo "VDIs are attached, rbdsr-daemon keeps running until they are detached and the host reboots"
+  fi
+  rm -f /etc/systemd/system/rbdsr-daemon.service
+  systemctl daemon-reload
   rm -rf /usr/libexec/xapi-storage-script/volume/org.xen.xapi.storage.rbdsr
   rm -rf /usr/libexec/xapi-storage-script/datapath/rbd+qcow2+qdisk
+  rm -rf /usr/libexec/xapi-storage-script/datapath/rbd+raw+krbd
+  rm -rf /usr/libexec/xapi-storage-script/datapath/rbd+raw+rbdnbd
   rm -rf /lib/python2.7/site-packages/xapi/storage/libs/librbd
   }
 
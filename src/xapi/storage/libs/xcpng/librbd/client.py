@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""SMAPIv3 entry point that forwards the call to the plugin daemon
+
+Every SR.*, Volume.*, Datapath.*, Data.* and Plugin.* command of the plugin directories is a link
+to this script. It sends its arguments and standard input to the daemon (see daemon.py) over
+DAEMON_SOCKET and writes back what the command printed and its exit status. It only imports the
+standard library, so it starts in a fraction of the time the xcpng script of the command takes to
+import rados, rbd and the xcpng libraries.
+
+When the daemon isn't running the command's xcpng script is run in this process, as it was before
+there was a daemon.
+"""
+
+import errno
+import json
+import os
+import socket
+import sys
+import traceback
+
+DAEMON_SOCKET = os.environ.get('RBDSR_DAEMON_SOCKET', '/var/run/rbdsr/plugin.sock')
+
+# Command prefix -> xcpng script of the plugin directory that implements it
+SCRIPTS = {
+    'Plugin': 'plugin.py',
+    'SR': 'sr.py',
+    'Volume': 'volume.py',
+    'Datapath': 'datapath.py',
+    'Data': 'data.py',
+}
+
+
+def script_path(command_path):
+    """Returns the script that implements the command, e.g. <plugin dir>/sr.py for <plugin dir>/SR.stat"""
+    prefix = os.path.basename(command_path).split('.', 1)[0]
+    if prefix not in SCRIPTS:
+        raise Exception("Unknown command %s" % command_path)
+    return os.path.join(os.path.dirname(command_path), SCRIPTS[prefix])
+
+
+def read_input(args):
+    """Returns the standard input of the command: the JSON request line in --json mode, as the
+    generated command line parsers read it, nothing otherwise"""
+    if '--json' in args or '-j' in args:
+        return sys.stdin.readline()
+    return ''
+
+
+def exit_status(code):
+    """Returns the exit status sys.exit(code) ends the process with"""
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    sys.stderr.write("%s\n" % code)
+    return 1
+
+
+def run_script(script, command_path, code=None):
+    """Runs script as __main__ in this process and returns its exit status
+
+    __file__ is the command, as it is when the command link is run on its own
+    """
+    if code is None:
+        with open(script) as f:
+            code = compile(f.read(), script, 'exec')
+    try:
+        exec(code, {'__name__': '__main__', '__file__': command_path})
+    except SystemExit as e:
+        return exit_status(e.code)
+    except Exception:
+        traceback.print_exc()
+        return 1
+    return 0
+
+
+def forward(sock, command_path, args, stdin):
+    """Runs the command in the daemon, returns its stdout, stderr and exit status"""
+    request = {'command': command_path, 'args': args, 'stdin': stdin}
+    sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+    f = sock.makefile('rb')
+    try:
+        line = f.readline()
+    finally:
+        f.close()
+    if not line:
+        raise Exception("Plugin daemon closed the connection running %s" % command_path)
+    reply = json.loads(line.decode('utf-8'))
+    return reply['stdout'], reply['stderr'], reply['status']
+
+
+def main():
+    command_path = os.path.abspath(sys.argv[0])
+    args = sys.argv[1:]
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(DAEMON_SOCKET)
+    except socket.error as e:
+        sock.close()
+        if e.errno not in (errno.ENOENT, errno.ECONNREFUSED):
+            raise
+        # No daemon, the script's directory is what sys.path[0] would have been
+        script = script_path(command_path)
+        sys.path[0] = os.path.dirname(os.path.realpath(script))
+        return run_script(script, command_path)
+    try:
+        stdout, stderr, status = forward(sock, command_path, args, read_input(args))
+    finally:
+        sock.close()
+    sys.stdout.write(stdout)
+    sys.stderr.write(stderr)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+"""Resident plugin daemon: runs the SMAPIv3 commands of the plugin in one long-lived process
+
+Without it every command is a Python process that imports rados, rbd and the xcpng libraries,
+connects to the cluster and exits, which takes longer than SR.stat or Volume.stat themselves. The
+daemon imports all of that once and runs each command forwarded by client.py in a thread of its
+own, so cluster connections, IoCtxs, image handles (rbd_utils.CONNECTIONS) and loaded MetaDBs
+(meta.META_CACHE) stay warm between commands. Connections are kept for DAEMON_CONNECTION_IDLE_TIMEOUT
+and those of the clusters in /etc/ceph are opened at start. The pool stats of those clusters are
+refreshed in the background (stats.POOL_STATS), so SR.stat never waits for the monitors.
+
+A command runs the same xcpng script it would run on its own: sys.argv, sys.stdin, sys.stdout and
+sys.stderr are per thread, and sys.exit() ends the command rather than the daemon.
+
+    python -m xapi.storage.libs.xcpng.librbd.daemon
+
+is run by the rbdsr-daemon service. It has to be restarted after the plugin is upgraded.
+"""
+
+import errno
+import fcntl
+import json
+import os
+import signal
+import sys
+import threading
+import traceback
+
+try:
+    import SocketServer as socketserver
+    from StringIO import StringIO
+except ImportError:
+    import socketserver
+    from io import StringIO
+
+from time import sleep
+from xapi.storage import log
+from xapi.storage.libs.xcpng.librbd import datapath, meta, sr, volume  # imported once for every command
+from xapi.storage.libs.xcpng.librbd.client import DAEMON_SOCKET, script_path, run_script
+from xapi.storage.libs.xcpng.librbd.rbd_utils import CONNECTIONS, CONNECTION_HEALTH_CHECK_INTERVAL, \
+                                                     get_config_files_list
+from xapi.storage.libs.xcpng.librbd.stats import POOL_STATS
+from xapi.storage.libs.xcpng.librbd.trace import METRICS, METRICS_FLUSH_INTERVAL, debug
+
+PLUGIN_ROOT = '/usr/libexec/xapi-storage-script'  # commands are only run from plugin directories under it
+DAEMON_LOCK_FILE = 'plugin.lock'
+DAEMON_CONNECTION_IDLE_TIMEOUT = 3600  # seconds an unused cluster connection is kept
+
+_command = threading.local()
+
+
+class _ThreadStream(object):
+    """sys.stdin/stdout/stderr of the command the thread runs, the daemon's own outside commands"""
+
+    def __init__(self, name, default):
+        self._name = name
+        self._default = default
+
+    def _stream(self):
+        stream = getattr(_command, self._name, None)
+        return self._default if stream is None else stream
+
+    def __getattr__(self, name):
+        return getattr(self._stream(), name)
+
+    def __iter__(self):
+        return iter(self._stream())
+
+
+class _ThreadArgv(object):
+    """sys.argv of the command the thread runs, the daemon's own outside commands"""
+
+    def __init__(self, default):
+        self._default = default
+
+    def _argv(self):
+        argv = getattr(_command, 'argv', None)
+        return self._default if argv is None else argv
+
+    def __getitem__(self, index):
+        return self._argv()[index]
+
+    def __setitem__(self, index, value):
+        self._argv()[index] = value
+
+    def __len__(self):
+        return len(self._argv())
+
+    def __iter__(self):
+        return iter(self._argv())
+
+    def __contains__(self, item):
+        return item in self._argv()
+
+    def __repr__(self):
+        return repr(self._argv())
+
+
+class _Scripts(object):
+    """Compiled xcpng scripts, recompiled when the file changes"""
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__code = {}  # script path -> (mtime, code)
+
+    def get(self, script):
+        mtime = os.stat(script).st_mtime
+        with self.__lock:
+            cached = self.__code.get(script)
+            if cached is not None and cached[0] == mtime:
+                return cached[1]
+        with open(script) as f:
+            code = compile(f.read(), script, 'exec')
+        with self.__lock:
+            self.__code[script] = (mtime, code)
+            # The script's imports resolve as if it had been run directly
+            script_dir = os.path.dirname(os.path.realpath(script))
+            if script_dir not in sys.path:
+                sys.path.append(script_dir)
+        return code
+
+
+SCRIPTS = _Scripts()
+
+
+def run_command(dbg, command_path, args, stdin):
+    """Runs a plugin command in this thread, returns its stdout, stderr and exit status"""
+    debug("%s: xcpng.librbd.daemon.run_command: %s %s", dbg, command_path, args)
+    stdout = StringIO()
+    stderr = StringIO()
+    try:
+        if not os.path.dirname(os.path.normpath(command_path)).startswith(PLUGIN_ROOT + os.sep):
+            raise Exception("%s is not a plugin command" % command_path)
+        script = script_path(command_path)
+        code = SCRIPTS.get(script)
+    except Exception as e:
+        log.error("%s: xcpng.librbd.daemon.run_command: Refused %s: %s" % (dbg, command_path, e))
+        return '', "%s\n" % e, 1
+
+    _command.argv = [command_path] + list(args)
+    _command.stdin = StringIO(stdin)
+    _command.stdout = stdout
+    _command.stderr = stderr
+    try:
+        status = run_script(script, command_path, code)
+    finally:
+        _command.argv = _command.stdin = _command.stdout = _command.stderr = None
+    return stdout.getvalue(), stderr.getvalue(), status
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        dbg = "rbdsr-daemon-%s" % threading.current_thread().name
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            request = json.loads(line.decode('utf-8'))
+            stdout, stderr, status = run_command(dbg, request['command'], request['args'], request['stdin'])
+        except Exception:
+            log.error("%s: xcpng.librbd.daemon._Handler.handle: Failed to run a command" % dbg)
+            log.error(traceback.format_exc())
+            stdout, stderr, status = '', traceback.format_exc(), 1
+        self.wfile.write((json.dumps({'stdout': stdout, 'stderr': stderr, 'status': status}) + '\n').encode('utf-8'))
+
+
+def _set_cloexec(fd):
+    # Daemons started by commands (qemu-nbd -c, rbd-nbd) must not inherit the daemon's sockets
+    fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        socketserver.UnixStreamServer.server_bind(self)
+        _set_cloexec(self.socket.fileno())
+        os.chmod(self.server_address, 0o600)
+
+    def get_request(self):
+        request, address = self.socket.accept()
+        _set_cloexec(request.fileno())
+        return request, address
+
+
+def _warm_up(dbg):
+    for cluster_name in get_config_files_list(dbg):
+        try:
+            CONNECTIONS.acquire(dbg, cluster_name)
+            CONNECTIONS.release(dbg, cluster_name)
+        except Exception:
+            log.error("%s: xcpng.librbd.daemon._warm_up: Failed to connect to cluster %s" % (dbg, cluster_name))
+            log.error(traceback.format_exc())
+        POOL_STATS.start(dbg, cluster_name)
+
+
+def _evict_idle(dbg):
+    # Unused handles are only evicted when a connection is released, the daemon can stay idle for long
+    while True:
+        sleep(CONNECTION_HEALTH_CHECK_INTERVAL)
+        try:
+            CONNECTIONS.evict_idle(dbg)
+        except Exception:
+            log.error(traceback.format_exc())
+
+
+def _flush_metrics(dbg):
+    # The daemon only exits when the host stops it, its counts would be missing until then
+    while True:
+        sleep(METRICS_FLUSH_INTERVAL)
+        try:
+            METRICS.flush(dbg)
+        except Exception:
+            log.error(traceback.format_exc())
+
+
+def _start_thread(target, dbg):
+    thread = threading.Thread(target=target, args=(dbg,))
+    thread.daemon = True
+    thread.start()
+
+
+def main(socket_path=DAEMON_SOCKET):
+    dbg = 'rbdsr-daemon'
+    run_dir = os.path.dirname(socket_path)
+    try:
+        os.makedirs(run_dir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    fd = os.open(os.path.join(run_dir, DAEMON_LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+    _set_cloexec(fd)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError as e:
+        if e.errno in (errno.EAGAIN, errno.EACCES):
+            log.error("%s: xcpng.librbd.daemon.main: Another daemon is serving %s" % (dbg, socket_path))
+            return 1
+        raise
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    server = _Server(socket_path, _Handler)
+    debug("%s: xcpng.librbd.daemon.main: Serving %s", dbg, socket_path)
+
+    sys.argv = _ThreadArgv(sys.argv)
+    sys.stdin = _ThreadStream('stdin', sys.stdin)
+    sys.stdout = _ThreadStream('stdout', sys.stdout)
+    sys.stderr = _ThreadStream('stderr', sys.stderr)
+    CONNECTIONS.idle_timeout = DAEMON_CONNECTION_IDLE_TIMEOUT
+    _start_thread(_warm_up, dbg)
+    _start_thread(_evict_idle, dbg)
+    _start_thread(_flush_metrics, dbg)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    finally:
+        # Clients fall back to running commands themselves as soon as the socket is gone
+        os.unlink(socket_path)
+        server.server_close()
+        os.close(fd)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,58 +1,284 @@
 #!/usr/bin/env python
 
-from os.path import exists
+import os
+
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from time import sleep, time
+
 from xapi.storage.libs.xcpng.datapath import DatapathOperations as _DatapathOperations_
 from xapi.storage.libs.xcpng.meta import IMAGE_UUID_TAG
-from xapi.storage.libs.xcpng.utils import call, _call, get_cluster_name_by_uri, get_sr_name_by_uri, VDI_PREFIXES, \
+from xapi.storage.libs.xcpng.utils import call, get_cluster_name_by_uri, get_sr_name_by_uri, VDI_PREFIXES, \
                                           get_vdi_type_by_uri
+from xapi.storage.libs.xcpng.librbd.meta import VDI_KEYS_TAG, get_sr_config
+from xapi.storage.libs.xcpng.librbd.host import get_host_config
+from xapi.storage.libs.xcpng.librbd.nbd_utils import SYS_BLOCK_DIR, NBDAllocator, NBDServer, load_nbd_module
+from xapi.storage.libs.xcpng.librbd import pcache
+from xapi.storage.libs.xcpng.librbd.qos import apply_vdi_qos, get_qos_profile
+from xapi.storage.libs.xcpng.librbd.tuning import get_tuning_profile, merge_tuning_profiles, qemu_nbd_options, \
+                                                  rbd_conf_options, blockdev_options
 
 from xapi.storage import log
+from xapi.storage.libs.xcpng.librbd.trace import METRICS, debug
 
-NBDS_MAX = 32
+QEMU_NBD = '/usr/lib64/qemu-dp-xcpng/bin/qemu-nbd'
+RBD = '/usr/bin/rbd'
+RBD_NBD = '/usr/bin/rbd-nbd'
+SYS_RBD_DEVICES_DIR = '/sys/bus/rbd/devices'
+RESIZE_TIMEOUT = 10  # seconds an attached device may take to show the new size of its image
 
-class DatapathOperations(_DatapathOperations_):
+# device-config:datapath values and how they map an image to the host block device given to the datapath:
+#   qdisk   qemu-nbd (or the shared NBD server) serving /dev/nbdN through librbd in user space
+#   rbdnbd  rbd-nbd serving /dev/nbdN, librbd without the qemu block layer in between
+#   krbd    kernel rbd driver, /dev/rbdN with no user space hop. The kernel must support every
+#           feature of the image, so images are best created with layering/exclusive-lock only.
+#           The tuning profile doesn't apply, the kernel client has no librbd cache.
+# With rbd-persistent-cache=true qemu-nbd and rbd-nbd attach through the host's persistent write-back
+# cache (see pcache), the shared NBD server and krbd without it.
+DATAPATH_QDISK = 'qdisk'
+DATAPATH_RBDNBD = 'rbdnbd'
+DATAPATH_KRBD = 'krbd'
+
+
+def get_datapath_by_uri(dbg, uri):
+    # <sr type>+<image format>+<datapath>://...
+    return uri.split('://', 1)[0].split('+')[2]
+
+
+class StageTimer(object):
+    """Wall clock time of the named stages of an operation, for its log line
+
+    Each stage is also counted in the latency metrics as <operation>.<stage>, see trace.py.
+    """
+
+    def __init__(self, operation):
+        self.operation = operation
+        self.start = time()
+        self.stages = []
+
+    def _record(self, name, start, outcome):
+        elapsed = time() - start
+        self.stages.append((name, elapsed))
+        METRICS.observe("%s.%s" % (self.operation, name), outcome, elapsed)
+
+    def timed(self, name, func):
+        """Returns func timed as stage name, to be called from any thread"""
+        def _timed_(*args):
+            start = time()
+            outcome = 'error'
+            try:
+                result = func(*args)
+                outcome = 'ok'
+                return result
+            finally:
+                self._record(name, start, outcome)
+        return _timed_
+
+    @contextmanager
+    def stage(self, name):
+        start = time()
+        outcome = 'error'
+        try:
+            yield
+            outcome = 'ok'
+        finally:
+            self._record(name, start, outcome)
+
+    def finish(self):
+        """Counts the whole operation in the latency metrics"""
+        METRICS.observe(self.operation, 'ok', time() - self.start)
+
+    def __str__(self):
+        return ' '.join("%s=%.0fms" % (name, elapsed * 1000) for name, elapsed in self.stages + [('total', time() - self.start)])
+
+
+def _read_sys(path):
+    with open(path) as f:
+        return f.read().strip()
+
+
+def _serves(device, image_spec):
+    """Tells whether device is connected on this host and serves the pool/image image_spec"""
+    name = os.path.basename(device)
+    try:
+        if name.startswith('rbd'):
+            path = os.path.join(SYS_RBD_DEVICES_DIR, name[len('rbd'):])
+            return "%s/%s" % (_read_sys(os.path.join(path, 'pool')), _read_sys(os.path.join(path, 'name'))) == image_spec
+        # The process connected to the nbd device (qemu-nbd, rbd-nbd, nbd-client) names the image
+        with open("/proc/%s/cmdline" % _read_sys(os.path.join(SYS_BLOCK_DIR, name, 'pid'))) as f:
+            return image_spec in f.read().replace('\0', ' ')
+    except (IOError, OSError):
+        return False
 
-    def _is_nbd_device_connected(self, dbg, nbd_device):
-        call(dbg, ['/usr/sbin/modprobe', 'nbd', "nbds_max=%s" % NBDS_MAX])
-        if not exists(nbd_device):
-            raise Exception('There are no more free NBD devices')
-        returncode = _call(dbg, ['/usr/sbin/nbd-client', '-check', nbd_device])
-        if returncode == 0:
-            return True
-        if returncode == 1:
-            return False
-
-    def _find_unused_nbd_device(self, dbg):
-        for device_no in range(0, NBDS_MAX):
-            nbd_device = "/dev/nbd{}".format(device_no)
-            if not self._is_nbd_device_connected(dbg, nbd_device=nbd_device):
-                return nbd_device
+
+def resize_device(dbg, uri, device, image_spec, size):
+    """Makes the block device of an attached VDI show the new size of its image, without a reattach
+
+    The kernel rbd client and rbd-nbd watch the image header and resize their device themselves,
+    on whichever host the VDI is attached. If it is attached here the kernel client is told to
+    refresh at once and the device is waited for. An NBD export of qemu has its size fixed when it
+    is connected, so on the qdisk datapath the new size shows with the next attach.
+    """
+    debug("%s: xcpng.librbd.datapath.resize_device: uri: %s device: %s size: %s", dbg, uri, device, size)
+    if not _serves(device, image_spec):
+        return
+    datapath = get_datapath_by_uri(dbg, uri)
+    if datapath == DATAPATH_KRBD:
+        with open(os.path.join(SYS_RBD_DEVICES_DIR, os.path.basename(device)[len('rbd'):], 'refresh'), 'w') as f:
+            f.write('1')
+    elif datapath != DATAPATH_RBDNBD:
+        debug("%s: xcpng.librbd.datapath.resize_device: %s keeps its size until the VDI is attached again",
+              dbg, device)
+        return
+    deadline = time() + RESIZE_TIMEOUT
+    while int(_read_sys(os.path.join(SYS_BLOCK_DIR, os.path.basename(device), 'size'))) << 9 < size:
+        if time() > deadline:
+            log.error("%s: xcpng.librbd.datapath.resize_device: %s didn't grow to %s bytes within %s seconds"
+                      % (dbg, device, size, RESIZE_TIMEOUT))
+            return
+        sleep(0.1)
+
+
+class DatapathOperations(_DatapathOperations_):
 
     def map_vol(self, dbg, uri, chained=False):
         if chained is False:
-            log.debug("%s: xcpng.librbd.datapath.QdiskDatapath.map_vol: uri: %s" % (dbg, uri))
-            nbd_dev = self._find_unused_nbd_device(dbg)
-            call(dbg, ['/usr/lib64/qemu-dp-xcpng/bin/qemu-nbd',
-                       '-c', nbd_dev,
-                       '-f', 'raw',
-                       self.gen_vol_uri(dbg, uri)])
-            volume_meta = {'nbd_dev': nbd_dev}
-            self.MetadataHandler.update_vdi_meta(dbg, uri, volume_meta)
+            debug("%s: xcpng.librbd.datapath.QdiskDatapath.map_vol: uri: %s", dbg, uri)
+            timer = StageTimer('map_vol')
+            datapath = get_datapath_by_uri(dbg, uri)
+            volume_meta, profile = self._prepare_map(dbg, uri, datapath, timer)
+            pool_name = get_sr_name_by_uri(dbg, uri)
+            image_name = self._get_image_name(dbg, uri, volume_meta)
+            image_spec = "%s/%s" % (pool_name, image_name)
+            qos = get_qos_profile(dbg, volume_meta.get(VDI_KEYS_TAG) or {})
+            if qos:
+                # Volume.set doesn't reach the image, the client about to open it reads the limits
+                with timer.stage('qos'):
+                    apply_vdi_qos(dbg, uri, pool_name, image_name, qos)
+                if datapath == DATAPATH_KRBD:
+                    log.error("%s: xcpng.librbd.datapath.QdiskDatapath.map_vol: uri: %s The kernel rbd client "
+                              "doesn't enforce the QoS limits %s" % (dbg, uri, qos))
+            nbd_server = datapath == DATAPATH_QDISK and get_host_config(dbg, 'NBD_SERVER', False)
+            cache = []
+            if profile is not None and profile['rbd-persistent-cache'] == 'true':
+                with timer.stage('pcache'):
+                    cache = pcache.prepare_attach(dbg, get_cluster_name_by_uri(dbg, uri), pool_name, image_name,
+                                                  datapath != DATAPATH_KRBD and not nbd_server)
+            nbd_export = None
+            with timer.stage('connect'):
+                if datapath == DATAPATH_KRBD:
+                    nbd_dev = self._krbd_map(dbg, uri, image_spec)
+                elif datapath == DATAPATH_RBDNBD:
+                    nbd_dev = self._rbd_nbd_map(dbg, uri, image_spec, profile, cache)
+                elif nbd_server:
+                    nbd_dev, nbd_export = self._nbd_server_map(dbg, uri, image_spec, profile)
+                else:
+                    nbd_dev = self._qemu_nbd_map(dbg, uri, image_spec, profile, cache)
+            with timer.stage('update_meta'):
+                self.MetadataHandler.update_vdi_meta(dbg, uri, {'nbd_dev': nbd_dev, 'nbd_export': nbd_export,
+                                                                'pcache': bool(cache)})
             self.blkdev = nbd_dev
-            super(DatapathOperations, self).map_vol(dbg, uri, chained=False)
+            with timer.stage('activate'):
+                super(DatapathOperations, self).map_vol(dbg, uri, chained=False)
+            timer.finish()
+            debug("%s: xcpng.librbd.datapath.QdiskDatapath.map_vol: uri: %s %s", dbg, uri, timer)
+
+    def _prepare_map(self, dbg, uri, datapath, timer):
+        """Returns the VDI meta and tuning profile, loading the nbd module meanwhile
+
+        The meta and the SR config are separate RADOS reads and the module is local, so the three run
+        at once. The kernel rbd client needs neither the profile nor the nbd module.
+        """
+        workers = ThreadPool(3)
+        try:
+            volume_meta = workers.apply_async(timer.timed('vdi_meta', self.MetadataHandler.get_vdi_meta), (dbg, uri))
+            if datapath == DATAPATH_KRBD:
+                return volume_meta.get(), None
+            sr_config = workers.apply_async(timer.timed('sr_config', get_sr_config), (dbg, uri))
+            nbd_module = workers.apply_async(timer.timed('nbd_module', load_nbd_module), (dbg,))
+            profile = merge_tuning_profiles(get_tuning_profile(dbg, sr_config.get()),
+                                            get_tuning_profile(dbg, volume_meta.get().get(VDI_KEYS_TAG) or {}))
+            nbd_module.get()
+            return volume_meta.get(), profile
+        finally:
+            workers.close()
 
     def unmap_vol(self, dbg, uri, chained=False):
         if chained is False:
-            log.debug("%s: xcpng.librbd.datapath.QdiskDatapath.unmap_vol: uri: %s" % (dbg, uri))
+            debug("%s: xcpng.librbd.datapath.QdiskDatapath.unmap_vol: uri: %s", dbg, uri)
             super(DatapathOperations, self).unmap_vol(dbg, uri, chained=False)
             volume_meta = self.MetadataHandler.get_vdi_meta(dbg, uri)
-            call(dbg, ['/usr/lib64/qemu-dp-xcpng/bin/qemu-nbd', '-d', volume_meta['nbd_dev']])
-            volume_meta = {'nbd_dev': None}
+            datapath = get_datapath_by_uri(dbg, uri)
+            if datapath == DATAPATH_KRBD:
+                call(dbg, [RBD, 'unmap', volume_meta['nbd_dev']])
+            elif datapath == DATAPATH_RBDNBD:
+                call(dbg, [RBD_NBD, 'unmap', volume_meta['nbd_dev']])
+                NBDAllocator().release(dbg, volume_meta['nbd_dev'])
+            elif volume_meta.get('nbd_export'):
+                # Attached through the shared NBD server
+                server = NBDServer(dbg, get_cluster_name_by_uri(dbg, uri))
+                server.disconnect_device(volume_meta['nbd_dev'])
+                NBDAllocator().release(dbg, volume_meta['nbd_dev'])
+                server.remove_export(get_sr_name_by_uri(dbg, uri), self._get_image_name(dbg, uri, volume_meta))
+            else:
+                call(dbg, [QEMU_NBD, '-d', volume_meta['nbd_dev']])
+                NBDAllocator().release(dbg, volume_meta['nbd_dev'])
+            if volume_meta.get('pcache'):
+                # The VDI may next be attached on another host, which must find all its data in the cluster
+                pcache.detach(dbg, get_cluster_name_by_uri(dbg, uri), get_sr_name_by_uri(dbg, uri),
+                              self._get_image_name(dbg, uri, volume_meta), pcache.cache_options(dbg))
+            volume_meta = {'nbd_dev': None, 'nbd_export': None, 'pcache': None}
             self.MetadataHandler.update_vdi_meta(dbg, uri, volume_meta)
 
-    def gen_vol_uri(self, dbg, uri):
-        volume_meta = self.MetadataHandler.get_vdi_meta(dbg, uri)
-        return "rbd:%s/%s%s:conf=/etc/ceph/%s.conf" % (get_sr_name_by_uri(dbg, uri),
-                                                       VDI_PREFIXES[get_vdi_type_by_uri(dbg, uri)],
-                                                       volume_meta[IMAGE_UUID_TAG],
-                                                       get_cluster_name_by_uri(dbg, uri))
\ No newline at end of file
+    def _qemu_nbd_map(self, dbg, uri, image_spec, profile, cache=()):
+        with NBDAllocator().allocate(dbg) as nbd_dev:
+            call(dbg, [QEMU_NBD,
+                       '-c', nbd_dev,
+                       '-f', 'raw'] +
+                 qemu_nbd_options(profile) +
+                 [self._vol_uri(dbg, uri, image_spec, profile, cache)])
+        return nbd_dev
+
+    def _nbd_server_map(self, dbg, uri, image_spec, profile):
+        server = NBDServer(dbg, get_cluster_name_by_uri(dbg, uri))
+        pool_name, image_name = image_spec.split('/', 1)
+        nbd_export = server.add_export(pool_name, image_name, blockdev_options(profile))
+        try:
+            with NBDAllocator().allocate(dbg) as nbd_dev:
+                server.connect_device(nbd_dev, nbd_export)
+        except Exception:
+            server.remove_export(pool_name, image_name)
+            raise
+        return nbd_dev, nbd_export
+
+    def _rbd_nbd_map(self, dbg, uri, image_spec, profile, cache=()):
+        # rbd-nbd would pick the first free device itself, racing with the allocator
+        with NBDAllocator().allocate(dbg) as nbd_dev:
+            call(dbg, [RBD_NBD, 'map',
+                       '--device', nbd_dev,
+                       '--cluster', get_cluster_name_by_uri(dbg, uri)] +
+                 ["--%s=%s" % option for option in rbd_conf_options(profile) + list(cache)] +
+                 [image_spec])
+        return nbd_dev
+
+    def _krbd_map(self, dbg, uri, image_spec):
+        return call(dbg, [RBD, 'map',
+                          '--cluster', get_cluster_name_by_uri(dbg, uri),
+                          image_spec]).strip()
+
+    def _get_image_name(self, dbg, uri, volume_meta=None):
+        if volume_meta is None:
+            volume_meta = self.MetadataHandler.get_vdi_meta(dbg, uri)
+        return "%s%s" % (VDI_PREFIXES[get_vdi_type_by_uri(dbg, uri)], volume_meta[IMAGE_UUID_TAG])
+
+    def gen_image_spec(self, dbg, uri, volume_meta=None):
+        return "%s/%s" % (get_sr_name_by_uri(dbg, uri), self._get_image_name(dbg, uri, volume_meta))
+
+    def gen_vol_uri(self, dbg, uri, profile=None):
+        return self._vol_uri(dbg, uri, self.gen_image_spec(dbg, uri), profile)
+
+    def _vol_uri(self, dbg, uri, image_spec, profile=None, options=()):
+        vol_uri = "rbd:%s:conf=/etc/ceph/%s.conf" % (image_spec, get_cluster_name_by_uri(dbg, uri))
+        if profile is not None:
+            vol_uri += ''.join(":%s=%s" % option for option in rbd_conf_options(profile))
+        return vol_uri + ''.join(":%s=%s" % option for option in options)
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+"""Incremental export and import of RBD images as streams of changed extents
+
+An image is exported as of a snapshot, either in full or as the changes since an older snapshot,
+and the stream applied to an image of another pool or cluster that has the older snapshot. The
+importer takes the snapshot too, so the next night only the extents changed since it are sent. The
+stream is the `rbd export-diff` format v1, so `rbd export-diff`/`rbd import-diff` interoperate:
+
+    'rbd diff v1\\n'
+    'f' <le32 length> <name>                   snapshot the stream starts from, incremental only
+    't' <le32 length> <name>                   snapshot the stream ends at
+    's' <le64 size>                            image size
+    'w' <le64 offset> <le64 length> <data>     extent to write
+    'z' <le64 offset> <le64 length>            extent to zero
+    'e'
+
+Memory is bounded: the exporter asks diff_iterate for one DIFF_WINDOW at a time and sends extents
+in pieces of at most DIFF_CHUNK, all zero pieces as 'z'. The importer reads 'w' data in such
+pieces too.
+
+Extents go out in ascending offset order and writing one again is harmless, so a transfer that
+broke off is resumed rather than restarted: every IMPORT_CHECKPOINT bytes the importer records how
+far it got in IMPORT_PROGRESS_OBJECT of the pool, import_progress() returns that offset and the
+export is started again from there.
+
+    python -m xapi.storage.libs.xcpng.librbd.diffstream export <cluster> <pool> <image> <snapshot> \\
+        [--from <snapshot>] [--offset <bytes>] [--whole-object] > stream
+    python -m xapi.storage.libs.xcpng.librbd.diffstream import <cluster> <pool> <image> < stream
+    python -m xapi.storage.libs.xcpng.librbd.diffstream progress <cluster> <pool> <image>
+
+The snapshot to export is taken if it doesn't exist. A full stream creates the target image if
+it doesn't exist.
+"""
+
+import argparse
+import json
+import struct
+import sys
+import traceback
+
+from rbd import Image, ImageNotFound
+
+from xapi.storage import log
+from xapi.storage.libs.xcpng.librbd.rbd_utils import ceph_cluster, rbd_create, rbd_resize, rbd_snapshot, \
+                                                     rbd_list_snapshots, rados_omap_get, rados_omap_set
+from xapi.storage.libs.xcpng.librbd.trace import debug, fsid
+
+DIFF_HEADER = b'rbd diff v1\n'
+DIFF_WINDOW = 1 << 30  # bytes of the image one diff_iterate() call covers
+DIFF_CHUNK = 4 << 20  # largest piece of data read, sent or written at once
+IMPORT_CHECKPOINT = 256 << 20  # bytes applied between two records of the import progress
+IMPORT_PROGRESS_OBJECT = '__import_progress__'  # image name -> JSON [from snapshot, to snapshot, offset]
+
+_ZEROS = bytes(bytearray(DIFF_CHUNK))
+
+
+def _write_name(stream, tag, name):
+    name = name.encode('utf-8')
+    stream.write(tag + struct.pack('<I', len(name)) + name)
+
+
+def _write_extent(stream, image, offset, length):
+    """Sends an extent in DIFF_CHUNK pieces, returns the bytes of data sent"""
+    sent = 0
+    end = offset + length
+    while offset < end:
+        chunk = min(DIFF_CHUNK, end - offset)
+        data = image.read(offset, chunk)
+        if data == _ZEROS[:chunk]:
+            stream.write(b'z' + struct.pack('<QQ', offset, chunk))
+        else:
+            stream.write(b'w' + struct.pack('<QQ', offset, chunk))
+            stream.write(data)
+            sent += chunk
+        offset += chunk
+    return sent
+
+
+def export_diff(dbg, cluster, pool, name, snapshot, stream, from_snapshot=None, offset=0, whole_object=False):
+    """Writes the extents of the image at snapshot that changed since from_snapshot (all allocated ones if
+    None) and lie at or beyond offset to stream. Returns the bytes of data sent
+
+    whole_object sends whole changed objects, which the object map of a fast-diff image lists at
+    once, instead of the exact extents that take a look at every object
+    """
+    debug("%s: xcpng.librbd.diffstream.export_diff: Cluster ID: %s Pool: %s Name: %s Snapshot: %s From: %s "
+          "Offset: %s", dbg, fsid(cluster), pool, name, snapshot, from_snapshot, offset)
+    sent = 0
+    try:
+        with cluster.ioctx(pool) as ioctx:
+            image = Image(ioctx, name, snapshot=snapshot, read_only=True)
+            try:
+                size = image.size()
+                stream.write(DIFF_HEADER)
+                if from_snapshot is not None:
+                    _write_name(stream, b'f', from_snapshot)
+                _write_name(stream, b't', snapshot)
+                stream.write(b's' + struct.pack('<Q', size))
+
+                window = offset
+                while window < size:
+                    length = min(DIFF_WINDOW, size - window)
+                    extents = []
+                    image.diff_iterate(window, length, from_snapshot,
+                                       lambda offset_, length_, exists: extents.append((offset_, length_, exists)),
+                                       include_parent=True, whole_object=whole_object)
+                    for extent_offset, extent_length, exists in sorted(extents):
+                        # A resumed export starts within the extent the import broke off in
+                        start = max(extent_offset, offset)
+                        if start >= extent_offset + extent_length:
+                            continue
+                        extent_length -= start - extent_offset
+                        if exists:
+                            sent += _write_extent(stream, image, start, extent_length)
+                        else:
+                            stream.write(b'z' + struct.pack('<QQ', start, extent_length))
+                    window += length
+                stream.write(b'e')
+                stream.flush()
+            finally:
+                image.close()
+    except Exception as e:
+        log.error("%s: xcpng.librbd.diffstream.export_diff: Failed to export an image: Cluster ID: %s Pool: %s Name: %s "
+                  "Snapshot: %s" % (dbg, cluster.get_fsid(), pool, name, snapshot))
+        log.error(traceback.format_exc())
+        raise Exception(e)
+    return sent
+
+
+def _read(stream, length):
+    data = stream.read(length)
+    if len(data) != length:
+        raise Exception("Diff stream is truncated")
+    return data
+
+
+def _read_name(stream):
+    return _read(stream, struct.unpack('<I', _read(stream, 4))[0]).decode('utf-8')
+
+
+def _image_exists(cluster, pool, name):
+    with cluster.ioctx(pool) as ioctx:
+        try:
+            Image(ioctx, name, read_only=True).close()
+            return True
+        except ImageNotFound:
+            return False
+
+
+def import_diff(dbg, cluster, pool, name, stream):
+    """Applies a diff stream to the image and takes its end snapshot. Returns the bytes of data written
+
+    An incremental stream needs the image to have the snapshot the stream starts from, a full one
+    creates the image if it doesn't exist
+    """
+    debug("%s: xcpng.librbd.diffstream.import_diff: Cluster ID: %s Pool: %s Name: %s",
+          dbg, fsid(cluster), pool, name)
+    applied = 0
+    try:
+        if _read(stream, len(DIFF_HEADER)) != DIFF_HEADER:
+            raise Exception("Not an rbd diff v1 stream")
+        from_snapshot = to_snapshot = None
+        while True:
+            # The snapshot and size records come before any extent
+            tag = _read(stream, 1)
+            if tag == b'f':
+                from_snapshot = _read_name(stream)
+            elif tag == b't':
+                to_snapshot = _read_name(stream)
+            elif tag == b's':
+                size = struct.unpack('<Q', _read(stream, 8))[0]
+                break
+            else:
+                raise Exception("Diff stream record %r before the image size" % tag)
+
+        if from_snapshot is not None:
+            if from_snapshot not in rbd_list_snapshots(dbg, cluster, pool, name):
+                raise Exception("Image %s has no snapshot %s to apply the diff to" % (name, from_snapshot))
+            rbd_resize(dbg, cluster, pool, name, size)
+        elif _image_exists(cluster, pool, name):
+            rbd_resize(dbg, cluster, pool, name, size)
+        else:
+            rbd_create(dbg, cluster, pool, name, size)
+
+        checkpoint = 0
+        with cluster.image(pool, name) as image:
+            while True:
+                tag = _read(stream, 1)
+                if tag == b'e':
+                    break
+                if tag not in (b'w', b'z'):
+                    raise Exception("Unknown diff stream record %r" % tag)
+                offset, length = struct.unpack('<QQ', _read(stream, 16))
+                end = offset + length
+                if tag == b'z':
+                    image.discard(offset, length)
+                else:
+                    while offset < end:
+                        chunk = min(DIFF_CHUNK, end - offset)
+                        image.write(_read(stream, chunk), offset)
+                        offset += chunk
+                    applied += length
+                if applied - checkpoint >= IMPORT_CHECKPOINT:
+                    rados_omap_set(dbg, cluster, pool, IMPORT_PROGRESS_OBJECT,
+                                   {name: json.dumps([from_snapshot, to_snapshot, end])})
+                    checkpoint = applied
+
+        if to_snapshot is not None and to_snapshot not in rbd_list_snapshots(dbg, cluster, pool, name):
+            rbd_snapshot(dbg, cluster, pool, name, to_snapshot)
+        rados_omap_set(dbg, cluster, pool, IMPORT_PROGRESS_OBJECT, {}, [name])
+    except Exception as e:
+        log.error("%s: xcpng.librbd.diffstream.import_diff: Failed to import an image: Cluster ID: %s Pool: %s Name: %s"
+                  % (dbg, cluster.get_fsid(), pool, name))
+        log.error(traceback.format_exc())
+        raise Exception(e)
+    return applied
+
+
+def import_progress(dbg, cluster, pool, name):
+    """Returns (from snapshot, to snapshot, offset) of an import of the image that broke off, None if there is none"""
+    progress = rados_omap_get(dbg, cluster, pool, IMPORT_PROGRESS_OBJECT, [name])
+    if name not in progress:
+        return None
+    return tuple(json.loads(progress[name]))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Incremental export and import of RBD images')
+    commands = parser.add_subparsers(dest='command')
+    for command in ('export', 'import', 'progress'):
+        subparser = commands.add_parser(command)
+        subparser.add_argument('cluster')
+        subparser.add_argument('pool')
+        subparser.add_argument('image')
+        if command == 'export':
+            subparser.add_argument('snapshot')
+            subparser.add_argument('--from', dest='from_snapshot')
+            subparser.add_argument('--offset', type=int, default=0)
+            subparser.add_argument('--whole-object', action='store_true')
+    args = parser.parse_args(argv)
+
+    dbg = "diffstream-%s-%s-%s" % (args.command, args.pool, args.image)
+    cluster = ceph_cluster(dbg, args.cluster)
+    stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+    stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+    try:
+        cluster.connect()
+        if args.command == 'export':
+            if args.snapshot not in rbd_list_snapshots(dbg, cluster, args.pool, args.image):
+                rbd_snapshot(dbg, cluster, args.pool, args.image, args.snapshot)
+            export_diff(dbg, cluster, args.pool, args.image, args.snapshot, stdout, args.from_snapshot, args.offset,
+                        args.whole_object)
+        elif args.command == 'import':
+            import_diff(dbg, cluster, args.pool, args.image, stdin)
+        else:
+            progress = import_progress(dbg, cluster, args.pool, args.image)
+            if progress is not None:
+                print("%s %s %s" % progress)
+    finally:
+        cluster.shutdown()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
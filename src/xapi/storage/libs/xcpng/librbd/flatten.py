@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+"""Background flattening of RBD clones and purging of trashed images
+
+VDI clones and snapshots are RBD clones of a protected snapshot of the source image, so they take no
+time or space to create. Every hop of a parent chain costs reads of data the clone doesn't hold yet,
+so a clone is flattened once its chain is deeper than FLATTEN_MAX_DEPTH or, when
+FLATTEN_PARENT_RATIO is set, once that share of its data is still read from its ancestors. A fresh
+clone reads everything from its parent, so the ratio is off by default. Flatten I/O is paced to
+FLATTEN_RATE bytes per second. All three are HOST_CONFIG_FILE settings.
+
+Destroyed VDIs are moved to the RBD trash (destroy_images()), which returns at once, and their objects
+are deleted here. An image with snapshots can't be trashed before its clones are flattened and the
+snapshots removed, which would copy their data within VDI.destroy: it is recorded in
+TRASH_PENDING_OBJECT instead and that is done here too. The parent snapshot of a trashed clone is
+recorded in TRASH_PARENTS_OBJECT and removed once the clone is purged and it has no other clones.
+
+The plugin processes are short-lived: schedule_pool_worker() starts a detached worker process
+(python -m xapi.storage.libs.xcpng.librbd.flatten <cluster> <pool>) that works until there is nothing
+left to do in the pool. A flock makes sure each pool has one worker, and a pending flag that a
+request arriving while the worker finishes isn't lost.
+"""
+
+import errno
+import fcntl
+import json
+import os
+import subprocess
+import sys
+import traceback
+
+from xapi.storage import log
+from xapi.storage.libs.xcpng.librbd.host import get_host_config
+from xapi.storage.libs.xcpng.librbd.nbd_utils import NBD_RUN_DIR
+from xapi.storage.libs.xcpng.librbd.rbd_utils import ceph_cluster, rbd_list, rbd_parent, rbd_chain_depth, \
+                                                     rbd_parent_ratio, rbd_flatten, rbd_children, \
+                                                     rbd_remove_snapshot, rbd_list_snapshots, rbd_trash_many, \
+                                                     rbd_trash_list, rbd_trash_purge, rados_omap_get, rados_omap_set
+from xapi.storage.libs.xcpng.librbd.trace import debug
+
+FLATTEN_MAX_DEPTH = 2  # ancestors a clone may read through before it is flattened
+FLATTEN_PARENT_RATIO = 0.0  # share of data read from ancestors that triggers a flatten, 0 disables
+FLATTEN_RATE = 64 << 20  # bytes per second per flatten, 0 for unthrottled
+TRASH_PARENTS_OBJECT = '__trash_parents__'  # trashed clone name -> JSON [pool, image, snapshot] of its parent
+TRASH_PENDING_OBJECT = '__trash_pending__'  # names of destroyed images to trash once their snapshots are gone
+
+
+def flatten_candidates(dbg, cluster, pool):
+    """Returns the clones of pool that pass a threshold, deepest chains first"""
+    max_depth = get_host_config(dbg, 'FLATTEN_MAX_DEPTH', FLATTEN_MAX_DEPTH)
+    max_ratio = get_host_config(dbg, 'FLATTEN_PARENT_RATIO', FLATTEN_PARENT_RATIO)
+    candidates = []
+    pending = pending_images(dbg, cluster, pool)
+    for name in rbd_list(dbg, cluster, pool):
+        if name in pending or rbd_parent(dbg, cluster, pool, name) is None:
+            continue
+        depth = rbd_chain_depth(dbg, cluster, pool, name)
+        if depth > max_depth or (max_ratio and rbd_parent_ratio(dbg, cluster, pool, name) >= max_ratio):
+            candidates.append((depth, name))
+    return [name for depth, name in sorted(candidates, reverse=True)]
+
+
+def flatten_image(dbg, cluster, pool, name, rate=None):
+    """Flattens a clone and removes the snapshot it was cloned from if no other clone uses it"""
+    if rate is None:
+        rate = get_host_config(dbg, 'FLATTEN_RATE', FLATTEN_RATE)
+    parent = rbd_parent(dbg, cluster, pool, name)
+    if parent is None:
+        return
+    rbd_flatten(dbg, cluster, pool, name, rate)
+    _remove_unused_snapshot(dbg, cluster, parent)
+
+
+def _remove_unused_snapshot(dbg, cluster, parent):
+    try:
+        if not rbd_children(dbg, cluster, parent[0], parent[1], parent[2]):
+            rbd_remove_snapshot(dbg, cluster, parent[0], parent[1], parent[2])
+    except Exception:
+        # Still used by a clone in the trash, or gone with its image. purge_trash() retries the former
+        debug("%s: xcpng.librbd.flatten._remove_unused_snapshot: Left snapshot %s", dbg, parent)
+
+
+def trash_images(dbg, cluster, pool, names):
+    """Moves images without snapshots to the trash, to be purged by the pool worker"""
+    parents = {}
+    for name in names:
+        parent = rbd_parent(dbg, cluster, pool, name)
+        if parent is not None:
+            parents[name] = json.dumps(parent)
+    if parents:
+        rados_omap_set(dbg, cluster, pool, TRASH_PARENTS_OBJECT, parents)
+    rbd_trash_many(dbg, cluster, pool, names)
+
+
+def destroy_images(dbg, cluster, pool, names):
+    """Trashes the images without snapshots, leaves the others to the pool worker"""
+    pending = [name for name in names if rbd_list_snapshots(dbg, cluster, pool, name)]
+    if pending:
+        rados_omap_set(dbg, cluster, pool, TRASH_PENDING_OBJECT, dict((name, '') for name in pending))
+    trash_images(dbg, cluster, pool, [name for name in names if name not in pending])
+
+
+def pending_images(dbg, cluster, pool):
+    """Returns the names of the destroyed images still waiting for the pool worker"""
+    return set(rados_omap_get(dbg, cluster, pool, TRASH_PENDING_OBJECT))
+
+
+def trash_pending(dbg, cluster, pool):
+    """Flattens the clones of the pending images, removes their snapshots and trashes them, returns their
+    number"""
+    done = []
+    for name in sorted(pending_images(dbg, cluster, pool)):
+        try:
+            for snapshot in rbd_list_snapshots(dbg, cluster, pool, name):
+                # Clones of the image must not lose their data with it
+                for child_pool, child in rbd_children(dbg, cluster, pool, name, snapshot):
+                    flatten_image(dbg, cluster, child_pool, child)
+                if snapshot in rbd_list_snapshots(dbg, cluster, pool, name):
+                    rbd_remove_snapshot(dbg, cluster, pool, name, snapshot)
+            trash_images(dbg, cluster, pool, [name])
+        except Exception:
+            log.error("%s: xcpng.librbd.flatten.trash_pending: Failed to trash %s/%s, left for the next round"
+                      % (dbg, pool, name))
+            log.error(traceback.format_exc())
+            continue
+        done.append(name)
+    if done:
+        rados_omap_set(dbg, cluster, pool, TRASH_PENDING_OBJECT, {}, done)
+    return len(done)
+
+
+def purge_trash(dbg, cluster, pool):
+    """Purges the trash of pool and removes the parent snapshots no clone uses any more"""
+    purged = rbd_trash_purge(dbg, cluster, pool)
+    parents = rados_omap_get(dbg, cluster, pool, TRASH_PARENTS_OBJECT)
+    if parents:
+        trashed = set(rbd_trash_list(dbg, cluster, pool))
+        done = []
+        for name, parent in parents.items():
+            if name in trashed:
+                continue
+            _remove_unused_snapshot(dbg, cluster, json.loads(parent))
+            done.append(name)
+        if done:
+            rados_omap_set(dbg, cluster, pool, TRASH_PARENTS_OBJECT, {}, done)
+    return purged
+
+
+def work_pool(dbg, cluster_name, pool):
+    """Purges the trash and flattens candidates of pool until there is nothing left to do"""
+    cluster = ceph_cluster(dbg, cluster_name)
+    try:
+        cluster.connect()
+        while True:
+            trashed = trash_pending(dbg, cluster, pool)
+            purged = purge_trash(dbg, cluster, pool)
+            candidates = flatten_candidates(dbg, cluster, pool)
+            if not trashed and not purged and not candidates:
+                return
+            for name in candidates:
+                debug("%s: xcpng.librbd.flatten.work_pool: Flattening %s/%s", dbg, pool, name)
+                flatten_image(dbg, cluster, pool, name)
+    finally:
+        cluster.shutdown()
+
+
+def _worker_path(cluster_name, pool, suffix):
+    return os.path.join(NBD_RUN_DIR, "pool-worker-%s-%s.%s" % (cluster_name, pool, suffix))
+
+
+def schedule_pool_worker(dbg, cluster_name, pool):
+    """Starts the worker of pool unless one is running already, which then runs another round"""
+    debug("%s: xcpng.librbd.flatten.schedule_pool_worker: Cluster: %s Pool: %s", dbg, cluster_name, pool)
+    try:
+        _make_run_dir()
+        open(_worker_path(cluster_name, pool, 'pending'), 'w').close()
+        with open(os.devnull, 'r+') as devnull:
+            subprocess.Popen([sys.executable, '-m', __name__, cluster_name, pool],
+                             stdin=devnull, stdout=devnull, stderr=devnull, close_fds=True,
+                             preexec_fn=os.setsid)
+    except Exception:
+        # Clones still work unflattened and trashed images wait, the next request starts the worker again
+        log.error("%s: xcpng.librbd.flatten.schedule_pool_worker: Failed to start worker for %s" % (dbg, pool))
+        log.error(traceback.format_exc())
+
+
+def _make_run_dir():
+    try:
+        os.makedirs(NBD_RUN_DIR)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def main(cluster_name, pool):
+    dbg = "pool-worker-%s-%s" % (cluster_name, pool)
+    pending = _worker_path(cluster_name, pool, 'pending')
+    _make_run_dir()
+    while True:
+        fd = os.open(_worker_path(cluster_name, pool, 'lock'), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as e:
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    return  # the running worker sees the pending flag
+                raise
+            while os.path.exists(pending):
+                os.unlink(pending)
+                try:
+                    work_pool(dbg, cluster_name, pool)
+                except Exception:
+                    log.error("%s: xcpng.librbd.flatten.main: Pool worker failed" % dbg)
+                    log.error(traceback.format_exc())
+        finally:
+            os.close(fd)
+        # Flagged after the last check but before the lock was released, its own worker gave up
+        if not os.path.exists(pending):
+            return
+
+
+if __name__ == '__main__':
+    main(sys.argv[1], sys.argv[2])
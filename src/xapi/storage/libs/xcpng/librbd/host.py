@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+"""Host-local settings and the lock files shared by the plugin processes of a host
+
+Kept apart from the other modules, which all read their settings here, so that trace can import
+it without an import cycle.
+"""
+
+import errno
+import fcntl
+import os
+
+from xapi.storage import log
+
+HOST_CONFIG_FILE = '/etc/sysconfig/rbdsr'  # shell-style KEY=value host settings, e.g. NBDS_MAX=256
+
+
+def get_host_config(dbg, name, default):
+    """Returns setting name from HOST_CONFIG_FILE converted to the type of default"""
+    try:
+        with open(HOST_CONFIG_FILE) as f:
+            for line in f:
+                key, _, value = line.partition('=')
+                if key.strip() != name:
+                    continue
+                value = value.strip().strip('"\'')
+                if isinstance(default, bool):
+                    return value.lower() in ('1', 'y', 'yes', 'true', 'on')
+                return type(default)(value)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    except ValueError:
+        log.error("%s: xcpng.librbd.host.get_host_config: Invalid %s in %s, using %s"
+                  % (dbg, name, HOST_CONFIG_FILE, default))
+    return default
+
+
+def _lock_file(run_dir, path):
+    """Opens and flocks path, the lock is released when the returned descriptor is closed"""
+    if not os.path.isdir(run_dir):
+        try:
+            os.makedirs(run_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    # Daemons started while the lock is held (qemu-nbd -c, qemu-dp) must not inherit it
+    fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+    except Exception:
+        os.close(fd)
+        raise
+    return fd
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""Image layout profile: RBD object size, striping, data pool and features of new images
+
+Like the tuning profile a layout is a dict of LAYOUT_DEFAULTS keys, given in SR device-config (kept
+with the SR, see meta.SR_CONFIG_OBJECT) and overridden by the keys of the VDI meta present when its
+image is created. It is applied when an image is created or cloned; existing images keep their layout.
+
+Bigger objects and wide stripes suit large sequential I/O (backups, media), small objects small
+random I/O. benchmarks/bench_layout.py compares them. An erasure coded 'rbd-data-pool' keeps the data
+and the image metadata stays in the SR pool, which must be replicated.
+"""
+
+from rbd import RBD_FEATURE_LAYERING, RBD_FEATURE_STRIPINGV2, RBD_FEATURE_EXCLUSIVE_LOCK, RBD_FEATURE_OBJECT_MAP, \
+                RBD_FEATURE_FAST_DIFF, RBD_FEATURE_DEEP_FLATTEN
+
+from xapi.storage.libs.xcpng.librbd.rbd_utils import RBD_IMAGE_ORDER, RBD_DEFAULT_FEATURES, RBD_KRBD_FEATURES
+
+LAYOUT_DEFAULTS = {
+    'rbd-object-size': str(1 << RBD_IMAGE_ORDER),
+    'rbd-stripe-unit': '0',  # 0 is the object size
+    'rbd-stripe-count': '1',
+    'rbd-data-pool': '',
+    'rbd-features': '',  # '' is RBD_DEFAULT_FEATURES, or RBD_KRBD_FEATURES on the krbd datapath
+}
+
+MIN_OBJECT_ORDER = 12  # 4 KiB
+MAX_OBJECT_ORDER = 25  # 32 MiB
+
+FEATURES = {
+    'layering': RBD_FEATURE_LAYERING,
+    'striping': RBD_FEATURE_STRIPINGV2,
+    'exclusive-lock': RBD_FEATURE_EXCLUSIVE_LOCK,
+    'object-map': RBD_FEATURE_OBJECT_MAP,
+    'fast-diff': RBD_FEATURE_FAST_DIFF,
+    'deep-flatten': RBD_FEATURE_DEEP_FLATTEN,
+}
+
+
+def _order(value):
+    size = int(value)
+    order = size.bit_length() - 1
+    if size != 1 << order or not MIN_OBJECT_ORDER <= order <= MAX_OBJECT_ORDER:
+        return None
+    return order
+
+
+def get_layout_profile(dbg, configuration):
+    """Returns the layout keys of configuration, raises Exception on an invalid value"""
+    profile = {}
+    for key in LAYOUT_DEFAULTS:
+        if key not in configuration:
+            continue
+        value = str(configuration[key]).strip()
+        if key == 'rbd-data-pool':
+            pass
+        elif key == 'rbd-features':
+            value = value.lower()
+            unknown = [name for name in value.split(',') if name and name not in FEATURES]
+            if unknown:
+                raise Exception("Invalid %s '%s', expected a comma separated list of: %s"
+                                % (key, configuration[key], ', '.join(sorted(FEATURES))))
+        elif not value.isdigit():
+            raise Exception("Invalid %s '%s', expected a number" % (key, configuration[key]))
+        elif key == 'rbd-object-size' and _order(value) is None:
+            raise Exception("Invalid %s '%s', expected a power of two from %s to %s bytes"
+                            % (key, configuration[key], 1 << MIN_OBJECT_ORDER, 1 << MAX_OBJECT_ORDER))
+        profile[key] = value
+    return profile
+
+
+def merge_layout_profiles(*profiles):
+    """Returns LAYOUT_DEFAULTS updated with each of profiles in turn, raises Exception if the striping
+    doesn't fit the object size"""
+    merged = dict(LAYOUT_DEFAULTS)
+    for profile in profiles:
+        merged.update(profile)
+    object_size = int(merged['rbd-object-size'])
+    stripe_unit = int(merged['rbd-stripe-unit'])
+    if stripe_unit and (stripe_unit > object_size or object_size % stripe_unit):
+        raise Exception("rbd-stripe-unit %s must divide rbd-object-size %s" % (stripe_unit, object_size))
+    if int(merged['rbd-stripe-count']) < 1:
+        raise Exception("rbd-stripe-count must be at least 1")
+    return merged
+
+
+def object_size(profile):
+    return 1 << _order(profile['rbd-object-size'])
+
+
+def rbd_create_options(profile, krbd=False):
+    """Returns the keyword arguments of rbd_create()/rbd_clone() for the layout"""
+    if profile['rbd-features']:
+        features = 0
+        for name in profile['rbd-features'].split(','):
+            if name:
+                features |= FEATURES[name]
+    else:
+        features = RBD_KRBD_FEATURES if krbd else RBD_DEFAULT_FEATURES
+    stripe_unit = int(profile['rbd-stripe-unit']) or object_size(profile)
+    stripe_count = int(profile['rbd-stripe-count'])
+    if stripe_unit != object_size(profile) or stripe_count > 1:
+        features |= RBD_FEATURE_STRIPINGV2
+    else:
+        stripe_unit = stripe_count = 0
+    return {'features': features,
+            'order': _order(profile['rbd-object-size']),
+            'stripe_unit': stripe_unit,
+            'stripe_count': stripe_count,
+            'data_pool': profile['rbd-data-pool'] or None}
@@ -1,18 +1,67 @@
 #!/usr/bin/env python
 
+import os
+import sys
+import threading
 import traceback
 
-from time import time, sleep
+from random import uniform
+from time import time
+from xapi.storage import log
 from xapi.storage.libs.xcpng.meta import LocksOpsMgr as _LocksOpsMgr_
 from xapi.storage.libs.xcpng.librbd.rbd_utils import ceph_cluster, rbd_lock, rbd_unlock, ImageBusy, ImageExists, \
-                                                     is_locked
+                                                     is_locked, RBDLockWatch, rbd_lock_notify
 from xapi.storage.libs.xcpng.utils import get_sr_uuid_by_uri, get_vdi_uuid_by_uri, get_cluster_name_by_uri, \
                                           get_sr_name_by_uri, get_vdi_name_by_uri
+from xapi.storage.libs.xcpng.librbd.trace import debug, observe
+
+# Waiters sleep a random time up to a delay that doubles from MIN to MAX after each failed attempt.
+# A release notification from the holder cuts the sleep short.
+LOCK_RETRY_MIN_DELAY = 0.05
+LOCK_RETRY_MAX_DELAY = 1.0
+
+# SMAPIv3 commands that only read the SR or VDI they lock
+READ_ONLY_COMMANDS = ('SR.stat', 'SR.ls', 'Volume.stat')
+
+
+def _command_read_only():
+    """Whether the command being run is in READ_ONLY_COMMANDS
+
+    sys.argv[0] is the command link, in a plugin process as in the daemon, which keeps sys.argv per
+    command thread.
+    """
+    return len(sys.argv) > 0 and os.path.basename(sys.argv[0]) in READ_ONLY_COMMANDS
+
 
 class LocksOpsMgr(_LocksOpsMgr_):
+    """Exclusive locks for operations that modify an SR or VDI, shared ones for read-only operations
+
+    The common xcpng layer calls lock(dbg, uri) for every command, so unless read_only is given the
+    lock is shared for READ_ONLY_COMMANDS and exclusive for all others. Readers on any number of
+    hosts hold the lock together and only wait for, or hold up, a writer. A VDI lock of either kind
+    only waits for an exclusive SR lock, so SR readers don't serialise VDI operations.
+
+    The daemon runs commands in threads, so the lock tables of the instance are guarded by a mutex.
+    """
+
+    def __init__(self):
+        _LocksOpsMgr_.__init__(self)
+        self.__readers = {}
+        self.__guard = threading.Lock()
 
-    def lock(self, dbg, uri, timeout=10):
-        log.debug("%s: xcpng.librbd.meta.MetaDBOpeations.lock: uri: %s timeout: %s" % (dbg, uri, timeout))
+    def _join_readers(self, lock_uuid):
+        """Shares the read-only lock this process already holds on lock_uuid, if any"""
+        with self.__guard:
+            if lock_uuid in self.__readers:
+                self.__readers[lock_uuid] += 1
+                return True
+            return False
+
+    def lock(self, dbg, uri, timeout=10, read_only=None):
+        if read_only is None:
+            read_only = _command_read_only()
+        debug("%s: xcpng.librbd.meta.MetaDBOpeations.lock: uri: %s timeout: %s read_only: %s",
+              dbg, uri, timeout, read_only)
 
         sr_uuid = get_sr_uuid_by_uri(dbg, uri)
         vdi_uuid = get_vdi_uuid_by_uri(dbg, uri)
@@ -25,54 +74,108 @@ class LocksOpsMgr(_LocksOpsMgr_):
             lock_uuid = sr_uuid
             image_name = '__lock__'
 
+        if read_only and self._join_readers(lock_uuid):
+            # Already shared by another read-only operation of this process
+            return
+
         start_time = time()
 
         lh = [None, None, None]
         lh[0] = ceph_cluster(dbg, get_cluster_name_by_uri(dbg, uri))
+        lh[0].connect()
 
-        if is_locked(dbg, lh[0], pool_name, '__lock__'):
-            # SR is locked
-            raise ImageBusy
+        try:
+            if vdi_uuid is not None and is_locked(dbg, lh[0], pool_name, '__lock__', exclusive=True):
+                # SR is locked
+                raise ImageBusy
+        except Exception:
+            lh[0].shutdown()
+            raise
 
+        watch = None
+        joined = False
+        delay = LOCK_RETRY_MIN_DELAY
         try:
             while True:
+                if watch is not None:
+                    watch.clear()
                 try:
-                    if lock_uuid in self.__lhs:
-                        raise ImageExists
+                    joined = read_only and self._join_readers(lock_uuid)
+                    if joined:
+                        break
+                    with self.__guard:
+                        if lock_uuid in self.__lhs:
+                            raise ImageExists
 
-                    lh[0].connect()
                     lh[1], lh[2] = rbd_lock(dbg,
                                             lh[0],
                                             pool_name,
-                                            image_name)
-                    self.__lhs[lock_uuid] = lh
+                                            image_name,
+                                            shared=read_only)
+                    with self.__guard:
+                        joined = read_only and lock_uuid in self.__readers
+                        if joined:
+                            self.__readers[lock_uuid] += 1
+                        else:
+                            self.__lhs[lock_uuid] = lh
+                            if read_only:
+                                self.__readers[lock_uuid] = 1
                     break
                 except Exception as e:
-                    if time() - start_time >= timeout:
+                    remaining = timeout - (time() - start_time)
+                    if remaining <= 0:
                         log.error("%s: xcpng.librbd.meta.MetaDBOpeations.lock: Failed to lock: uri: %s" % (dbg, uri))
                         raise Exception(e)
-                    sleep(1)
-                    pass
+                    if watch is None:
+                        # Retry right after subscribing, the holder may have released the lock meanwhile
+                        watch = RBDLockWatch(dbg, lh[0], pool_name, image_name)
+                        continue
+                    watch.wait(min(remaining, uniform(0, delay)))
+                    delay = min(delay * 2, LOCK_RETRY_MAX_DELAY)
+            observe(dbg, 'lock_wait', 'ok', time() - start_time)
+            if joined:
+                # Another thread of this process took the shared lock meanwhile, ours isn't needed
+                try:
+                    if lh[2] is not None:
+                        rbd_unlock(dbg, lh)
+                except Exception:
+                    log.error("%s: xcpng.librbd.meta.MetaDBOpeations.lock: Failed to release a redundant shared "
+                              "lock: uri: %s" % (dbg, uri))
+                    log.error(traceback.format_exc())
+                lh[0].shutdown()
         except Exception as e:
+            observe(dbg, 'lock_wait', 'error', time() - start_time)
             log.error("%s: xcpng.librbd.meta.MetaDBOpeations.lock: Failed to lock: uri: %s"
                       % (dbg, uri))
             log.error(traceback.format_exc())
             lh[0].shutdown()
             raise Exception(e)
+        finally:
+            if watch is not None:
+                watch.close()
 
     def unlock(self, dbg, uri):
-        log.debug("%s: xcpng.librbd.meta.MetaDBOpeations.unlock: uri: %s" % (dbg, uri))
+        debug("%s: xcpng.librbd.meta.MetaDBOpeations.unlock: uri: %s", dbg, uri)
 
         sr_uuid = get_sr_uuid_by_uri(dbg, uri)
         vdi_uuid = get_vdi_uuid_by_uri(dbg, uri)
 
         if vdi_uuid is not None:
             lock_uuid = vdi_uuid
+            image_name = get_vdi_name_by_uri(dbg, uri)
         else:
             lock_uuid = sr_uuid
+            image_name = '__lock__'
 
-        if lock_uuid in self.__lhs:
-            lh = self.__lhs[lock_uuid]
+        with self.__guard:
+            if lock_uuid in self.__readers:
+                self.__readers[lock_uuid] -= 1
+                if self.__readers[lock_uuid] > 0:
+                    return
+                del self.__readers[lock_uuid]
+            lh = self.__lhs.pop(lock_uuid, None)
+
+        if lh is not None:
             rbd_unlock(dbg, lh)
-            lh[0].shutdown()
-            del self.__lhs[lock_uuid]
\ No newline at end of file
+            rbd_lock_notify(dbg, lh[0], get_sr_name_by_uri(dbg, uri), image_name)
+            lh[0].shutdown()
\ No newline at end of file
@@ -1,15 +1,172 @@
 #!/usr/bin/env python
 
+import threading
 import traceback
 
-from struct import pack, unpack
+from json import dumps, loads
+from struct import unpack
 from xapi.storage import log
 from xapi.storage.libs.xcpng.meta import MetaDBOperations as _MetaDBOperations_
 from xapi.storage.libs.xcpng.utils import get_sr_name_by_uri, get_cluster_name_by_uri
-from xapi.storage.libs.xcpng.librbd.rbd_utils import ceph_cluster, rbd_create, rbd_write, rbd_read, rbd_remove, \
-                                                     rbd_lock, rbd_unlock
+from xapi.storage.libs.xcpng.librbd.rbd_utils import ceph_cluster, rbd_create, rbd_read, rbd_remove, rbd_exists, \
+                                                     rados_omap_get, rados_omap_get_versioned, \
+                                                     rados_omap_set, rados_remove, OmapCompareFailed
+from xapi.storage.libs.xcpng.librbd.trace import debug
 
 CEPH_CLUSTER_TAG = 'cluster'
+VDI_KEYS_TAG = 'keys'  # Volume.set/unset key-values in the VDI meta
+
+# SR settings given at SR.create/SR.attach, kept in the omap of their own small object so that
+# readers like the datapath don't have to load the MetaDB
+SR_CONFIG_OBJECT = '__config__'
+
+# MetaDB is kept in the omap of one RADOS object: every document of every table is its own
+# '<table>/<doc_id>' key, so an update only writes the documents that changed.
+META_OBJECT = '__meta_db__'
+META_FORMAT_KEY = '__format__'
+META_TABLES_KEY = '__tables__'
+META_GENERATION_KEY = '__generation__'  # bumped by every write, which only applies if it is unchanged
+META_FORMAT_VERSION = '1'
+LEGACY_META_IMAGE = '__meta__'  # v3.0 layout: '!I%ss' length-prefixed JSON blob in an RBD image
+
+
+def _split_db(db):
+    """Splits a TinyDB JSON document into omap key/values"""
+    shards = {META_TABLES_KEY: dumps(sorted(db.keys()))}
+    for table, docs in db.items():
+        for doc_id, doc in docs.items():
+            shards["%s/%s" % (table, doc_id)] = dumps(doc, sort_keys=True)
+    return shards
+
+
+def _join_db(shards):
+    """Builds the TinyDB JSON document back from omap values without parsing them"""
+    tables = dict((table, []) for table in loads(shards.get(META_TABLES_KEY, '[]')))
+    for key, value in shards.items():
+        if key.startswith('__'):
+            continue
+        table, doc_id = key.rsplit('/', 1)
+        tables.setdefault(table, []).append("%s: %s" % (dumps(doc_id), value))
+    return "{%s}" % ", ".join("%s: {%s}" % (dumps(table), ", ".join(docs)) for table, docs in tables.items())
+
+
+def _diff_db(old_db, new_db):
+    """Returns omap keys to set and to remove to turn old_db into new_db"""
+    changed = {}
+    removed = []
+    for table, docs in new_db.items():
+        old_docs = old_db.get(table, {})
+        for doc_id, doc in docs.items():
+            if old_docs.get(doc_id) != doc:
+                changed["%s/%s" % (table, doc_id)] = dumps(doc, sort_keys=True)
+    for table, old_docs in old_db.items():
+        docs = new_db.get(table, {})
+        removed.extend("%s/%s" % (table, doc_id) for doc_id in old_docs if doc_id not in docs)
+    if sorted(old_db.keys()) != sorted(new_db.keys()):
+        changed[META_TABLES_KEY] = dumps(sorted(new_db.keys()))
+    return changed, removed
+
+
+def _apply_db(db, changed, removed):
+    """Returns a copy of db with the omap changes of _diff_db() applied"""
+    tables = loads(changed[META_TABLES_KEY]) if META_TABLES_KEY in changed else list(db.keys())
+    new_db = dict((table, dict(db.get(table, {}))) for table in tables)
+    for key, value in changed.items():
+        if not key.startswith('__'):
+            table, doc_id = key.rsplit('/', 1)
+            new_db.setdefault(table, {})[doc_id] = loads(value)
+    for key in removed:
+        table, doc_id = key.rsplit('/', 1)
+        new_db.get(table, {}).pop(doc_id, None)
+    return new_db
+
+
+def _next_generation(generation):
+    return str(int(generation or 0) + 1)
+
+
+class _CachedDB(object):
+
+    def __init__(self, generation, json=None, db=None):
+        self.generation = generation
+        self.json = json
+        self.db = db
+
+    def get_json(self):
+        if self.json is None:
+            self.json = dumps(self.db)
+        return self.json
+
+    def get_db(self):
+        if self.db is None:
+            self.db = loads(self.json)
+        return self.db
+
+
+class MetaDBCache(object):
+    """Process-wide cache of loaded MetaDBs keyed by (cluster, pool)
+
+    An entry is valid while META_GENERATION_KEY of the META_OBJECT it was read from is unchanged.
+    Every dump bumps it, so checking it costs one small omap read instead of reading the whole DB.
+
+    Dumps of the process are serialized per MetaDB, each one applied on top of the last, so only a
+    write of another host makes one retry.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.__lock = threading.Lock()
+        self.__entries = {}
+        self.__writers = {}
+        self.__loaded = threading.local()  # the entry each thread last loaded, the base of its dump
+
+    def writer(self, key):
+        """Returns the lock serializing the dumps of the process to a MetaDB"""
+        with self.__lock:
+            return self.__writers.setdefault(key, threading.Lock())
+
+    def loaded(self, key, entry=None):
+        """Records entry as the copy the thread loaded, returns the one recorded"""
+        if not hasattr(self.__loaded, 'entries'):
+            self.__loaded.entries = {}
+        if entry is not None:
+            self.__loaded.entries[key] = entry
+        return self.__loaded.entries.get(key)
+
+    def peek(self, key):
+        with self.__lock:
+            return self.__entries.get(key)
+
+    def get(self, key, generation):
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None and entry.generation is not None and entry.generation == generation:
+                self.hits += 1
+                return entry
+            if entry is not None:
+                self.invalidations += 1
+                del self.__entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, entry):
+        with self.__lock:
+            self.__entries[key] = entry
+
+    def drop(self, key):
+        with self.__lock:
+            if self.__entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def stats(self):
+        with self.__lock:
+            return {'hits': self.hits, 'misses': self.misses, 'invalidations': self.invalidations,
+                    'entries': len(self.__entries)}
+
+
+META_CACHE = MetaDBCache()
 
 
 class MetaDBOperations(_MetaDBOperations_):
@@ -18,16 +175,18 @@ class MetaDBOperations(_MetaDBOperations_):
         self.lh = None
 
     def create(self, dbg, uri, db, size=8388608):
-        log.debug("%s: xcpng.librbd.meta.MetaDBOpeations.create: uri: %s" % (dbg, uri))
+        debug("%s: xcpng.librbd.meta.MetaDBOpeations.create: uri: %s", dbg, uri)
 
         cluster = ceph_cluster(dbg, get_cluster_name_by_uri(dbg, uri))
 
         try:
             cluster.connect()
-            rbd_create(dbg, cluster, get_sr_name_by_uri(dbg, uri), '__meta__', size)  # default size = 8388608 = 8Mb
             rbd_create(dbg, cluster, get_sr_name_by_uri(dbg, uri), '__lock__', 0)
-            length = len(db)
-            rbd_write(dbg, cluster, get_sr_name_by_uri(dbg, uri), '__meta__', pack("!I%ss" % length, length, db), 0, length+4)
+            shards = _split_db(loads(db))
+            shards[META_FORMAT_KEY] = META_FORMAT_VERSION
+            shards[META_GENERATION_KEY] = _next_generation(None)
+            rados_omap_set(dbg, cluster, get_sr_name_by_uri(dbg, uri), META_OBJECT, shards)
+            META_CACHE.put(self._cache_key(dbg, uri), _CachedDB(shards[META_GENERATION_KEY], json=db))
         except Exception as e:
             log.error("%s: xcpng.librbd.meta.MetaDBOpeations.create: Failed to create MetaDB: uri: %s"
                       % (dbg, uri))
@@ -37,15 +196,17 @@ class MetaDBOperations(_MetaDBOperations_):
             cluster.shutdown()
 
     def destroy(self, dbg, uri):
-        log.debug("%s: xcpng.librbd.meta.MetaDBOpeations.destroy: uri: %s" % (dbg, uri))
+        debug("%s: xcpng.librbd.meta.MetaDBOpeations.destroy: uri: %s", dbg, uri)
 
         cluster = ceph_cluster(dbg, get_cluster_name_by_uri(dbg, uri))
 
         try:
             cluster.connect()
-            rbd_remove(dbg, cluster, get_sr_name_by_uri(dbg, uri), '__meta__')
+            rados_remove(dbg, cluster, get_sr_name_by_uri(dbg, uri), META_OBJECT)
+            if rbd_exists(dbg, cluster, get_sr_name_by_uri(dbg, uri), LEGACY_META_IMAGE):
+                rbd_remove(dbg, cluster, get_sr_name_by_uri(dbg, uri), LEGACY_META_IMAGE)
             rbd_remove(dbg, cluster, get_sr_name_by_uri(dbg, uri), '__lock__')
-
+            META_CACHE.drop(self._cache_key(dbg, uri))
         except Exception as e:
             log.error("%s: xcpng.librbd.meta.MetaDBOpeations.destroy: Failed to destroy MetaDB: uri: %s"
                       % (dbg, uri))
@@ -55,15 +216,29 @@ class MetaDBOperations(_MetaDBOperations_):
             cluster.shutdown()
 
     def load(self, dbg, uri):
-        log.debug("%s: xcpng.libsbd.meta.MetaDBOpeations.load: uri: %s" % (dbg, uri))
+        debug("%s: xcpng.libsbd.meta.MetaDBOpeations.load: uri: %s", dbg, uri)
 
         cluster = ceph_cluster(dbg, get_cluster_name_by_uri(dbg, uri))
 
         try:
             cluster.connect()
-            length = unpack('!I', rbd_read(dbg, cluster, get_sr_name_by_uri(dbg, uri), '__meta__', 0, 4))[0]
-            data = unpack('!%ss' % length, rbd_read(dbg, cluster, get_sr_name_by_uri(dbg, uri), '__meta__', 4, length))[0]
-            return data
+            key = self._cache_key(dbg, uri)
+            generation = None
+            if META_CACHE.peek(key) is not None:
+                generation = rados_omap_get(dbg, cluster, get_sr_name_by_uri(dbg, uri), META_OBJECT,
+                                            [META_GENERATION_KEY]).get(META_GENERATION_KEY)
+            entry = META_CACHE.get(key, generation)
+            if entry is not None:
+                META_CACHE.loaded(key, entry)
+                return entry.get_json()
+
+            shards, generation = self._read(dbg, cluster, uri)
+            if META_FORMAT_KEY not in shards:
+                shards, generation = self._migrate(dbg, cluster, uri)
+            entry = _CachedDB(generation, json=_join_db(shards))
+            META_CACHE.put(key, entry)
+            META_CACHE.loaded(key, entry)
+            return entry.json
         except Exception as e:
             log.error("%s: xcpng.librbd.meta.MetaDBOpeations.load: Failed to load MetaDB: uri: %s"
                       % (dbg, uri))
@@ -73,24 +248,105 @@ class MetaDBOperations(_MetaDBOperations_):
             cluster.shutdown()
 
     def dump(self, dbg, uri, json):
-        log.debug("%s: xcpng.libsbd.meta.MetaDBOpeations.dump: uri: %s" % (dbg, uri))
+        debug("%s: xcpng.libsbd.meta.MetaDBOpeations.dump: uri: %s", dbg, uri)
 
         cluster = ceph_cluster(dbg, get_cluster_name_by_uri(dbg, uri))
 
         try:
-            length = len(json)
             cluster.connect()
-            rbd_write(dbg,
-                      cluster,
-                      get_sr_name_by_uri(dbg, uri),
-                      '__meta__',
-                      pack("!I%ss" % length, length, json),
-                      0,
-                      length + 4)
+            key = self._cache_key(dbg, uri)
+            db = loads(json)
+            with META_CACHE.writer(key):
+                # json is the copy this thread loaded with its changes, only those are written
+                base = META_CACHE.loaded(key) or META_CACHE.peek(key)
+                if base is None:
+                    shards, generation = self._read(dbg, cluster, uri)
+                    base = _CachedDB(generation, json=_join_db(shards))
+                changed, removed = _diff_db(base.get_db(), db)
+                if not changed and not removed:
+                    return
+                changed[META_FORMAT_KEY] = META_FORMAT_VERSION
+                current = META_CACHE.peek(key) or base
+                while True:
+                    generation = changed[META_GENERATION_KEY] = _next_generation(current.generation)
+                    # A MetaDB written before generations were kept has none to compare with
+                    expected = (META_GENERATION_KEY, current.generation) if current.generation is not None else None
+                    try:
+                        rados_omap_set(dbg, cluster, get_sr_name_by_uri(dbg, uri), META_OBJECT, changed, removed,
+                                       expected)
+                        break
+                    except OmapCompareFailed:
+                        # Another host wrote since our copy was read, our changes go on top of its own
+                        debug("%s: xcpng.librbd.meta.MetaDBOpeations.dump: uri: %s MetaDB changed since it was "
+                              "read", dbg, uri)
+                        shards, current_generation = self._read(dbg, cluster, uri)
+                        current = _CachedDB(current_generation, json=_join_db(shards))
+                if current is base:
+                    entry = _CachedDB(generation, json=json, db=db)
+                else:
+                    entry = _CachedDB(generation, db=_apply_db(current.get_db(), changed, removed))
+                META_CACHE.put(key, entry)
+                META_CACHE.loaded(key, entry)
         except Exception as e:
             log.error("%s: xcpng.librbd.meta.MetaDBOpeations.dump: Failed to dump MetaDB: uri: %s"
                       % (dbg, uri))
             log.error(traceback.format_exc())
             raise Exception(e)
         finally:
-            cluster.shutdown()
\ No newline at end of file
+            cluster.shutdown()
+
+    def _migrate(self, dbg, cluster, uri):
+        """Converts MetaDB kept by v3.0 in the __meta__ image to the omap layout.
+
+        The image is left in place so that a downgrade still finds its data, destroy() removes it. Only
+        the first host to migrate writes the omap, the others use it as they would after a dump()
+        """
+        debug("%s: xcpng.librbd.meta.MetaDBOpeations._migrate: uri: %s", dbg, uri)
+
+        pool = get_sr_name_by_uri(dbg, uri)
+        if not rbd_exists(dbg, cluster, pool, LEGACY_META_IMAGE):
+            raise Exception("MetaDB for %s doesn't exist" % uri)
+
+        length = unpack('!I', rbd_read(dbg, cluster, pool, LEGACY_META_IMAGE, 0, 4))[0]
+        data = unpack('!%ss' % length, rbd_read(dbg, cluster, pool, LEGACY_META_IMAGE, 4, length))[0]
+        shards = _split_db(loads(data))
+        shards[META_FORMAT_KEY] = META_FORMAT_VERSION
+        shards[META_GENERATION_KEY] = _next_generation(None)
+        try:
+            # Another host may have migrated and written since, its omap must not be overwritten
+            rados_omap_set(dbg, cluster, pool, META_OBJECT, shards, expect=(META_GENERATION_KEY, None))
+        except OmapCompareFailed:
+            debug("%s: xcpng.librbd.meta.MetaDBOpeations._migrate: uri: %s MetaDB was migrated by another host",
+                  dbg, uri)
+            shards, generation = self._read(dbg, cluster, uri)
+            if META_FORMAT_KEY not in shards:
+                raise Exception("MetaDB for %s exists but has no format" % uri)
+            return shards, generation
+        debug("%s: xcpng.librbd.meta.MetaDBOpeations._migrate: Migrated MetaDB of %s to omap: %s keys",
+              dbg, uri, len(shards))
+        return shards, shards[META_GENERATION_KEY]
+
+    def _read(self, dbg, cluster, uri):
+        """Returns the omap of the MetaDB and its generation"""
+        return rados_omap_get_versioned(dbg, cluster, get_sr_name_by_uri(dbg, uri), META_OBJECT,
+                                        version_key=META_GENERATION_KEY)
+
+    def _cache_key(self, dbg, uri):
+        return get_cluster_name_by_uri(dbg, uri), get_sr_name_by_uri(dbg, uri)
+
+
+def get_sr_config(dbg, uri):
+    debug("%s: xcpng.librbd.meta.get_sr_config: uri: %s", dbg, uri)
+
+    cluster = ceph_cluster(dbg, get_cluster_name_by_uri(dbg, uri))
+
+    try:
+        cluster.connect()
+        return rados_omap_get(dbg, cluster, get_sr_name_by_uri(dbg, uri), SR_CONFIG_OBJECT)
+    except Exception as e:
+        log.error("%s: xcpng.librbd.meta.get_sr_config: Failed to get SR config: uri: %s" % (dbg, uri))
+        log.error(traceback.format_exc())
+        raise Exception(e)
+    finally:
+        cluster.shutdown()
+
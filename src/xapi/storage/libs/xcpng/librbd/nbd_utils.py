@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+"""NBD plumbing of the qdisk datapath: host-wide /dev/nbdN allocation and the shared NBD server
+
+Free devices are tracked in a bitmap file shared by every plugin process of the host. The file is
+flock'ed while a device is picked, so concurrent attaches never get the same device, and the device
+is connected under a lock of its own, so concurrent attaches connect theirs in parallel.
+Connection state comes from sysfs (/sys/block/nbdN/pid exists while a client is connected) instead
+of running nbd-client -check for every device.
+
+With NBD_SERVER=yes in HOST_CONFIG_FILE, images are not served by a qemu-nbd process each. One
+qemu-dp daemon per host and cluster exports all of them over a unix socket, see NBDServer.
+"""
+
+import errno
+import fcntl
+import json
+import os
+import socket
+import traceback
+
+from contextlib import contextmanager
+from hashlib import md5
+from time import sleep, time
+from xapi.storage import log
+from xapi.storage.libs.xcpng.utils import call
+from xapi.storage.libs.xcpng.librbd.host import get_host_config, _lock_file
+from xapi.storage.libs.xcpng.librbd.trace import debug
+
+NBDS_MAX = 32  # devices created when the nbd module is loaded, see HOST_CONFIG_FILE
+NBD_RUN_DIR = '/var/run/rbdsr'
+NBD_BITMAP_FILE = 'nbd.bitmap'
+NBD_DEVICE_LOCK_FILE = 'nbd%s.lock'  # held while the device is being connected
+SYS_BLOCK_DIR = '/sys/block'
+SYS_NBD_MODULE_DIR = '/sys/module/nbd'
+QEMU_DP = '/usr/lib64/qemu-dp-xcpng/bin/qemu-dp'
+NBD_CLIENT = '/usr/sbin/nbd-client'
+NBD_SERVER_START_TIMEOUT = 10
+
+
+def load_nbd_module(dbg):
+    """Loads the nbd module unless it is loaded already and returns the number of its devices"""
+    if not os.path.exists(SYS_NBD_MODULE_DIR):
+        call(dbg, ['/usr/sbin/modprobe', 'nbd', "nbds_max=%s" % get_host_config(dbg, 'NBDS_MAX', NBDS_MAX)])
+    with open(os.path.join(SYS_NBD_MODULE_DIR, 'parameters', 'nbds_max')) as f:
+        return int(f.read().strip())
+
+
+def is_nbd_device_connected(dbg, device_no):
+    return os.path.exists(os.path.join(SYS_BLOCK_DIR, "nbd%s" % device_no, 'pid'))
+
+
+class NBDAllocator(object):
+
+    def __init__(self, run_dir=NBD_RUN_DIR):
+        self.path = os.path.join(run_dir, NBD_BITMAP_FILE)
+        self.run_dir = run_dir
+
+    @contextmanager
+    def _locked_bitmap(self, dbg, nbds_max):
+        fd = _lock_file(self.run_dir, self.path)
+        try:
+            size = (nbds_max + 7) // 8
+            bitmap = bytearray(os.read(fd, size).ljust(size, b'\0')[:size])
+            original = bytearray(bitmap)
+            yield bitmap
+            if bitmap != original:
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.write(fd, bytes(bitmap))
+                os.ftruncate(fd, size)
+        finally:
+            os.close(fd)
+
+    def _device_lock_path(self, device_no):
+        return os.path.join(self.run_dir, NBD_DEVICE_LOCK_FILE % device_no)
+
+    def _is_connecting(self, device_no):
+        """Tells whether another allocation holds the device and is still connecting it"""
+        try:
+            fd = os.open(self._device_lock_path(device_no), os.O_RDWR)
+        except OSError:
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return False
+        except IOError as e:
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return True
+            raise
+        finally:
+            os.close(fd)
+
+    def _find_free(self, dbg, bitmap, nbds_max):
+        for byte_no, byte in enumerate(bitmap):
+            if byte == 0xff:
+                continue
+            for bit in range(8):
+                device_no = byte_no * 8 + bit
+                if device_no >= nbds_max:
+                    return None
+                if byte & (1 << bit):
+                    continue
+                if is_nbd_device_connected(dbg, device_no):
+                    # Connected by something that doesn't use this allocator
+                    bitmap[byte_no] |= 1 << bit
+                    continue
+                return device_no
+        return None
+
+    def _reclaim(self, dbg, bitmap, nbds_max):
+        """Clears the bits of devices that are no longer connected, e.g. after a crash"""
+        reclaimed = 0
+        for device_no in range(nbds_max):
+            byte_no, bit = divmod(device_no, 8)
+            if bitmap[byte_no] & (1 << bit) and not is_nbd_device_connected(dbg, device_no) and \
+                    not self._is_connecting(device_no):
+                bitmap[byte_no] &= ~(1 << bit) & 0xff
+                reclaimed += 1
+        if reclaimed:
+            debug("%s: xcpng.librbd.nbd_utils.NBDAllocator._reclaim: Reclaimed %s stale devices", dbg, reclaimed)
+
+    @contextmanager
+    def allocate(self, dbg):
+        """Yields a free NBD device path, which stays allocated if the block succeeds
+
+        The block is expected to connect the device. The device is marked in the bitmap before the
+        block runs, so other allocations skip it, and its device lock is held until the block
+        returns, so it isn't reclaimed while it isn't connected yet. The bitmap itself is only
+        locked to pick the device, attaches don't wait for each other's connects.
+        """
+        nbds_max = load_nbd_module(dbg)
+        with self._locked_bitmap(dbg, nbds_max) as bitmap:
+            device_no = self._find_free(dbg, bitmap, nbds_max)
+            if device_no is None:
+                self._reclaim(dbg, bitmap, nbds_max)
+                device_no = self._find_free(dbg, bitmap, nbds_max)
+            if device_no is None:
+                raise Exception('There are no more free NBD devices')
+            device_fd = _lock_file(self.run_dir, self._device_lock_path(device_no))
+            byte_no, bit = divmod(device_no, 8)
+            bitmap[byte_no] |= 1 << bit
+        nbd_device = "/dev/nbd%s" % device_no
+        debug("%s: xcpng.librbd.nbd_utils.NBDAllocator.allocate: %s", dbg, nbd_device)
+        try:
+            try:
+                yield nbd_device
+            finally:
+                os.close(device_fd)
+        except Exception:
+            self.release(dbg, nbd_device)
+            raise
+
+    def release(self, dbg, nbd_device):
+        debug("%s: xcpng.librbd.nbd_utils.NBDAllocator.release: %s", dbg, nbd_device)
+        try:
+            device_no = int(nbd_device[len('/dev/nbd'):])
+            with self._locked_bitmap(dbg, load_nbd_module(dbg)) as bitmap:
+                byte_no, bit = divmod(device_no, 8)
+                if byte_no < len(bitmap):
+                    bitmap[byte_no] &= ~(1 << bit) & 0xff
+        except Exception:
+            # A leaked bit is reclaimed by the next allocation that runs out of devices
+            log.error("%s: xcpng.librbd.nbd_utils.NBDAllocator.release: Failed to release %s"
+                      % (dbg, nbd_device))
+            log.error(traceback.format_exc())
+
+
+class QMPClient(object):
+    """Minimal QEMU Machine Protocol client, enough to manage block nodes and NBD exports"""
+
+    def __init__(self, dbg, path):
+        self.dbg = dbg
+        self.path = path
+        self.sock = None
+        self.f = None
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+        self.f = self.sock.makefile('rb')
+        self._read()  # greeting
+        self.execute('qmp_capabilities')
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+        if self.sock is not None:
+            self.sock.close()
+        self.f = self.sock = None
+
+    def _read(self):
+        while True:
+            line = self.f.readline()
+            if not line:
+                raise Exception("QMP connection %s closed" % self.path)
+            message = json.loads(line.decode('utf-8'))
+            if 'event' not in message:
+                return message
+
+    def execute(self, command, arguments=None):
+        debug("%s: xcpng.librbd.nbd_utils.QMPClient.execute: %s %s", self.dbg, command, arguments)
+        request = {'execute': command}
+        if arguments is not None:
+            request['arguments'] = arguments
+        self.sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        reply = self._read()
+        if 'error' in reply:
+            raise Exception("QMP %s failed: %s" % (command, reply['error'].get('desc', reply['error'])))
+        return reply.get('return')
+
+
+class NBDServer(object):
+    """qemu-dp daemon that serves the RBD images of one cluster as named exports of one NBD server
+
+    All images share one librbd client and one Ceph session instead of a qemu-nbd process each.
+    Exports are added and removed over the daemon's QMP socket. QMP serves a single client at a
+    time, so every session is serialised with an flock on <cluster>.lock.
+    """
+
+    def __init__(self, dbg, cluster_name, run_dir=NBD_RUN_DIR):
+        self.dbg = dbg
+        self.cluster_name = cluster_name
+        self.run_dir = run_dir
+        self.qmp_path = os.path.join(run_dir, "%s.qmp" % cluster_name)
+        self.nbd_path = os.path.join(run_dir, "%s.nbd" % cluster_name)
+        self.pid_path = os.path.join(run_dir, "%s.pid" % cluster_name)
+        self.lock_path = os.path.join(run_dir, "%s.lock" % cluster_name)
+
+    @staticmethod
+    def export_name(pool, image):
+        return "%s/%s" % (pool, image)
+
+    @staticmethod
+    def node_name(pool, image):
+        # QEMU node names are limited to 31 characters
+        return "rbd%s" % md5(NBDServer.export_name(pool, image).encode('utf-8')).hexdigest()[:28]
+
+    def _is_running(self):
+        try:
+            with open(self.pid_path) as f:
+                os.kill(int(f.read().strip()), 0)
+            return os.path.exists(self.qmp_path)
+        except (IOError, OSError, ValueError):
+            return False
+
+    def _start(self, qmp):
+        debug("%s: xcpng.librbd.nbd_utils.NBDServer._start: cluster: %s", self.dbg, self.cluster_name)
+        for path in (self.qmp_path, self.nbd_path, self.pid_path):
+            if os.path.exists(path):
+                os.unlink(path)
+        # -daemonize returns once the monitor socket is listening
+        call(self.dbg, [QEMU_DP, '-daemonize', '-pidfile', self.pid_path,
+                        '-qmp', "unix:%s,server,nowait" % self.qmp_path])
+        deadline = time() + NBD_SERVER_START_TIMEOUT
+        while True:
+            try:
+                qmp.connect()
+                break
+            except socket.error:
+                qmp.close()
+                if time() > deadline:
+                    raise Exception("NBD server for cluster %s didn't start" % self.cluster_name)
+                sleep(0.1)
+        qmp.execute('nbd-server-start', {'addr': {'type': 'unix', 'data': {'path': self.nbd_path}}})
+
+    @contextmanager
+    def _session(self):
+        fd = _lock_file(self.run_dir, self.lock_path)
+        qmp = QMPClient(self.dbg, self.qmp_path)
+        try:
+            if self._is_running():
+                qmp.connect()
+            else:
+                self._start(qmp)
+            yield qmp
+        finally:
+            qmp.close()
+            os.close(fd)
+
+    def add_export(self, pool, image, options=None):
+        """Exports image and returns the export name to connect to on the server socket
+
+        options are extra blockdev-add options of the image's node, e.g. cache and discard modes
+        """
+        debug("%s: xcpng.librbd.nbd_utils.NBDServer.add_export: cluster: %s pool: %s image: %s options: %s",
+              self.dbg, self.cluster_name, pool, image, options)
+        node_name = self.node_name(pool, image)
+        node = {'driver': 'raw',
+                'node-name': node_name,
+                'file': {'driver': 'rbd',
+                         'pool': pool,
+                         'image': image,
+                         'conf': "/etc/ceph/%s.conf" % self.cluster_name}}
+        if options:
+            node.update(options)
+            if 'cache' in options:
+                node['file']['cache'] = options['cache']
+        with self._session() as qmp:
+            qmp.execute('blockdev-add', node)
+            try:
+                qmp.execute('nbd-server-add', {'device': node_name,
+                                               'name': self.export_name(pool, image),
+                                               'writable': True})
+            except Exception:
+                qmp.execute('blockdev-del', {'node-name': node_name})
+                raise
+        return self.export_name(pool, image)
+
+    def remove_export(self, pool, image):
+        debug("%s: xcpng.librbd.nbd_utils.NBDServer.remove_export: cluster: %s pool: %s image: %s",
+              self.dbg, self.cluster_name, pool, image)
+        with self._session() as qmp:
+            qmp.execute('nbd-server-remove', {'name': self.export_name(pool, image), 'mode': 'hard'})
+            qmp.execute('blockdev-del', {'node-name': self.node_name(pool, image)})
+
+    def connect_device(self, nbd_device, export):
+        call(self.dbg, [NBD_CLIENT, '-unix', self.nbd_path, nbd_device, '-N', export])
+
+    def disconnect_device(self, nbd_device):
+        call(self.dbg, [NBD_CLIENT, '-d', nbd_device])
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+"""Host-local persistent write-back cache of attached VDIs: librbd's persistent write log (PWL)
+
+With PERSISTENT_CACHE_DIR set in HOST_CONFIG_FILE, on a local SSD/NVMe file system, VDIs whose
+tuning profile has rbd-persistent-cache=true are attached with librbd's pwl_cache plugin. Writes
+and flushes of the guest complete once they are in a log file of PERSISTENT_CACHE_SIZE bytes in that
+directory, and librbd writes them back to the cluster in order behind it. Only librbd opened by
+qemu-nbd or rbd-nbd can load the plugin: the shared NBD server and the kernel rbd client attach
+without the cache.
+
+librbd keeps the state of the cache (host, clean or dirty) in the image metadata, PCACHE_STATE_KEY:
+
+* VDI.detach waits for the cache to be written back and removed as the image is closed, and flushes
+  it itself if it isn't within PCACHE_FLUSH_TIMEOUT, so a detached VDI has all its data in the cluster.
+* While the VDI is attached its cache is dirty. Another host may still open the image, as for a live
+  migration: librbd of the cache's host writes the cache back before it hands the exclusive lock over.
+* After a crash the cache of the host still holds writes that never reached the cluster, and no
+  client holds the exclusive lock of the image any more. A client that merely opened it, to read its
+  metadata say, doesn't count. The next attach on the same host replays the log.
+  An attach on any other host is refused: it would read stale data and the later replay would
+  overwrite newer writes. The writes are recovered with 'flush' on the host of the cache, or
+  discarded with 'invalidate' if that host is gone:
+
+    python -m xapi.storage.libs.xcpng.librbd.pcache status|flush|invalidate <cluster> <pool> <image>
+"""
+
+import argparse
+import json
+import socket
+import sys
+
+from time import sleep, time
+
+from xapi.storage import log
+from xapi.storage.libs.xcpng.utils import call
+from xapi.storage.libs.xcpng.librbd.host import get_host_config
+from xapi.storage.libs.xcpng.librbd.rbd_utils import ceph_cluster, rbd_metadata_list, rbd_lock_owners
+from xapi.storage.libs.xcpng.librbd.trace import debug
+
+RBD = '/usr/bin/rbd'
+PCACHE_STATE_KEY = '.librbd/persistent_cache_state'
+PCACHE_MODE = 'ssd'  # 'rwl' needs the log on persistent memory (DAX)
+PCACHE_SIZE = 1 << 30  # bytes of log per attached VDI
+PCACHE_FLUSH_TIMEOUT = 60  # seconds VDI.detach waits for the closing client to write the cache back
+PCACHE_POLL_INTERVAL = 0.5
+
+
+def cache_options(dbg):
+    """Returns the librbd (name, value) settings of the host's cache, [] if the host has none"""
+    path = get_host_config(dbg, 'PERSISTENT_CACHE_DIR', '')
+    if not path:
+        return []
+    return [('rbd_plugins', 'pwl_cache'),
+            ('rbd_persistent_cache_mode', get_host_config(dbg, 'PERSISTENT_CACHE_MODE', PCACHE_MODE)),
+            ('rbd_persistent_cache_path', path),
+            ('rbd_persistent_cache_size', str(get_host_config(dbg, 'PERSISTENT_CACHE_SIZE', PCACHE_SIZE)))]
+
+
+def _flag(state, name, default):
+    value = state.get(name, default)
+    return value is True or str(value).lower() == 'true'
+
+
+def is_dirty(state):
+    """Whether the cache of state holds writes the cluster doesn't have"""
+    return state is not None and _flag(state, 'present', False) and not _flag(state, 'clean', True)
+
+
+def state_host(state):
+    return state.get('pwl_host', state.get('host', ''))
+
+
+def local_host():
+    # librbd records the short host name
+    return socket.gethostname().split('.')[0]
+
+
+def get_cache_state(dbg, cluster, pool, name):
+    """Returns the cache state librbd keeps in the image metadata, None if the image has no cache"""
+    value = rbd_metadata_list(dbg, cluster, pool, name, PCACHE_STATE_KEY).get(PCACHE_STATE_KEY)
+    if not value:
+        return None
+    try:
+        return json.loads(value)
+    except ValueError:
+        log.error("%s: xcpng.librbd.pcache.get_cache_state: Pool: %s Name: %s Invalid cache state %s"
+                  % (dbg, pool, name, value))
+        return {'present': True, 'clean': False}
+
+
+def _recovery_hint(cluster_name, pool, name):
+    return ("run 'python -m %s flush %s %s %s' on the host of the cache, or 'invalidate' to discard them"
+            % (__name__, cluster_name, pool, name))
+
+
+def prepare_attach(dbg, cluster_name, pool, name, usable):
+    """Checks that the image can be attached here, returns the librbd settings of the cache to attach
+    it with ([] for none)
+
+    usable is whether the datapath's client can load the cache plugin.
+    """
+    options = cache_options(dbg) if usable else []
+    cluster = ceph_cluster(dbg, cluster_name)
+    try:
+        cluster.connect()
+        state = get_cache_state(dbg, cluster, pool, name)
+        live = is_dirty(state) and rbd_lock_owners(dbg, cluster, pool, name)
+    finally:
+        cluster.shutdown()
+    debug("%s: xcpng.librbd.pcache.prepare_attach: Pool: %s Name: %s State: %s Options: %s",
+          dbg, pool, name, state, options)
+    if not is_dirty(state) or live:
+        return options
+    if state_host(state) != local_host():
+        raise Exception("%s/%s has writes in the persistent cache of host %s that aren't in the cluster, %s"
+                        % (pool, name, state_host(state), _recovery_hint(cluster_name, pool, name)))
+    if not options:
+        raise Exception("%s/%s has writes in the persistent cache of this host that aren't in the cluster, and "
+                        "is attached without the cache now, %s" % (pool, name, _recovery_hint(cluster_name, pool, name)))
+    log.error("%s: xcpng.librbd.pcache.prepare_attach: %s/%s: replaying the persistent cache left by a crash"
+              % (dbg, pool, name))
+    return options
+
+
+def flush(dbg, cluster_name, pool, name, options=None):
+    """Writes the cache of the image back to the cluster, on the host of the cache"""
+    if options is None:
+        options = cache_options(dbg)
+    call(dbg, [RBD, 'persistent-cache', 'flush', '--cluster', cluster_name] +
+         ["--%s=%s" % option for option in options] + ["%s/%s" % (pool, name)])
+
+
+def invalidate(dbg, cluster_name, pool, name):
+    """Discards the cache of the image, with the writes it holds"""
+    call(dbg, [RBD, 'persistent-cache', 'invalidate', '--cluster', cluster_name, "%s/%s" % (pool, name)])
+
+
+def detach(dbg, cluster_name, pool, name, options, timeout=PCACHE_FLUSH_TIMEOUT):
+    """Returns once the cache of the image is written back, after its datapath client was stopped
+
+    The client writes the cache back as it closes the image, which can take a while after qemu-nbd -d
+    or rbd-nbd unmap returned. If it doesn't finish within timeout the cache is flushed here.
+    """
+    cluster = ceph_cluster(dbg, cluster_name)
+    try:
+        cluster.connect()
+        deadline = time() + timeout
+        while is_dirty(get_cache_state(dbg, cluster, pool, name)):
+            if time() >= deadline:
+                log.error("%s: xcpng.librbd.pcache.detach: %s/%s: persistent cache not written back within %s "
+                          "seconds, flushing it" % (dbg, pool, name, timeout))
+                flush(dbg, cluster_name, pool, name, options)
+                if is_dirty(get_cache_state(dbg, cluster, pool, name)):
+                    raise Exception("Failed to write back the persistent cache of %s/%s, %s"
+                                    % (pool, name, _recovery_hint(cluster_name, pool, name)))
+                break
+            sleep(PCACHE_POLL_INTERVAL)
+    finally:
+        cluster.shutdown()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Persistent write-back cache of an RBD image')
+    parser.add_argument('command', choices=('status', 'flush', 'invalidate'))
+    parser.add_argument('cluster')
+    parser.add_argument('pool')
+    parser.add_argument('image')
+    args = parser.parse_args(argv)
+
+    dbg = "pcache-%s-%s-%s" % (args.command, args.pool, args.image)
+    if args.command == 'flush':
+        flush(dbg, args.cluster, args.pool, args.image)
+    elif args.command == 'invalidate':
+        invalidate(dbg, args.cluster, args.pool, args.image)
+    cluster = ceph_cluster(dbg, args.cluster)
+    try:
+        cluster.connect()
+        state = get_cache_state(dbg, cluster, args.pool, args.image)
+    finally:
+        cluster.shutdown()
+    if state is None:
+        print("no cache")
+    else:
+        print("%s host: %s" % ('dirty' if is_dirty(state) else 'clean', state_host(state)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+"""Per-VDI I/O limits: librbd QoS settings kept in the image metadata
+
+A QoS profile is a dict of QOS_OPTIONS keys given as VDI keys (sm-config at VDI creation, or
+Volume.set). Each key is stored in the image metadata as conf_<librbd option>, which librbd applies
+to every client of the image instead of its configured value: qemu-nbd, rbd-nbd and the shared NBD
+server enforce it, the kernel rbd client (krbd datapath) has no QoS and ignores it. A value of 0
+removes the limit.
+
+The VDI keys are written to the image when it is created or cloned and again at every attach, so
+the image follows the VDI meta. Clients that have the image open apply a change at once, so the
+limits of an attached VDI are changed online with
+
+    python -m xapi.storage.libs.xcpng.librbd.qos <cluster> <pool> <image> rbd-qos-iops-limit=500 ...
+
+which without limits prints the current ones. A limit only set this way lasts until an attach
+writes the VDI's own key of the same name.
+"""
+
+import argparse
+import sys
+
+from xapi.storage.libs.xcpng.utils import get_cluster_name_by_uri
+from xapi.storage.libs.xcpng.librbd.rbd_utils import ceph_cluster, rbd_metadata_list, rbd_metadata_set
+from xapi.storage.libs.xcpng.librbd.trace import debug
+
+QOS_OPTIONS = {
+    'rbd-qos-iops-limit': 'rbd_qos_iops_limit',
+    'rbd-qos-read-iops-limit': 'rbd_qos_read_iops_limit',
+    'rbd-qos-write-iops-limit': 'rbd_qos_write_iops_limit',
+    'rbd-qos-bps-limit': 'rbd_qos_bps_limit',
+    'rbd-qos-read-bps-limit': 'rbd_qos_read_bps_limit',
+    'rbd-qos-write-bps-limit': 'rbd_qos_write_bps_limit',
+    'rbd-qos-iops-burst': 'rbd_qos_iops_burst',
+    'rbd-qos-read-iops-burst': 'rbd_qos_read_iops_burst',
+    'rbd-qos-write-iops-burst': 'rbd_qos_write_iops_burst',
+    'rbd-qos-bps-burst': 'rbd_qos_bps_burst',
+    'rbd-qos-read-bps-burst': 'rbd_qos_read_bps_burst',
+    'rbd-qos-write-bps-burst': 'rbd_qos_write_bps_burst',
+}
+
+IMAGE_META_PREFIX = 'conf_'  # librbd applies image metadata conf_<option> as the value of <option>
+QOS_META_PREFIX = "%srbd_qos_" % IMAGE_META_PREFIX
+
+
+def get_qos_profile(dbg, configuration):
+    """Returns the QoS keys of configuration, raises Exception on an invalid value"""
+    profile = {}
+    for key in QOS_OPTIONS:
+        if key not in configuration:
+            continue
+        value = str(configuration[key]).strip()
+        if not value.isdigit():
+            raise Exception("Invalid %s '%s', expected a number, 0 for no limit" % (key, configuration[key]))
+        profile[key] = str(int(value))
+    return profile
+
+
+def image_qos(metadata):
+    """Returns the QoS profile kept in the image metadata {key: value}"""
+    options = dict((IMAGE_META_PREFIX + option, key) for key, option in QOS_OPTIONS.items())
+    return dict((options[key], value) for key, value in metadata.items() if key in options)
+
+
+def set_image_qos(dbg, cluster, pool, name, profile):
+    """Writes the limits of profile to the image metadata, only those that differ. Returns the profile
+    of the image"""
+    debug("%s: xcpng.librbd.qos.set_image_qos: Pool: %s Name: %s Profile: %s", dbg, pool, name, profile)
+    metadata = rbd_metadata_list(dbg, cluster, pool, name, QOS_META_PREFIX)
+    changed = {}
+    removed = []
+    for key, value in profile.items():
+        meta_key = IMAGE_META_PREFIX + QOS_OPTIONS[key]
+        if value == '0':
+            if meta_key in metadata:
+                removed.append(meta_key)
+                del metadata[meta_key]
+        elif metadata.get(meta_key) != value:
+            changed[meta_key] = metadata[meta_key] = value
+    if changed or removed:
+        rbd_metadata_set(dbg, cluster, pool, name, changed, removed)
+    return image_qos(metadata)
+
+
+def apply_vdi_qos(dbg, uri, pool, name, profile):
+    """set_image_qos() over a connection to the cluster of uri"""
+    cluster = ceph_cluster(dbg, get_cluster_name_by_uri(dbg, uri))
+    try:
+        cluster.connect()
+        return set_image_qos(dbg, cluster, pool, name, profile)
+    finally:
+        cluster.shutdown()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Show or change the I/O limits of an RBD image')
+    parser.add_argument('cluster')
+    parser.add_argument('pool')
+    parser.add_argument('image')
+    parser.add_argument('limits', nargs='*', metavar='key=value',
+                        help="one of %s, 0 for no limit" % ', '.join(sorted(QOS_OPTIONS)))
+    args = parser.parse_args(argv)
+
+    limits = dict(limit.split('=', 1) for limit in args.limits if '=' in limit)
+    unknown = [limit for limit in args.limits if '=' not in limit or limit.split('=', 1)[0] not in QOS_OPTIONS]
+    if unknown:
+        parser.error("invalid limit %s" % ', '.join(unknown))
+
+    dbg = "qos-%s-%s" % (args.pool, args.image)
+    profile = get_qos_profile(dbg, limits)
+    cluster = ceph_cluster(dbg, args.cluster)
+    try:
+        cluster.connect()
+        if profile:
+            qos = set_image_qos(dbg, cluster, args.pool, args.image, profile)
+        else:
+            qos = image_qos(rbd_metadata_list(dbg, cluster, args.pool, args.image, QOS_META_PREFIX))
+    finally:
+        cluster.shutdown()
+    for key in sorted(qos):
+        print("%s=%s" % (key, qos[key]))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
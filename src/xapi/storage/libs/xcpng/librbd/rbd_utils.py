@@ -1,58 +1,446 @@
 #!/usr/bin/env python
 
-from rbd import RBD, Image, ImageBusy, ImageExists
-from rados import Rados
+from rbd import RBD, Image, ImageBusy, ImageExists, ImageNotFound, RBD_FEATURE_LAYERING, RBD_FEATURE_EXCLUSIVE_LOCK, \
+                RBD_FEATURE_OBJECT_MAP, RBD_FEATURE_FAST_DIFF, RBD_FEATURE_DEEP_FLATTEN, RBD_FLAG_FAST_DIFF_INVALID, \
+                RBD_TRASH_IMAGE_SOURCE_USER
+from rados import Rados, ReadOpCtx, WriteOpCtx, ObjectNotFound, ObjectExists, Error as RadosError
 import os, fnmatch
+import atexit
+import errno
+import threading
 import traceback
 
+from collections import OrderedDict
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from random import Random
+from time import sleep, time
 from xapi.storage import log
+from xapi.storage.libs.xcpng.librbd.trace import debug, fsid, span, timed
+
+CEPH_CONF_DIR = '/etc/ceph'
 
 VOLBLOCKSIZE = 2097152
 RBD_IMAGE_ORDER = 21  # the image is split into (2**order = VOLBLOCKSIZE) bytes objects
 
+RADOS_CONNECT_TIMEOUT = 30  # seconds to wait for monitors on connect
+CONNECTION_IDLE_TIMEOUT = 300  # unused cluster connections are closed after this many seconds
+CONNECTION_HEALTH_CHECK_INTERVAL = 30  # connections idle longer than this are probed before reuse
+IOCTX_CACHE_SIZE = 16  # pool IoCtxs kept open per process
+IMAGE_CACHE_SIZE = 64  # Image handles kept open per process
+IMAGE_HANDLE_IDLE_TIMEOUT = 60  # an open Image holds a header watch, so don't keep unused ones for long
+OMAP_READ_BATCH = 1024  # omap keys fetched per read op
+ECANCELED = getattr(errno, 'ECANCELED', 125)  # missing from Python 2's errno, a failed omap_cmp
+RADOS_CREATE_EXCLUSIVE = 1  # LIBRADOS_CREATE_EXCLUSIVE, not exported by older bindings
+LOCK_COOKIE = 'xapi-xcpng-lock'
+LOCK_SHARED_TAG = 'xapi-xcpng-readers'  # all read-only holders of an image share this tag
+LOCK_NOTIFY_OBJECT = 'rbd_id.%s'  # per-image RADOS object lock waiters watch, librbd itself doesn't
+LOCK_NOTIFY_TIMEOUT_MS = 500  # don't let a crashed waiter's stale watch hold up unlock
+
+# object-map/fast-diff let utilization be read from the object map instead of probing every object
+RBD_DEFAULT_FEATURES = RBD_FEATURE_LAYERING | RBD_FEATURE_EXCLUSIVE_LOCK | RBD_FEATURE_OBJECT_MAP | \
+                       RBD_FEATURE_FAST_DIFF | RBD_FEATURE_DEEP_FLATTEN
+RBD_KRBD_FEATURES = RBD_FEATURE_LAYERING | RBD_FEATURE_EXCLUSIVE_LOCK  # what older kernel clients can map
+UTILIZATION_SCAN_TIMEOUT = 5  # seconds a scan without fast-diff may take before it extrapolates
+UTILIZATION_SCAN_CHUNK = 1 << 30  # bytes scanned per diff_iterate() call of such a scan
+UTILIZATION_CACHE_TTL = 60  # seconds a utilization of the image head is reused, snapshots don't change
+RBD_SCAN_WORKERS = 16  # images rbd_scan() queries at once
+RBD_BULK_WORKERS = 16  # images the bulk create/trash/purge operations work on at once
+POOL_LIST_CACHE_TTL = 10  # seconds the pool list of a cluster is reused by SR discovery
+CLUSTER_DISCOVERY_TIMEOUT = 10  # seconds SR discovery waits for a cluster before leaving it out
+
 def get_config_files_list(dbg):
-    log.debug("%s: xcpng.librbd.rbd_utils.get_config_files_list" % (dbg))
+    debug("%s: xcpng.librbd.rbd_utils.get_config_files_list", dbg)
     files = []
     pattern = '*.conf'
-    if os.path.exists('/etc/ceph'):
-        for file in os.listdir('/etc/ceph'):
+    if os.path.exists(CEPH_CONF_DIR):
+        for file in os.listdir(CEPH_CONF_DIR):
             if fnmatch.fnmatch(file, pattern):
                 files.append(os.path.splitext(os.path.basename(file))[0])
     return files
 
 
+class _CachedHandle(object):
+
+    def __init__(self, handle):
+        self.handle = handle
+        self.users = 0
+        self.last_used = time()
+        self.evicted = False
+
+
+class HandleCache(object):
+    """Bounded LRU caches of pool IoCtxs and open Image handles
+
+    Handles are borrowed with the ioctx() and image() context managers. A borrowed handle is never
+    closed under its user: if it is evicted meanwhile it is closed when the last user gives it back.
+    An Image handle whose user raised an exception is dropped, so a failing image is never reused.
+    IoCtx errors (missing object, existing image) are usually about the request, not the handle.
+
+    image(..., read_only=True) opens a read-only handle for the borrower alone. It holds no header
+    watch, so it doesn't stop other hosts from removing the image, but it would also never see a
+    header update, so it is never cached.
+    """
+
+    def __init__(self, max_ioctxs=IOCTX_CACHE_SIZE, max_images=IMAGE_CACHE_SIZE,
+                 image_idle_timeout=IMAGE_HANDLE_IDLE_TIMEOUT):
+        self.max_ioctxs = max_ioctxs
+        self.max_images = max_images
+        self.image_idle_timeout = image_idle_timeout
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__lock = threading.RLock()
+        self.__ioctxs = OrderedDict()  # (cluster_name, pool) -> _CachedHandle
+        self.__images = OrderedDict()  # (cluster_name, pool, name) -> _CachedHandle
+
+    @contextmanager
+    def ioctx(self, dbg, cluster_name, cluster, pool):
+        with self._borrow(dbg, self.__ioctxs, (cluster_name, pool), self.max_ioctxs,
+                          lambda: cluster.open_ioctx(pool), False) as ioctx:
+            yield ioctx
+
+    @contextmanager
+    def image(self, dbg, cluster_name, cluster, pool, name, read_only=False):
+        if read_only:
+            with self.ioctx(dbg, cluster_name, cluster, pool) as ioctx:
+                with span(dbg, 'image_open'):
+                    image = Image(ioctx, name, read_only=True)
+                try:
+                    yield image
+                finally:
+                    image.close()
+            return
+
+        def _open():
+            with self.ioctx(dbg, cluster_name, cluster, pool) as ioctx:
+                with span(dbg, 'image_open'):
+                    return Image(ioctx, name)
+
+        with self._borrow(dbg, self.__images, (cluster_name, pool, name), self.max_images, _open, True) as image:
+            yield image
+
+    def invalidate_image(self, dbg, cluster_name, pool, name):
+        debug("%s: xcpng.librbd.rbd_utils.HandleCache.invalidate_image: Cluster: %s Pool: %s Name: %s",
+              dbg, cluster_name, pool, name)
+        with self.__lock:
+            entry = self.__images.pop((cluster_name, pool, name), None)
+            if entry is not None:
+                self._evict(dbg, entry)
+
+    def invalidate_cluster(self, dbg, cluster_name):
+        with self.__lock:
+            for cache in (self.__images, self.__ioctxs):
+                for key in [key for key in cache if key[0] == cluster_name]:
+                    self._evict(dbg, cache.pop(key))
+
+    def evict_idle(self, dbg):
+        now = time()
+        with self.__lock:
+            for key in [key for key, entry in self.__images.items()
+                        if entry.users == 0 and now - entry.last_used >= self.image_idle_timeout]:
+                self._evict(dbg, self.__images.pop(key))
+
+    @contextmanager
+    def _borrow(self, dbg, cache, key, limit, opener, drop_on_error):
+        with self.__lock:
+            entry = cache.pop(key, None)
+            if entry is not None:
+                cache[key] = entry  # most recently used goes last
+                entry.users += 1
+                self.hits += 1
+
+        if entry is None:
+            handle = opener()
+            with self.__lock:
+                self.misses += 1
+                entry = _CachedHandle(handle)
+                entry.users += 1
+                if key in cache:
+                    # Lost a race with another thread, keep ours private and close it after use
+                    entry.evicted = True
+                else:
+                    cache[key] = entry
+                    while len(cache) > limit:
+                        self._evict(dbg, cache.pop(next(iter(cache))))
+
+        failed = False
+        try:
+            yield entry.handle
+        except Exception:
+            failed = drop_on_error
+            raise
+        finally:
+            with self.__lock:
+                entry.users -= 1
+                entry.last_used = time()
+                if failed and cache.get(key) is entry:
+                    del cache[key]
+                    entry.evicted = True
+                if entry.evicted and entry.users == 0:
+                    self._close(dbg, entry)
+
+    def _evict(self, dbg, entry):
+        self.evictions += 1
+        entry.evicted = True
+        if entry.users == 0:
+            self._close(dbg, entry)
+
+    def _close(self, dbg, entry):
+        if entry.handle is not None:
+            try:
+                entry.handle.close()
+            except Exception:
+                log.error("%s: xcpng.librbd.rbd_utils.HandleCache._close: Failed to close cached handle" % dbg)
+                log.error(traceback.format_exc())
+            entry.handle = None
+
+
+class _PooledConnection(object):
+
+    def __init__(self, cluster_name):
+        self.cluster_name = cluster_name
+        self.cluster = None
+        self.refcount = 0
+        self.last_used = 0
+        self.last_checked = 0
+        self.closed = False
+        self.lock = threading.Lock()  # guards cluster, only held for local work and health checks
+        self.connect_lock = threading.Lock()  # one connect at a time, held for as long as it takes
+
+
+class ClusterConnectionManager(object):
+    """Process-wide pool of connected Rados handles keyed by cluster name.
+
+    A handle is connected on first use and shared by every caller in the process. It is reference
+    counted and closed only after it has stayed unused for idle_timeout seconds, so a sequence of
+    operations against the same cluster pays for the monitor handshake once.
+    """
+
+    def __init__(self, idle_timeout=CONNECTION_IDLE_TIMEOUT,
+                 health_check_interval=CONNECTION_HEALTH_CHECK_INTERVAL):
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.connects = 0
+        self.acquires = 0
+        self.handles = HandleCache()
+        self.__lock = threading.Lock()
+        self.__connections = {}
+
+    def acquire(self, dbg, cluster_name):
+        debug("%s: xcpng.librbd.rbd_utils.ClusterConnectionManager.acquire: Cluster: %s", dbg, cluster_name)
+
+        with self.__lock:
+            self.acquires += 1
+            conn = self.__connections.get(cluster_name)
+            if conn is None:
+                conn = _PooledConnection(cluster_name)
+                self.__connections[cluster_name] = conn
+            conn.refcount += 1
+
+        try:
+            cluster = self._get(dbg, conn)
+            if cluster is None:
+                with conn.connect_lock:
+                    cluster = self._get(dbg, conn)
+                    if cluster is None:
+                        # conn.lock stays free while an unreachable cluster takes its time to fail, so
+                        # shutdown_all() at exit doesn't wait for it
+                        cluster = self._connect(dbg, cluster_name)
+                        self._publish(dbg, conn, cluster)
+            return cluster
+        except Exception:
+            with self.__lock:
+                conn.refcount -= 1
+            raise
+
+    def _get(self, dbg, conn):
+        """Returns the healthy connected handle of conn, None if it has to be connected"""
+        with conn.lock:
+            if conn.cluster is not None and not self._is_healthy(dbg, conn):
+                self._disconnect(dbg, conn)
+            if conn.cluster is not None:
+                conn.last_used = time()
+            return conn.cluster
+
+    def _publish(self, dbg, conn, cluster):
+        with conn.lock:
+            if conn.closed:
+                cluster.shutdown()
+                raise Exception("Connections to cluster %s were shut down while connecting" % conn.cluster_name)
+            conn.cluster = cluster
+            conn.last_checked = conn.last_used = time()
+
+    def release(self, dbg, cluster_name):
+        debug("%s: xcpng.librbd.rbd_utils.ClusterConnectionManager.release: Cluster: %s", dbg, cluster_name)
+
+        with self.__lock:
+            conn = self.__connections.get(cluster_name)
+            if conn is not None and conn.refcount > 0:
+                conn.refcount -= 1
+                conn.last_used = time()
+        self.evict_idle(dbg)
+
+    def invalidate(self, dbg, cluster_name):
+        """Forces the next acquire to probe the connection and reconnect if it is broken"""
+        with self.__lock:
+            conn = self.__connections.get(cluster_name)
+        if conn is not None:
+            conn.last_checked = 0
+
+    def evict_idle(self, dbg):
+        self.handles.evict_idle(dbg)
+        now = time()
+        with self.__lock:
+            idle = [conn for conn in self.__connections.values()
+                    if conn.refcount == 0 and now - conn.last_used >= self.idle_timeout]
+            for conn in idle:
+                del self.__connections[conn.cluster_name]
+        for conn in idle:
+            with conn.lock:
+                self._disconnect(dbg, conn)
+
+    def shutdown_all(self, dbg='rbd_utils'):
+        """Closes every connection. Runs at exit, so it doesn't wait for a health check still waiting on
+        its cluster: that connection is left to the process exit"""
+        with self.__lock:
+            conns = list(self.__connections.values())
+            self.__connections.clear()
+        for conn in conns:
+            # A connect still in progress shuts its handle down as it finishes
+            conn.closed = True
+            if not conn.lock.acquire(False):
+                log.error("%s: xcpng.librbd.rbd_utils.ClusterConnectionManager.shutdown_all: Connection to "
+                          "cluster %s is busy, not closing it" % (dbg, conn.cluster_name))
+                continue
+            try:
+                self._disconnect(dbg, conn)
+            finally:
+                conn.lock.release()
+
+    def _connect(self, dbg, cluster_name):
+        conf_file = "%s/%s.conf" % (CEPH_CONF_DIR, cluster_name)
+        with span(dbg, 'connect'):
+            cluster = Rados(conffile=conf_file)
+            try:
+                cluster.connect(timeout=RADOS_CONNECT_TIMEOUT)
+            except Exception:
+                # One retry covers monitors that dropped us during an election
+                log.error("%s: xcpng.librbd.rbd_utils.ClusterConnectionManager._connect: Failed to connect to "
+                          "cluster %s, retrying" % (dbg, cluster_name))
+                cluster.shutdown()
+                cluster = Rados(conffile=conf_file)
+                cluster.connect(timeout=RADOS_CONNECT_TIMEOUT)
+        self.connects += 1
+        return cluster
+
+    def _disconnect(self, dbg, conn):
+        if conn.cluster is not None:
+            debug("%s: xcpng.librbd.rbd_utils.ClusterConnectionManager._disconnect: Cluster: %s",
+                  dbg, conn.cluster_name)
+            # Cached handles must be closed before the connection they were opened on
+            self.handles.invalidate_cluster(dbg, conn.cluster_name)
+            try:
+                conn.cluster.shutdown()
+            except Exception:
+                log.error(traceback.format_exc())
+            conn.cluster = None
+
+    def _is_healthy(self, dbg, conn):
+        if conn.cluster.state != 'connected':
+            return False
+        if time() - max(conn.last_used, conn.last_checked) < self.health_check_interval:
+            return True
+        try:
+            conn.cluster.get_cluster_stats()
+            conn.last_checked = time()
+            return True
+        except Exception:
+            log.error("%s: xcpng.librbd.rbd_utils.ClusterConnectionManager._is_healthy: Connection to cluster %s "
+                      "is broken, reconnecting" % (dbg, conn.cluster_name))
+            return False
+
+
+CONNECTIONS = ClusterConnectionManager()
+atexit.register(CONNECTIONS.shutdown_all)
+
+
+class CephCluster(object):
+    """Rados look-alike handed out by ceph_cluster()
+
+    connect() and shutdown() acquire and release the pooled connection instead of opening and closing
+    a new one. Every other attribute is looked up on the shared Rados handle.
+    """
+
+    def __init__(self, dbg, cluster_name, manager=CONNECTIONS):
+        self.dbg = dbg
+        self.cluster_name = cluster_name
+        self.manager = manager
+        self.__cluster = None
+
+    def connect(self):
+        if self.__cluster is None:
+            self.__cluster = self.manager.acquire(self.dbg, self.cluster_name)
+
+    def shutdown(self):
+        if self.__cluster is not None:
+            self.__cluster = None
+            self.manager.release(self.dbg, self.cluster_name)
+
+    def ioctx(self, pool):
+        """Borrows a cached IoCtx for pool. Use as a context manager and don't close it"""
+        if self.__cluster is None:
+            raise Exception("CEPH cluster %s is not connected" % self.cluster_name)
+        return self.manager.handles.ioctx(self.dbg, self.cluster_name, self.__cluster, pool)
+
+    def image(self, pool, name, read_only=False):
+        """Borrows a cached Image handle. Use as a context manager and don't close it
+
+        Helpers that only read pass read_only=True and get a private handle without a header watch.
+        """
+        if self.__cluster is None:
+            raise Exception("CEPH cluster %s is not connected" % self.cluster_name)
+        return self.manager.handles.image(self.dbg, self.cluster_name, self.__cluster, pool, name, read_only)
+
+    def invalidate_image(self, pool, name):
+        self.manager.handles.invalidate_image(self.dbg, self.cluster_name, pool, name)
+
+    def __getattr__(self, name):
+        if self.__cluster is None:
+            raise Exception("CEPH cluster %s is not connected" % self.cluster_name)
+        return getattr(self.__cluster, name)
+
+
 def ceph_cluster(dbg, cluster_name):
-    log.debug("%s: xcpng.librbd.rbd_utils.ceph_cluster: Cluster: %s" % (dbg, cluster_name))
+    debug("%s: xcpng.librbd.rbd_utils.ceph_cluster: Cluster: %s", dbg, cluster_name)
 
-    conf_file = "/etc/ceph/%s.conf" % cluster_name
+    conf_file = "%s/%s.conf" % (CEPH_CONF_DIR, cluster_name)
 
     if not os.path.exists(conf_file):
         log.error("%s: xcpng.librbd.rbd_utils.ceph_cluster: Config file for CEPH cluster %s doesn't exists." %
                   (dbg, cluster_name))
         raise Exception("CEPH config file %s doesn't exists" % conf_file)
 
-    cluster = Rados(conffile=conf_file)
-
-    return cluster
+    return CephCluster(dbg, cluster_name)
 
 
+@timed('rbd_list')
 def rbd_list(dbg, cluster, pool):
-    log.debug("%s: xcpng.librbd.rbd_utils.get_rbd_list: %s" % (dbg, pool))
-    ioctx = cluster.open_ioctx(pool)
+    debug("%s: xcpng.librbd.rbd_utils.get_rbd_list: %s", dbg, pool)
     rbd_inst = RBD()
     try:
-        rbds = rbd_inst.list(ioctx)
+        with cluster.ioctx(pool) as ioctx:
+            rbds = rbd_inst.list(ioctx)
         return rbds
     except Exception as e:
         log.error("%s: xcpng.librbd.rbd_utils.get_rbd_list: Failed to get list of rbds for pool: %s " % (dbg, pool))
         log.error(traceback.format_exc())
         raise Exception(e)
-    finally:
-        ioctx.close()
 
 
+@timed('pool_list')
 def pool_list(dbg, cluster):
-    log.debug("%s: xcpng.librbd.rbd_utils.pool_list: Cluster ID: %s" % (dbg, cluster.get_fsid()))
+    debug("%s: xcpng.librbd.rbd_utils.pool_list: Cluster ID: %s", dbg, fsid(cluster))
     try:
         pools = cluster.list_pools()
         return pools
@@ -63,204 +451,885 @@ def pool_list(dbg, cluster):
         raise Exception(e)
 
 
-def rbd_create(dbg, cluster, pool, name, size):
-    log.debug("%s: xcpng.librbd.rbd_utils.rbd_create: Cluster ID: %s Pool: %s Name: %s Size: %s"
-              % (dbg, cluster.get_fsid(), pool, name, size))
-    ioctx = cluster.open_ioctx(pool)
+class PoolListCache(object):
+    """Pool names of each cluster, reused for POOL_LIST_CACHE_TTL seconds"""
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__entries = {}  # cluster_name -> (pools, time listed)
+
+    def get(self, cluster_name):
+        with self.__lock:
+            entry = self.__entries.get(cluster_name)
+            if entry is not None and time() - entry[1] < POOL_LIST_CACHE_TTL:
+                return entry[0]
+            return None
+
+    def put(self, cluster_name, pools):
+        with self.__lock:
+            self.__entries[cluster_name] = (pools, time())
+
+    def invalidate(self, cluster_name):
+        with self.__lock:
+            self.__entries.pop(cluster_name, None)
+
+
+POOL_LIST_CACHE = PoolListCache()
+
+
+def clusters_pool_list(dbg, cluster_names, timeout=CLUSTER_DISCOVERY_TIMEOUT):
+    """Returns {cluster_name: pools} of the clusters that answered within timeout seconds
+
+    The clusters are queried concurrently, so an unreachable one costs at most timeout seconds however
+    many clusters there are. A cluster that fails or doesn't answer in time is logged and left out;
+    its query carries on in the background and fills POOL_LIST_CACHE if it completes.
+    """
+    debug("%s: xcpng.librbd.rbd_utils.clusters_pool_list: Clusters: %s", dbg, cluster_names)
+
+    def _list_(cluster_name):
+        pools = POOL_LIST_CACHE.get(cluster_name)
+        if pools is None:
+            cluster = ceph_cluster(dbg, cluster_name)
+            try:
+                cluster.connect()
+                pools = pool_list(dbg, cluster)
+            finally:
+                cluster.shutdown()
+            POOL_LIST_CACHE.put(cluster_name, pools)
+        return pools
+
+    results = {}
+    if not cluster_names:
+        return results
+    workers = ThreadPool(len(cluster_names))
+    try:
+        pending = [(cluster_name, workers.apply_async(_list_, (cluster_name,))) for cluster_name in cluster_names]
+        deadline = time() + timeout
+        for cluster_name, result in pending:
+            try:
+                results[cluster_name] = result.get(max(0, deadline - time()))
+            except Exception:
+                log.error("%s: xcpng.librbd.rbd_utils.clusters_pool_list: Failed to get list of pools of cluster "
+                          "%s within %s seconds" % (dbg, cluster_name, timeout))
+                log.error(traceback.format_exc())
+    finally:
+        # Don't join, a cluster that timed out may still be connecting
+        workers.close()
+    return results
+
+
+def _layout_args(features, order, stripe_unit, stripe_count, data_pool):
+    """Returns the layout keyword arguments of RBD.create()/RBD.clone()
+
+    Striping and the data pool are only passed when set, bindings older than luminous lack data_pool
+    """
+    args = {'features': features, 'order': order}
+    if stripe_unit or stripe_count:
+        args['stripe_unit'] = stripe_unit
+        args['stripe_count'] = stripe_count
+    if data_pool:
+        args['data_pool'] = data_pool
+    return args
+
+
+@timed('rbd_create')
+def rbd_create(dbg, cluster, pool, name, size, features=RBD_DEFAULT_FEATURES, order=RBD_IMAGE_ORDER, stripe_unit=0,
+               stripe_count=0, data_pool=None):
+    debug("%s: xcpng.librbd.rbd_utils.rbd_create: Cluster ID: %s Pool: %s Name: %s Size: %s Features: %s "
+          "Order: %s Stripe unit: %s Stripe count: %s Data pool: %s",
+          dbg, fsid(cluster), pool, name, size, features, order, stripe_unit, stripe_count, data_pool)
     rbd_inst = RBD()
     try:
-        rbd_inst.create(ioctx, name, size, order=RBD_IMAGE_ORDER)
+        with cluster.ioctx(pool) as ioctx:
+            rbd_inst.create(ioctx, name, size, old_format=False,
+                            **_layout_args(features, order, stripe_unit, stripe_count, data_pool))
     except Exception as e:
         log.error("%s: xcpng.librbd.rbd_utils.rbd_create: Failed to create an image: Cluster ID: %s Pool %s Name: %s Size: %s"
                   % (dbg, cluster.get_fsid(), pool, name, size))
         log.error(traceback.format_exc())
         raise Exception(e)
-    finally:
-        ioctx.close()
 
 
+@timed('rbd_remove')
 def rbd_remove(dbg, cluster, pool, name):
-    log.debug("%s: xcpng.librbd.rbd_utils.rbd_remove: Cluster ID: %s Pool %s Name: %s"
-              % (dbg, cluster.get_fsid(), pool, name))
-    ioctx = cluster.open_ioctx(pool)
+    debug("%s: xcpng.librbd.rbd_utils.rbd_remove: Cluster ID: %s Pool %s Name: %s",
+          dbg, fsid(cluster), pool, name)
     rbd_inst = RBD()
     try:
-        rbd_inst.remove(ioctx, name)
+        # Our own cached handle would hold a watch on the image and make the removal fail
+        cluster.invalidate_image(pool, name)
+        with cluster.ioctx(pool) as ioctx:
+            rbd_inst.remove(ioctx, name)
     except Exception as e:
         log.error("%s: xcpng.librbd.rbd_utils.rbd_remove: Failed to remove an image: Cluster ID: %s Pool %s Name: %s"
                   % (dbg, cluster.get_fsid(), pool, name))
         log.error(traceback.format_exc())
         raise Exception(e)
+
+
+def _run_concurrently(func, items, workers=RBD_BULK_WORKERS):
+    """Calls func(item) for every item from a pool of threads, returns [(item, exception)] of the failures"""
+    def _call_(item):
+        try:
+            func(item)
+            return None
+        except Exception as e:
+            return item, e
+
+    if not items:
+        return []
+    threads = ThreadPool(max(1, min(workers, len(items))))
+    try:
+        return [failure for failure in threads.map(_call_, items, chunksize=1) if failure is not None]
     finally:
-        ioctx.close()
+        # Not joined: map() has the results, and on Python 2 join() waits up to 100ms for the pool's
+        # handler thread to wake up
+        threads.close()
 
 
-def rbd_resize(dbg, cluster, pool, name, size):
-    log.debug("%s: xcpng.librbd.rbd_utils.rbd_resize: Cluster ID: %s Pool: %s Name: %s Size: %s"
-              % (dbg, cluster.get_fsid(), pool, name, size))
-    ioctx = cluster.open_ioctx(pool)
-    image = Image(ioctx, name)
+@timed('rbd_create_many')
+def rbd_create_many(dbg, cluster, pool, images, features=RBD_DEFAULT_FEATURES, order=RBD_IMAGE_ORDER, stripe_unit=0,
+                    stripe_count=0, data_pool=None):
+    """Creates the (name, size) images concurrently on one IoCtx, all with the same layout
+
+    All or nothing: if any create fails the images created by this call are removed again.
+    """
+    debug("%s: xcpng.librbd.rbd_utils.rbd_create_many: Cluster ID: %s Pool: %s Images: %s Features: %s "
+          "Order: %s Stripe unit: %s Stripe count: %s Data pool: %s",
+          dbg, fsid(cluster), pool, len(images), features, order, stripe_unit, stripe_count, data_pool)
+    rbd_inst = RBD()
+    layout = _layout_args(features, order, stripe_unit, stripe_count, data_pool)
+    try:
+        with cluster.ioctx(pool) as ioctx:
+            failed = _run_concurrently(
+                lambda image: rbd_inst.create(ioctx, image[0], image[1], old_format=False, **layout),
+                images)
+            if failed:
+                failed_names = set(image[0] for image, e in failed)
+                _run_concurrently(lambda name: rbd_inst.remove(ioctx, name),
+                                  [name for name, size in images if name not in failed_names])
+                raise Exception("Failed to create %s: %s"
+                                % (', '.join(sorted(failed_names)), failed[0][1]))
+    except Exception as e:
+        log.error("%s: xcpng.librbd.rbd_utils.rbd_create_many: Failed to create images: Cluster ID: %s Pool %s"
+                  % (dbg, cluster.get_fsid(), pool))
+        log.error(traceback.format_exc())
+        raise Exception(e)
+
 
+@timed('rbd_trash_many')
+def rbd_trash_many(dbg, cluster, pool, names):
+    """Moves the images to the pool's trash concurrently
+
+    Unlike a remove, a move to the trash doesn't wait for the image's objects to be deleted. That is
+    left to rbd_trash_purge(). Images with snapshots can't be trashed.
+    """
+    debug("%s: xcpng.librbd.rbd_utils.rbd_trash_many: Cluster ID: %s Pool: %s Names: %s",
+          dbg, fsid(cluster), pool, names)
+    rbd_inst = RBD()
     try:
-        image.resize(size)
+        for name in names:
+            cluster.invalidate_image(pool, name)
+        with cluster.ioctx(pool) as ioctx:
+            failed = _run_concurrently(lambda name: rbd_inst.trash_move(ioctx, name, 0), names)
+        if failed:
+            raise Exception("Failed to trash %s: %s" % (', '.join(sorted(name for name, e in failed)), failed[0][1]))
+    except Exception as e:
+        log.error("%s: xcpng.librbd.rbd_utils.rbd_trash_many: Failed to trash images: Cluster ID: %s Pool %s"
+                  % (dbg, cluster.get_fsid(), pool))
+        log.error(traceback.format_exc())
+        raise Exception(e)
+
+
+def rbd_trash_list(dbg, cluster, pool):
+    """Returns the names of the images in the trash of pool"""
+    debug("%s: xcpng.librbd.rbd_utils.rbd_trash_list: Cluster ID: %s Pool: %s", dbg, fsid(cluster), pool)
+    try:
+        with cluster.ioctx(pool) as ioctx:
+            return [entry['name'] for entry in RBD().trash_list(ioctx)]
+    except Exception as e:
+        log.error("%s: xcpng.librbd.rbd_utils.rbd_trash_list: Failed to list trash: Cluster ID: %s Pool %s"
+                  % (dbg, cluster.get_fsid(), pool))
+        log.error(traceback.format_exc())
+        raise Exception(e)
+
+
+@timed('rbd_trash_purge')
+def rbd_trash_purge(dbg, cluster, pool):
+    """Deletes the images moved to the trash of pool by users (not by librbd itself), returns their number"""
+    debug("%s: xcpng.librbd.rbd_utils.rbd_trash_purge: Cluster ID: %s Pool: %s", dbg, fsid(cluster), pool)
+    rbd_inst = RBD()
+    try:
+        with cluster.ioctx(pool) as ioctx:
+            trashed = [entry['id'] for entry in rbd_inst.trash_list(ioctx)
+                       if entry['source'] == RBD_TRASH_IMAGE_SOURCE_USER]
+            failed = _run_concurrently(lambda image_id: rbd_inst.trash_remove(ioctx, image_id), trashed)
+        for image_id, e in failed:
+            # Left for the next purge, e.g. a clone of it was created meanwhile
+            debug("%s: xcpng.librbd.rbd_utils.rbd_trash_purge: Failed to purge image id %s: %s",
+                  dbg, image_id, e)
+        return len(trashed) - len(failed)
+    except Exception as e:
+        log.error("%s: xcpng.librbd.rbd_utils.rbd_trash_purge: Failed to purge trash: Cluster ID: %s Pool %s"
+                  % (dbg, cluster.get_fsid(), pool))
+        log.error(traceback.format_exc())
+        raise Exception(e)
+
+
+@timed('rbd_resize')
+def rbd_resize(dbg, cluster, pool, name, size):
+    debug("%s: xcpng.librbd.rbd_utils.rbd_resize: Cluster ID: %s Pool: %s Name: %s Size: %s",
+          dbg, fsid(cluster), pool, name, size)
+    try:
+        with cluster.image(pool, name) as image:
+            image.resize(size)
     except Exception as e:
         log.error("%s: xcpng.librbd.rbd_utils.rbd_resize: Failed to resize an image: Cluster ID: %s Pool %s Name: %s Size: %s"
                   % (dbg, cluster.get_fsid(), pool, name, size))
         log.error(traceback.format_exc())
         raise Exception(e)
-    finally:
-        ioctx.close()
 
 
-def rbd_utilization(dbg, cluster, pool, name):
-    log.debug("%s: xcpng.librbd.rbd_utils.rbd_utilization: Cluster ID: %s Pool: %s Name: %s"
-              % (dbg, cluster.get_fsid(), pool, name))
-    ioctx = cluster.open_ioctx(pool)
-    image = Image(ioctx, name)
+@timed('rbd_metadata_list')
+def rbd_metadata_list(dbg, cluster, pool, name, prefix=''):
+    """Returns {key: value} of the image metadata keys starting with prefix"""
+    debug("%s: xcpng.librbd.rbd_utils.rbd_metadata_list: Cluster ID: %s Pool: %s Name: %s Prefix: %s",
+          dbg, fsid(cluster), pool, name, prefix)
+    try:
+        with cluster.image(pool, name, read_only=True) as image:
+            return dict((key, value) for key, value in image.metadata_list() if key.startswith(prefix))
+    except Exception as e:
+        log.error("%s: xcpng.librbd.rbd_utils.rbd_metadata_list: Failed to list image metadata: Cluster ID: %s Pool %s Name: %s"
+                  % (dbg, cluster.get_fsid(), pool, name))
+        log.error(traceback.format_exc())
+        raise Exception(e)
+
+
+@timed('rbd_metadata_set')
+def rbd_metadata_set(dbg, cluster, pool, name, metadata, removed=()):
+    """Sets the {key: value} metadata of the image and removes the removed keys
+
+    Every change is announced to the clients that have the image open, which apply conf_ keys at once.
+    """
+    debug("%s: xcpng.librbd.rbd_utils.rbd_metadata_set: Cluster ID: %s Pool: %s Name: %s Metadata: %s Removed: %s",
+          dbg, fsid(cluster), pool, name, metadata, removed)
+    try:
+        with cluster.image(pool, name) as image:
+            for key, value in sorted(metadata.items()):
+                image.metadata_set(key, value)
+            for key in removed:
+                image.metadata_remove(key)
+    except Exception as e:
+        log.error("%s: xcpng.librbd.rbd_utils.rbd_metadata_set: Failed to set image metadata: Cluster ID: %s Pool %s Name: %s"
+                  % (dbg, cluster.get_fsid(), pool, name))
+        log.error(traceback.format_exc())
+        raise Exception(e)
+
+
+@timed('rbd_lock_owners')
+def rbd_lock_owners(dbg, cluster, pool, name):
+    """Returns the clients that hold the exclusive lock of the image
+
+    librbd takes the lock when an image is written, so unlike its watchers these are only the clients
+    doing I/O to it, such as a datapath, and not the ones reading its header or metadata.
+    """
+    debug("%s: xcpng.librbd.rbd_utils.rbd_lock_owners: Cluster ID: %s Pool: %s Name: %s",
+          dbg, fsid(cluster), pool, name)
+    try:
+        with cluster.image(pool, name, read_only=True) as image:
+            return [owner['owner'] for owner in image.lock_get_owners()]
+    except Exception as e:
+        log.error("%s: xcpng.librbd.rbd_utils.rbd_lock_owners: Failed to get the lock owners: Cluster ID: %s Pool %s Name: %s"
+                  % (dbg, cluster.get_fsid(), pool, name))
+        log.error(traceback.format_exc())
+        raise Exception(e)
+
+
+class UtilizationCache(object):
+    """Utilization of images keyed by (fsid, pool, image id, snapshot id)
+
+    A snapshot never changes, so its entry is kept until evicted. The head (snapshot id None) is
+    reused for UTILIZATION_CACHE_TTL seconds, so back to back scans of an SR don't diff every image again.
+    """
+
+    def __init__(self, size=4096):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.__lock = threading.Lock()
+        self.__entries = OrderedDict()
+
+    def get(self, key):
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None and (key[3] is not None or time() - entry[1] < UTILIZATION_CACHE_TTL):
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            return None
+
+    def put(self, key, used):
+        with self.__lock:
+            self.__entries.pop(key, None)
+            self.__entries[key] = (used, time())
+            while len(self.__entries) > self.size:
+                self.__entries.popitem(last=False)
+
+
+UTILIZATION_CACHE = UtilizationCache()
+
+
+def _diff_used(image, offset, length, include_parent=False):
+    used = [0]
+
+    def _cb_(offset, length, exists):
+        if exists:
+            used[0] += length
+
+    image.diff_iterate(offset, length, None, _cb_, include_parent=include_parent, whole_object=True)
+    return used[0]
+
+
+def _image_utilization(dbg, image, size):
+    """Returns bytes allocated by the image itself, excluding what a clone shares with its parent"""
+    if image.features() & RBD_FEATURE_FAST_DIFF and not image.flags() & RBD_FLAG_FAST_DIFF_INVALID:
+        # Served from the object map, a single round trip however big the image is
+        return _diff_used(image, 0, size)
+
+    # Without fast-diff every object is probed, so scan chunks in random order until the time runs
+    # out and extrapolate from the part scanned
+    chunks = list(range((size + UTILIZATION_SCAN_CHUNK - 1) // UTILIZATION_SCAN_CHUNK))
+    Random(image.id()).shuffle(chunks)
+    deadline = time() + UTILIZATION_SCAN_TIMEOUT
+    used = scanned = 0
+    for chunk in chunks:
+        if scanned and time() > deadline:
+            break
+        offset = chunk * UTILIZATION_SCAN_CHUNK
+        length = min(UTILIZATION_SCAN_CHUNK, size - offset)
+        used += _diff_used(image, offset, length)
+        scanned += length
+    if scanned < size:
+        debug("%s: xcpng.librbd.rbd_utils.rbd_utilization: Estimated from %s of %s bytes",
+              dbg, scanned, size)
+        return used * size // scanned
+    return used
 
+
+@timed('rbd_utilization')
+def rbd_utilization(dbg, cluster, pool, name, snapshot=None):
+    debug("%s: xcpng.librbd.rbd_utils.rbd_utilization: Cluster ID: %s Pool: %s Name: %s Snapshot: %s",
+          dbg, fsid(cluster), pool, name, snapshot)
     try:
-        image_stat = image.stat()
-        return image_stat['num_objs']*image_stat['obj_size']
+        if snapshot is None:
+            with cluster.image(pool, name, read_only=True) as image:
+                return _cached_utilization(dbg, cluster, pool, image, None)
+        with cluster.ioctx(pool) as ioctx:
+            image = Image(ioctx, name, snapshot=snapshot, read_only=True)
+            try:
+                snap_id = [snap['id'] for snap in image.list_snaps() if snap['name'] == snapshot][0]
+                return _cached_utilization(dbg, cluster, pool, image, snap_id)
+            finally:
+                image.close()
     except Exception as e:
         log.error("%s: xcpng.librbd.rbd_utils.rbd_utilisation: Failed to get an image utilization: Cluster ID: %s Pool %s Name: %s"
                   % (dbg, cluster.get_fsid(), pool, name))
         log.error(traceback.format_exc())
         raise Exception(e)
-    finally:
-        ioctx.close()
 
 
+def _cached_utilization(dbg, cluster, pool, image, snap_id):
+    key = (cluster.get_fsid(), pool, image.id(), snap_id)
+    used = UTILIZATION_CACHE.get(key)
+    if used is None:
+        used = _image_utilization(dbg, image, image.size())
+        UTILIZATION_CACHE.put(key, used)
+    return used
+
+
+@timed('rbd_scan')
+def rbd_scan(dbg, cluster, pool, prefix='', utilization=False, workers=RBD_SCAN_WORKERS):
+    """Returns {name: {'size', 'parent', 'utilization'}} of the pool images whose name starts with prefix
+
+    The pool is listed once and the images are opened read-only (no header watch) on one shared IoCtx
+    by a pool of worker threads, so the round trips of different images overlap. parent is the
+    (pool, image, snapshot) of a clone, otherwise None. utilization is None unless asked for, it goes
+    through UTILIZATION_CACHE so VolumeOperations.get_phisical_utilization of a VDI scanned
+    just before doesn't query the image again. An image removed while scanning is left out.
+    """
+    debug("%s: xcpng.librbd.rbd_utils.rbd_scan: Cluster ID: %s Pool: %s Prefix: %s",
+          dbg, fsid(cluster), pool, prefix)
+
+    def _stat_(ioctx, name):
+        try:
+            image = Image(ioctx, name, read_only=True)
+        except ImageNotFound:
+            return name, None
+        try:
+            size = image.size()
+            try:
+                parent = tuple(image.parent_info())
+            except ImageNotFound:
+                parent = None
+            used = _cached_utilization(dbg, cluster, pool, image, None) if utilization else None
+            return name, {'size': size, 'parent': parent, 'utilization': used}
+        finally:
+            image.close()
+
+    try:
+        with cluster.ioctx(pool) as ioctx:
+            names = [name for name in RBD().list(ioctx) if name.startswith(prefix)]
+            vdis = OrderedDict()
+            if not names:
+                return vdis
+            workers = ThreadPool(max(1, min(workers, len(names))))
+            try:
+                for name, info in workers.map(lambda name: _stat_(ioctx, name), names, chunksize=1):
+                    if info is not None:
+                        vdis[name] = info
+            finally:
+                workers.close()
+        return vdis
+    except Exception as e:
+        log.error("%s: xcpng.librbd.rbd_utils.rbd_scan: Failed to scan images: Cluster ID: %s Pool %s"
+                  % (dbg, cluster.get_fsid(), pool))
+        log.error(traceback.format_exc())
+        raise Exception(e)
+
+
+@timed('rbd_rename')
 def rbd_rename(dbg, cluster, pool, old_name, new_name):
-    log.debug("%s: xcpng.librbd.rbd_utils.rbd_rename: Cluster ID: %s Pool: %s Old name: %s New name: %s"
-              % (dbg, cluster.get_fsid(), pool, old_name, new_name))
+    debug("%s: xcpng.librbd.rbd_utils.rbd_rename: Cluster ID: %s Pool: %s Old name: %s New name: %s",
+          dbg, fsid(cluster), pool, old_name, new_name)
 
-    ioctx = cluster.open_ioctx(pool)
     rbd_inst = RBD()
 
     try:
-        rbd_inst.rename(ioctx, old_name, new_name)
+        cluster.invalidate_image(pool, old_name)
+        cluster.invalidate_image(pool, new_name)
+        with cluster.ioctx(pool) as ioctx:
+            rbd_inst.rename(ioctx, old_name, new_name)
     except Exception as e:
         log.error("%s: xcpng.librbd.rbd_utils.rbd_utilisation: Failed to get an image utilization: Cluster ID: %s Pool %s Old Name: %s New Name: %s"
                   % (dbg, cluster.get_fsid(), pool, old_name, new_name))
         log.error(traceback.format_exc())
         raise Exception(e)
-    finally:
-        ioctx.close()
 
 
-def rbd_clone(dbg, cluster, parent_pool, parent, snapshot, clone_pool, clone):
-    log.debug("%s: xcpng.librbd.rbd_utils.rbd_clone: Cluster ID: %s Parent Pool: %s Parent: %s Snapshot: %s Clone Pool: %s Clone: %s"
-              % (dbg, cluster.get_fsid(), parent_pool, parent, snapshot, clone_pool, clone))
-    p_ioctx = cluster.open_ioctx(parent_pool)
-    p_image = Image(p_ioctx, parent)
-    c_ioctx = cluster.open_ioctx(clone_pool)
+@timed('rbd_clone')
+def rbd_clone(dbg, cluster, parent_pool, parent, snapshot, clone_pool, clone, features=RBD_DEFAULT_FEATURES,
+              order=RBD_IMAGE_ORDER, stripe_unit=0, stripe_count=0, data_pool=None):
+    debug("%s: xcpng.librbd.rbd_utils.rbd_clone: Cluster ID: %s Parent Pool: %s Parent: %s Snapshot: %s Clone Pool: %s Clone: %s "
+          "Features: %s Order: %s Stripe unit: %s Stripe count: %s Data pool: %s",
+          dbg, fsid(cluster), parent_pool, parent, snapshot, clone_pool, clone, features, order, stripe_unit,
+          stripe_count, data_pool)
     rbd_inst = RBD()
 
     try:
-        if not p_image.is_protected_snap(snapshot):
-            p_image.protect_snap(snapshot)
-        rbd_inst.clone(p_ioctx, parent, snapshot, c_ioctx, clone)
+        with cluster.image(parent_pool, parent) as p_image:
+            if not p_image.is_protected_snap(snapshot):
+                p_image.protect_snap(snapshot)
+        with cluster.ioctx(parent_pool) as p_ioctx, cluster.ioctx(clone_pool) as c_ioctx:
+            rbd_inst.clone(p_ioctx, parent, snapshot, c_ioctx, clone,
+                           **_layout_args(features, order, stripe_unit, stripe_count, data_pool))
     except Exception as e:
         log.error("%s: xcpng.librbd.rbd_utils.rbd_clone: Failed to make a clone: Cluster ID: %s Parent Pool: %s Parent: %s Snapshot: %s Clone Pool: %s Clone: %s"
               % (dbg, cluster.get_fsid(), parent_pool, parent, snapshot, clone_pool, clone))
         log.error(traceback.format_exc())
         raise Exception(e)
-    finally:
-        p_ioctx.close()
-        c_ioctx.close()
 
 
+@timed('rbd_snapshot')
 def rbd_snapshot(dbg, cluster, pool, name, snapshot):
-    log.debug("%s: xcpng.librbd.rbd_utils.rbd_snapshot: Cluster ID: %s Pool: %s Name: %s Snapshot: %s"
-        % (dbg, cluster.get_fsid(), pool, name, snapshot))
-    ioctx = cluster.open_ioctx(pool)
-    image = Image(ioctx, name)
+    debug("%s: xcpng.librbd.rbd_utils.rbd_snapshot: Cluster ID: %s Pool: %s Name: %s Snapshot: %s",
+          dbg, fsid(cluster), pool, name, snapshot)
 
     try:
-        image.create_snap(snapshot)
+        with cluster.image(pool, name) as image:
+            image.create_snap(snapshot)
     except Exception as e:
         log.error("%s: xcpng.librbd.rbd_utils.rbd_clone: Failed to take a snapshot: Cluster ID: %s Pool: %s Name: %s Snapshot: %s"
                   % (dbg, cluster.get_fsid(), pool, name, snapshot))
         log.error(traceback.format_exc())
         raise Exception(e)
-    finally:
-        ioctx.close()
+
+
+def rbd_parent(dbg, cluster, pool, name):
+    """Returns (pool, image, snapshot) of the parent of a clone, None for an image that isn't one"""
+    debug("%s: xcpng.librbd.rbd_utils.rbd_parent: Cluster ID: %s Pool: %s Name: %s",
+          dbg, fsid(cluster), pool, name)
+    try:
+        with cluster.image(pool, name, read_only=True) as image:
+            return tuple(image.parent_info())
+    except ImageNotFound:
+        return None
+    except Exception as e:
+        log.error("%s: xcpng.librbd.rbd_utils.rbd_parent: Failed to get the parent of an image: Cluster ID: %s Pool: %s Name: %s"
+                  % (dbg, cluster.get_fsid(), pool, name))
+        log.error(traceback.format_exc())
+        raise Exception(e)
+
+
+def rbd_chain_depth(dbg, cluster, pool, name):
+    """Returns the number of ancestors a read of the image may have to go through"""
+    depth = 0
+    parent = rbd_parent(dbg, cluster, pool, name)
+    while parent is not None:
+        depth += 1
+        parent = rbd_parent(dbg, cluster, parent[0], parent[1])
+    return depth
+
+
+def rbd_parent_ratio(dbg, cluster, pool, name):
+    """Returns the share of the allocated data of a clone that is still read from its ancestors"""
+    debug("%s: xcpng.librbd.rbd_utils.rbd_parent_ratio: Cluster ID: %s Pool: %s Name: %s",
+          dbg, fsid(cluster), pool, name)
+    try:
+        with cluster.image(pool, name, read_only=True) as image:
+            size = image.size()
+            total = _diff_used(image, 0, size, include_parent=True)
+            if total == 0:
+                return 0.0
+            return float(total - _diff_used(image, 0, size)) / total
+    except Exception as e:
+        log.error("%s: xcpng.librbd.rbd_utils.rbd_parent_ratio: Failed to diff an image: Cluster ID: %s Pool: %s Name: %s"
+                  % (dbg, cluster.get_fsid(), pool, name))
+        log.error(traceback.format_exc())
+        raise Exception(e)
+
+
+def rbd_children(dbg, cluster, pool, name, snapshot):
+    """Returns [(pool, image)] of the clones of snapshot"""
+    debug("%s: xcpng.librbd.rbd_utils.rbd_children: Cluster ID: %s Pool: %s Name: %s Snapshot: %s",
+          dbg, fsid(cluster), pool, name, snapshot)
+    try:
+        with cluster.ioctx(pool) as ioctx:
+            image = Image(ioctx, name, snapshot=snapshot, read_only=True)
+            try:
+                return [tuple(child) for child in image.list_children()]
+            finally:
+                image.close()
+    except Exception as e:
+        log.error("%s: xcpng.librbd.rbd_utils.rbd_children: Failed to list clones: Cluster ID: %s Pool: %s Name: %s Snapshot: %s"
+                  % (dbg, cluster.get_fsid(), pool, name, snapshot))
+        log.error(traceback.format_exc())
+        raise Exception(e)
+
+
+def rbd_list_snapshots(dbg, cluster, pool, name):
+    debug("%s: xcpng.librbd.rbd_utils.rbd_list_snapshots: Cluster ID: %s Pool: %s Name: %s",
+          dbg, fsid(cluster), pool, name)
+    try:
+        with cluster.image(pool, name, read_only=True) as image:
+            return [snap['name'] for snap in image.list_snaps()]
+    except Exception as e:
+        log.error("%s: xcpng.librbd.rbd_utils.rbd_list_snapshots: Failed to list snapshots: Cluster ID: %s Pool: %s Name: %s"
+                  % (dbg, cluster.get_fsid(), pool, name))
+        log.error(traceback.format_exc())
+        raise Exception(e)
+
+
+@timed('rbd_remove_snapshot')
+def rbd_remove_snapshot(dbg, cluster, pool, name, snapshot):
+    """Unprotects and removes snapshot, which must have no clones left"""
+    debug("%s: xcpng.librbd.rbd_utils.rbd_remove_snapshot: Cluster ID: %s Pool: %s Name: %s Snapshot: %s",
+          dbg, fsid(cluster), pool, name, snapshot)
+    try:
+        with cluster.image(pool, name) as image:
+            if image.is_protected_snap(snapshot):
+                image.unprotect_snap(snapshot)
+            image.remove_snap(snapshot)
+    except Exception as e:
+        log.error("%s: xcpng.librbd.rbd_utils.rbd_remove_snapshot: Failed to remove a snapshot: Cluster ID: %s Pool: %s Name: %s Snapshot: %s"
+                  % (dbg, cluster.get_fsid(), pool, name, snapshot))
+        log.error(traceback.format_exc())
+        raise Exception(e)
+
+
+@timed('rbd_flatten')
+def rbd_flatten(dbg, cluster, pool, name, rate=0):
+    """Copies the data a clone still shares with its parent into it and detaches it from the parent
+
+    With rate (bytes per second) the copy is paced from librbd's progress callback, so a flatten
+    doesn't starve the guests of the cluster's bandwidth. Bindings without the callback flatten at
+    full speed.
+    """
+    debug("%s: xcpng.librbd.rbd_utils.rbd_flatten: Cluster ID: %s Pool: %s Name: %s Rate: %s",
+          dbg, fsid(cluster), pool, name, rate)
+    try:
+        with cluster.image(pool, name) as image:
+            size = image.size()
+            start = time()
+
+            def _progress_(offset, total):
+                if total:
+                    ahead = start + float(size) * offset / total / rate - time()
+                    if ahead > 0:
+                        sleep(ahead)
+                return 0
+
+            if rate:
+                try:
+                    image.flatten(on_progress=_progress_)
+                    return
+                except TypeError:
+                    debug("%s: xcpng.librbd.rbd_utils.rbd_flatten: No progress callback in this binding, "
+                          "flattening %s unthrottled", dbg, name)
+            image.flatten()
+    except Exception as e:
+        log.error("%s: xcpng.librbd.rbd_utils.rbd_flatten: Failed to flatten an image: Cluster ID: %s Pool: %s Name: %s"
+                  % (dbg, cluster.get_fsid(), pool, name))
+        log.error(traceback.format_exc())
+        raise Exception(e)
 
 
 def rbd_exists(dbg, cluster, pool, name):
-    log.debug("%s: rbd_utils.rbd_exist: Cluster ID: %s Image: %s"
-              % (dbg, cluster.get_fsid(), name))
-    ioctx = cluster.open_ioctx(pool)
+    debug("%s: rbd_utils.rbd_exist: Cluster ID: %s Image: %s",
+          dbg, fsid(cluster), name)
     try:
-        Image(ioctx, name)
-        return True
+        with cluster.image(pool, name, read_only=True):
+            return True
     except Exception:
         return False
-    finally:
-        ioctx.close()
 
 
-def rbd_lock(dbg, cluster, pool, name):
-    log.debug("%s: xcpng.librbd.rbd_utils.rbd_lock: Cluster ID: %s Pool: %s Name: %s"
-              % (dbg, cluster.get_fsid(), pool, name))
+@timed('rbd_lock')
+def rbd_lock(dbg, cluster, pool, name, shared=False):
+    debug("%s: xcpng.librbd.rbd_utils.rbd_lock: Cluster ID: %s Pool: %s Name: %s Shared: %s",
+          dbg, fsid(cluster), pool, name, shared)
     ioctx = cluster.open_ioctx(pool)
     image = Image(ioctx, name)
     try:
-        image.lock_exclusive('xapi-xcpng-lock')
+        if shared:
+            image.lock_shared(LOCK_COOKIE, LOCK_SHARED_TAG)
+        else:
+            image.lock_exclusive(LOCK_COOKIE)
         return ioctx, image
-    except ImageBusy or ImageExists as e:
-        log.error("%s: xcpng.librbd.rbd_utils.rbd_lock: Failed to acquire exclusive lock: Cluster ID: %s Pool: %s Name: %s"
-                  % (dbg, cluster.get_fsid(), pool, name))
-        log.error(traceback.format_exc())
+    except (ImageBusy, ImageExists) as e:
+        # Contention is expected here, LocksOpsMgr.lock() retries and logs the final failure
+        debug("%s: xcpng.librbd.rbd_utils.rbd_lock: Failed to acquire %s lock: Cluster ID: %s Pool: %s Name: %s",
+              dbg, 'shared' if shared else 'exclusive', fsid(cluster), pool, name)
         image.close()
         ioctx.close()
         raise Exception(e)
 
-def is_locked(dbg, cluster, pool, name):
-    log.debug("%s: xcpng.librbd.rbd_utils.is_locked: Cluster ID: %s Pool: %s Name: %s"
-              % (dbg, cluster.get_fsid(), pool, name))
-    ioctx = cluster.open_ioctx(pool)
-    image = Image(ioctx, name)
-    if len(image.list_lockers()) > 0:
-        return True
-    else:
-        return False
+
+@timed('is_locked')
+def is_locked(dbg, cluster, pool, name, exclusive=False):
+    """Returns True if the image has lockers, or only if it is locked exclusively when exclusive=True"""
+    debug("%s: xcpng.librbd.rbd_utils.is_locked: Cluster ID: %s Pool: %s Name: %s",
+          dbg, fsid(cluster), pool, name)
+    with cluster.image(pool, name, read_only=True) as image:
+        lockers = image.list_lockers()
+        if len(lockers) > 0:
+            return lockers['exclusive'] or not exclusive
+        else:
+            return False
 
 
+@timed('rbd_unlock')
 def rbd_unlock(dbg, lh):
-    log.debug("%s: xcpng.librbd.rbd_utils.rbd_unlock" % (dbg))
-    lh[2].unlock('xapi-xcpng-lock')
+    debug("%s: xcpng.librbd.rbd_utils.rbd_unlock", dbg)
+    lh[2].unlock(LOCK_COOKIE)
     lh[2].close()
     lh[1].close()
 
 
+class RBDLockWatch(object):
+    """Wakes up a waiter for an rbd lock as soon as the holder announces the release with rbd_lock_notify()
+
+    Uses a RADOS watch when the binding supports it. Without one wait() simply sleeps, so callers get
+    plain backoff.
+    """
+
+    def __init__(self, dbg, cluster, pool, name):
+        self.dbg = dbg
+        self.event = threading.Event()
+        self.ioctx = cluster.open_ioctx(pool)  # private, a cached IoCtx could be closed under the watch
+        self.watch = None
+        if hasattr(self.ioctx, 'watch'):
+            try:
+                self.watch = self.ioctx.watch(LOCK_NOTIFY_OBJECT % name, self._notified)
+            except Exception:
+                log.error("%s: xcpng.librbd.rbd_utils.RBDLockWatch: Failed to watch %s, falling back to polling"
+                          % (dbg, name))
+                log.error(traceback.format_exc())
+
+    def _notified(self, *args):
+        self.event.set()
+
+    def clear(self):
+        self.event.clear()
+
+    def wait(self, timeout):
+        """Returns True if woken up by a release notification"""
+        return self.event.wait(timeout)
+
+    def close(self):
+        if self.watch is not None:
+            try:
+                self.watch.close()
+            except Exception:
+                log.error(traceback.format_exc())
+            self.watch = None
+        self.ioctx.close()
+
+
+@timed('rbd_lock_notify')
+def rbd_lock_notify(dbg, cluster, pool, name):
+    debug("%s: xcpng.librbd.rbd_utils.rbd_lock_notify: Cluster ID: %s Pool: %s Name: %s",
+          dbg, fsid(cluster), pool, name)
+    try:
+        with cluster.ioctx(pool) as ioctx:
+            ioctx.notify(LOCK_NOTIFY_OBJECT % name, 'unlocked', LOCK_NOTIFY_TIMEOUT_MS)
+    except Exception:
+        # Waiters still find the lock free when their backoff expires
+        log.error("%s: xcpng.librbd.rbd_utils.rbd_lock_notify: Failed to notify waiters: Pool: %s Name: %s"
+                  % (dbg, pool, name))
+        log.error(traceback.format_exc())
+
+
+@timed('rbd_read')
 def rbd_read(dbg, cluster, pool, name, offset, length):
-    log.debug("%s: xcpng.librbd.rbd_utils.rbd_read: Cluster ID: %s Pool: %s Name: %s Offset: %s Length: %s"
-              % (dbg, cluster.get_fsid(), pool, name, offset, length))
-    ioctx = cluster.open_ioctx(pool)
+    debug("%s: xcpng.librbd.rbd_utils.rbd_read: Cluster ID: %s Pool: %s Name: %s Offset: %s Length: %s",
+          dbg, fsid(cluster), pool, name, offset, length)
     try:
-        image = Image(ioctx, name)
-        return image.read(offset, length)
+        with cluster.image(pool, name, read_only=True) as image:
+            return image.read(offset, length)
     except ImageBusy or ImageExists as e:
         log.error("%s: xcpng.librbd.rbd_utils.rbd_read: Failed to read from the image: Cluster ID: %s Pool: %s Name: %s"
                   % (dbg, cluster.get_fsid(), pool, name))
         log.error(traceback.format_exc())
         raise Exception(e)
-    finally:
-        ioctx.close()
 
 
+@timed('rbd_write')
 def rbd_write(dbg, cluster, pool, name, data, offset, length):
-    log.debug("%s: xcpng.librbd.rbd_utils.rbd_wite: Cluster ID: %s Pool: %s Name: %s Offset: %s Length: %s"
-              % (dbg, cluster.get_fsid(), pool, name, offset, length))
-    ioctx = cluster.open_ioctx(pool)
+    debug("%s: xcpng.librbd.rbd_utils.rbd_wite: Cluster ID: %s Pool: %s Name: %s Offset: %s Length: %s",
+          dbg, fsid(cluster), pool, name, offset, length)
     try:
-        image = Image(ioctx, name)
-        image.write(data, offset)
+        with cluster.image(pool, name) as image:
+            image.write(data, offset)
     except ImageBusy or ImageExists as e:
         log.error("%s: xcpng.librbd.rbd_utils.rbd_lock: Failed to write to the image: Cluster ID: %s Pool: %s Name: %s"
                   % (dbg, cluster.get_fsid(), pool, name))
         log.error(traceback.format_exc())
         raise Exception(e)
-    finally:
-        ioctx.close()
+
+
+class OmapCompareFailed(Exception):
+    """The object didn't hold the omap value a conditional rados_omap_set() expected"""
+
+
+def rados_omap_get(dbg, cluster, pool, obj, keys=None):
+    """Returns omap of a RADOS object as a dict, either all of it or only the given keys.
+
+    A missing object reads as an empty omap
+    """
+    return rados_omap_get_versioned(dbg, cluster, pool, obj, keys)[0]
+
+
+@timed('rados_omap_get')
+def rados_omap_get_versioned(dbg, cluster, pool, obj, keys=None, version_key=None):
+    """Like rados_omap_get() but also returns the value of version_key, a key every writer of the object
+    changes (None if it isn't set). A full read spanning several batches is retried if it changed in
+    between.
+
+    The object's RADOS version can't serve here: it is that of the whole placement group, which any
+    write to another object of the PG moves
+    """
+    debug("%s: xcpng.librbd.rbd_utils.rados_omap_get_versioned: Cluster ID: %s Pool: %s Object: %s Keys: %s",
+          dbg, fsid(cluster), pool, obj, keys)
+    try:
+        with cluster.ioctx(pool) as ioctx:
+            while True:
+                values = {}
+                versions = set()
+                start_after = ''
+                while True:
+                    with ReadOpCtx() as read_op:
+                        if keys is not None:
+                            vals, ret = ioctx.get_omap_vals_by_keys(read_op, tuple(keys))
+                        else:
+                            vals, ret = ioctx.get_omap_vals(read_op, start_after, '', OMAP_READ_BATCH)
+                        if version_key is not None:
+                            version, ret = ioctx.get_omap_vals_by_keys(read_op, (version_key,))
+                        ioctx.operate_read_op(read_op, obj)
+                        batch = list(vals)
+                        if version_key is not None:
+                            versions.add(dict(version).get(version_key))
+                    values.update(batch)
+                    if keys is not None or len(batch) < OMAP_READ_BATCH:
+                        break
+                    start_after = batch[-1][0]
+                if len(versions) <= 1:
+                    return values, versions.pop() if versions else None
+    except ObjectNotFound:
+        return {}, None
+    except Exception as e:
+        log.error("%s: xcpng.librbd.rbd_utils.rados_omap_get_versioned: Failed to read omap: Cluster ID: %s Pool: %s Object: %s"
+                  % (dbg, cluster.get_fsid(), pool, obj))
+        log.error(traceback.format_exc())
+        raise Exception(e)
+
+
+@timed('rados_omap_set')
+def rados_omap_set(dbg, cluster, pool, obj, values, remove_keys=(), expect=None):
+    """Sets and removes omap keys of a RADOS object in one atomic write op, creating the object if needed.
+
+    With expect=(key, value) the write only happens if the omap holds that value, raises
+    OmapCompareFailed otherwise. Bindings without WriteOp.omap_cmp (before Pacific) check it with a
+    read just before the write instead, which leaves a short window open. With expect=(key, None) the
+    write only happens if the object doesn't exist yet
+    """
+    debug("%s: xcpng.librbd.rbd_utils.rados_omap_set: Cluster ID: %s Pool: %s Object: %s Set: %s Remove: %s",
+          dbg, fsid(cluster), pool, obj, len(values), len(remove_keys))
+    try:
+        with cluster.ioctx(pool) as ioctx:
+            with WriteOpCtx() as write_op:
+                if expect is not None and expect[1] is None:
+                    if hasattr(write_op, 'new'):
+                        write_op.new(RADOS_CREATE_EXCLUSIVE)
+                    elif rados_omap_get(dbg, cluster, pool, obj, [expect[0]]).get(expect[0]) is not None:
+                        raise OmapCompareFailed("%s/%s: already exists" % (pool, obj))
+                elif expect is not None:
+                    if hasattr(write_op, 'omap_cmp'):
+                        write_op.omap_cmp(expect[0], expect[1])
+                    elif rados_omap_get(dbg, cluster, pool, obj, [expect[0]]).get(expect[0]) != expect[1]:
+                        raise OmapCompareFailed("%s/%s: %s isn't %s" % (pool, obj, expect[0], expect[1]))
+                if values:
+                    keys = list(values.keys())
+                    ioctx.set_omap(write_op, tuple(keys), tuple(values[key] for key in keys))
+                if remove_keys:
+                    ioctx.remove_omap_keys(write_op, tuple(remove_keys))
+                try:
+                    ioctx.operate_write_op(write_op, obj)
+                except ObjectExists:
+                    raise OmapCompareFailed("%s/%s: already exists" % (pool, obj))
+                except RadosError as e:
+                    if expect is not None and abs(getattr(e, 'errno', 0) or 0) == ECANCELED:
+                        raise OmapCompareFailed("%s/%s: %s isn't %s" % (pool, obj, expect[0], expect[1]))
+                    raise
+    except OmapCompareFailed:
+        raise
+    except Exception as e:
+        log.error("%s: xcpng.librbd.rbd_utils.rados_omap_set: Failed to write omap: Cluster ID: %s Pool: %s Object: %s"
+                  % (dbg, cluster.get_fsid(), pool, obj))
+        log.error(traceback.format_exc())
+        raise Exception(e)
+
+
+@timed('rados_remove')
+def rados_remove(dbg, cluster, pool, obj):
+    debug("%s: xcpng.librbd.rbd_utils.rados_remove: Cluster ID: %s Pool: %s Object: %s",
+          dbg, fsid(cluster), pool, obj)
+    try:
+        with cluster.ioctx(pool) as ioctx:
+            ioctx.remove_object(obj)
+    except ObjectNotFound:
+        pass
+    except Exception as e:
+        log.error("%s: xcpng.librbd.rbd_utils.rados_remove: Failed to remove object: Cluster ID: %s Pool: %s Object: %s"
+                  % (dbg, cluster.get_fsid(), pool, obj))
+        log.error(traceback.format_exc())
+        raise Exception(e)
@@ -7,8 +7,14 @@ from xapi.storage.libs.xcpng.sr import SROperations as _SROperations_
 from xapi.storage.libs.xcpng.utils import POOL_PREFIX, SR_PATH_PREFIX, VDI_PREFIXES, \
                                           get_sr_type_by_uri, get_sr_uuid_by_uri, mkdir_p, get_vdi_type_by_uri, \
                                           get_sr_name_by_uri, get_cluster_name_by_uri, get_sr_uuid_by_name
-from xapi.storage.libs.xcpng.librbd.meta import CEPH_CLUSTER_TAG
-from xapi.storage.libs.xcpng.librbd.rbd_utils import get_config_files_list, pool_list, rbd_list, ceph_cluster
+from xapi.storage.libs.xcpng.librbd.meta import CEPH_CLUSTER_TAG, SR_CONFIG_OBJECT
+from xapi.storage.libs.xcpng.librbd.rbd_utils import get_config_files_list, clusters_pool_list, rbd_list, rbd_scan, \
+                                                     ceph_cluster, rados_omap_set, POOL_LIST_CACHE
+from xapi.storage.libs.xcpng.librbd.flatten import pending_images
+from xapi.storage.libs.xcpng.librbd.stats import POOL_STATS
+from xapi.storage.libs.xcpng.librbd.tuning import get_tuning_profile
+from xapi.storage.libs.xcpng.librbd.layout import get_layout_profile, merge_layout_profiles
+from xapi.storage.libs.xcpng.librbd.trace import debug
 
 
 class SROperations(_SROperations_):
@@ -19,7 +25,7 @@ class SROperations(_SROperations_):
         super(SROperations, self).__init__()
 
     def extend_uri(self, dbg, uri, configuration):
-        log.debug("%s: xcpng.librbd.sr.SROperations.extend_uri: uri: %s configuration %s" % (dbg, uri, configuration))
+        debug("%s: xcpng.librbd.sr.SROperations.extend_uri: uri: %s configuration %s", dbg, uri, configuration)
 
         if CEPH_CLUSTER_TAG in configuration:
             return "%s%s" % (uri, configuration[CEPH_CLUSTER_TAG])
@@ -27,32 +33,50 @@ class SROperations(_SROperations_):
             return uri
 
     def create(self, dbg, uri, configuration):
-        log.debug("%s: xcpng.librbd.sr.SROperations.create: uri: %s configuration %s" % (dbg, uri, configuration))
+        debug("%s: xcpng.librbd.sr.SROperations.create: uri: %s configuration %s", dbg, uri, configuration)
 
         if CEPH_CLUSTER_TAG not in configuration:
             raise Exception('Failed to connect to CEPH cluster. Parameter \'cluster\' is not specified')
 
+        profile = self._get_config_profile(dbg, configuration)
         cluster = ceph_cluster(dbg, configuration[CEPH_CLUSTER_TAG])
 
         try:
             cluster.connect()
+            self._check_data_pool(cluster, profile)
             cluster.create_pool(get_sr_name_by_uri(dbg, uri))
+            POOL_LIST_CACHE.invalidate(configuration[CEPH_CLUSTER_TAG])
+            if profile:
+                rados_omap_set(dbg, cluster, get_sr_name_by_uri(dbg, uri), SR_CONFIG_OBJECT, profile)
         except Exception as e:
-            log.debug("%s: xcpng.librbd.sr.SROperations.create: uri: Failed to create SR: uri: %s"
-                      % dbg, uri)
+            debug("%s: xcpng.librbd.sr.SROperations.create: uri: Failed to create SR: uri: %s",
+                  dbg, uri)
             log.error(traceback.format_exc())
             raise Exception(e)
         finally:
             cluster.shutdown()
 
+    def _get_config_profile(self, dbg, configuration):
+        """Returns the tuning and layout keys of device-config to keep with the SR"""
+        profile = get_tuning_profile(dbg, configuration)
+        layout = get_layout_profile(dbg, configuration)
+        merge_layout_profiles(layout)  # fails SR.create rather than every VDI.create on a bad striping
+        profile.update(layout)
+        return profile
+
+    def _check_data_pool(self, cluster, profile):
+        if profile.get('rbd-data-pool') and not cluster.pool_exists(profile['rbd-data-pool']):
+            raise Exception("CEPH pool %s doesn\'t exist" % profile['rbd-data-pool'])
+
     def destroy(self, dbg, uri):
-        log.debug("%s: xcpng.librbd.sr.SROperations.destroy: uri: %s" % (dbg, uri))
+        debug("%s: xcpng.librbd.sr.SROperations.destroy: uri: %s", dbg, uri)
 
         cluster = ceph_cluster(dbg, get_cluster_name_by_uri(dbg, uri))
 
         try:
             cluster.connect()
             cluster.delete_pool(get_sr_name_by_uri(dbg, uri))
+            POOL_LIST_CACHE.invalidate(get_cluster_name_by_uri(dbg, uri))
         except Exception as e:
             log.debug("%s: xcpng.librbd.sr.SROperations.destory: Failed to destroy SR: uri: %s"
                       % dbg, uri)
@@ -62,14 +86,14 @@ class SROperations(_SROperations_):
             cluster.shutdown()
 
     def get_sr_list(self, dbg, uri, configuration):
-        log.debug("%s: xcpng.librbd.sr.SROperations.get_sr_list: uri: %s configuration %s" % (dbg, uri, configuration))
+        debug("%s: xcpng.librbd.sr.SROperations.get_sr_list: uri: %s configuration %s", dbg, uri, configuration)
 
         srs = []
         uris = []
 
         cluster_in_uri = get_cluster_name_by_uri(dbg, uri)
 
-        log.debug("%s: xcpng.librbd.sr.SROperations.get_sr_list: uris: %s" % (dbg, uris))
+        debug("%s: xcpng.librbd.sr.SROperations.get_sr_list: uris: %s", dbg, uris)
 
         if cluster_in_uri == '':
             for cluster in get_config_files_list(dbg):
@@ -77,49 +101,72 @@ class SROperations(_SROperations_):
         else:
             uris = [uri]
 
-        log.debug("%s: xcpng.librbd.sr.SROperations.get_sr_list: uris: %s" % (dbg, uris))
+        debug("%s: xcpng.librbd.sr.SROperations.get_sr_list: uris: %s", dbg, uris)
+
+        # Clusters are probed concurrently, one that is down only drops its own SRs from the list
+        pools = clusters_pool_list(dbg, [get_cluster_name_by_uri(dbg, _uri_) for _uri_ in uris])
+        if cluster_in_uri != '' and cluster_in_uri not in pools:
+            raise Exception("Failed to get SRs list of CEPH cluster %s" % cluster_in_uri)
 
         for _uri_ in uris:
-            cluster_name = get_cluster_name_by_uri(dbg, _uri_)
-            cluster = ceph_cluster(dbg, cluster_name)
-            try:
-                cluster.connect()
-                for pool in pool_list(dbg, cluster):
-                    if pool.startswith("%s%s" % (get_sr_type_by_uri(dbg, uri), POOL_PREFIX)):
-                        srs.append("%s/%s" % (_uri_, get_sr_uuid_by_name(dbg, pool)))
-            except Exception as e:
-                log.debug("%s: xcpng.librbd.sr.SROperations.get_sr_list: uri: Failed to get SRs list: uri: %s"
-                          % dbg, uri)
-                log.error(traceback.format_exc())
-                raise Exception(e)
-            finally:
-                cluster.shutdown()
-        log.debug("%s: xcpng.librbd.sr.SROperations.get_sr_list: srs: %s" % (dbg, srs))
+            for pool in pools.get(get_cluster_name_by_uri(dbg, _uri_), []):
+                if pool.startswith("%s%s" % (get_sr_type_by_uri(dbg, uri), POOL_PREFIX)):
+                    srs.append("%s/%s" % (_uri_, get_sr_uuid_by_name(dbg, pool)))
+        debug("%s: xcpng.librbd.sr.SROperations.get_sr_list: srs: %s", dbg, srs)
         return srs
 
     def get_vdi_list(self, dbg, uri):
-        log.debug("%s: xcpng.librbd.sr.SROperations.get_vdi_list: uri: %s" % (dbg, uri))
+        debug("%s: xcpng.librbd.sr.SROperations.get_vdi_list: uri: %s", dbg, uri)
 
-        rbds = []
         cluster = ceph_cluster(dbg, get_cluster_name_by_uri(dbg, uri))
 
         try:
             cluster.connect()
-            for rbd in rbd_list(dbg, cluster, get_sr_name_by_uri(dbg, uri)):
-                if rbd.startswith(VDI_PREFIXES[get_vdi_type_by_uri(dbg, uri)]):
-                    rbds.append(rbd)
-            return rbds
+            pool = get_sr_name_by_uri(dbg, uri)
+            # One pool listing, use scan_vdis() where the sizes or parents are needed too
+            pending = pending_images(dbg, cluster, pool)
+            return [rbd for rbd in rbd_list(dbg, cluster, pool)
+                    if rbd.startswith(VDI_PREFIXES[get_vdi_type_by_uri(dbg, uri)]) and rbd not in pending]
         except Exception as e:
-            log.debug("%s: xcpng.librbd.sr.SROperations.get_vdi_list: uri: Failed to get VDIs list: uri: %s"
-                      % dbg, uri)
+            debug("%s: xcpng.librbd.sr.SROperations.get_vdi_list: uri: Failed to get VDIs list: uri: %s",
+                  dbg, uri)
+            log.error(traceback.format_exc())
+            raise Exception(e)
+        finally:
+            cluster.shutdown()
+
+    def scan_vdis(self, dbg, uri, utilization=False):
+        """Returns {image name: {'size', 'parent', 'utilization'}} of all VDIs of the SR in one pass
+
+        Computing the utilization may diff every image, so it is None unless asked for.
+        """
+        debug("%s: xcpng.librbd.sr.SROperations.scan_vdis: uri: %s", dbg, uri)
+
+        cluster = ceph_cluster(dbg, get_cluster_name_by_uri(dbg, uri))
+
+        try:
+            cluster.connect()
+            vdis = rbd_scan(dbg,
+                            cluster,
+                            get_sr_name_by_uri(dbg, uri),
+                            VDI_PREFIXES[get_vdi_type_by_uri(dbg, uri)],
+                            utilization)
+            # Destroyed, the pool worker trashes them once their clones are flattened
+            for name in pending_images(dbg, cluster, get_sr_name_by_uri(dbg, uri)):
+                vdis.pop(name, None)
+            return vdis
+        except Exception as e:
+            debug("%s: xcpng.librbd.sr.SROperations.scan_vdis: uri: Failed to scan VDIs: uri: %s",
+                  dbg, uri)
             log.error(traceback.format_exc())
             raise Exception(e)
         finally:
             cluster.shutdown()
 
     def sr_import(self, dbg, uri, configuration):
-        log.debug("%s: xcpng.librbd.sr.SROperations.sr_import: uri: %s configuration %s" % (dbg, uri, configuration))
+        debug("%s: xcpng.librbd.sr.SROperations.sr_import: uri: %s configuration %s", dbg, uri, configuration)
 
+        profile = self._get_config_profile(dbg, configuration)
         cluster = ceph_cluster(dbg, get_cluster_name_by_uri(dbg, uri))
         pool_name = get_sr_name_by_uri(dbg, uri)
 
@@ -127,9 +174,14 @@ class SROperations(_SROperations_):
             cluster.connect()
             if not cluster.pool_exists(pool_name):
                 raise Exception("CEPH pool %s doesn\'t exist" % pool_name)
+            self._check_data_pool(cluster, profile)
+            if profile:
+                # device-config changed since SR.create takes effect for VDIs attached (tuning) or created
+                # (layout) from now on
+                rados_omap_set(dbg, cluster, pool_name, SR_CONFIG_OBJECT, profile)
         except Exception as e:
-            log.debug("%s: xcpng.librbd.sr.SROperations.sr_import: uri: Failed to import SR: uri: %s"
-                      % dbg, uri)
+            debug("%s: xcpng.librbd.sr.SROperations.sr_import: uri: Failed to import SR: uri: %s",
+                  dbg, uri)
             log.error(traceback.format_exc())
             raise Exception(e)
         finally:
@@ -142,35 +194,23 @@ class SROperations(_SROperations_):
         pass
 
     def get_free_space(self, dbg, uri):
-        log.debug("%s: xcpng.librbd.sr.SROperations.get_free_space: uri: %s" % (dbg, uri))
-
-        cluster = ceph_cluster(dbg, get_cluster_name_by_uri(dbg, uri))
+        debug("%s: xcpng.librbd.sr.SROperations.get_free_space: uri: %s", dbg, uri)
 
         try:
-            cluster.connect()
-            stats = cluster.get_cluster_stats()
-            return stats['kb_avail'] * 1024
+            return POOL_STATS.get(dbg, get_cluster_name_by_uri(dbg, uri), get_sr_name_by_uri(dbg, uri))['free']
         except Exception as e:
-            log.debug("%s: xcpng.librbd.sr.SROperations.get_free_space: uri: Failed to get free space: uri: %s"
-                      % dbg, uri)
+            debug("%s: xcpng.librbd.sr.SROperations.get_free_space: uri: Failed to get free space: uri: %s",
+                  dbg, uri)
             log.error(traceback.format_exc())
             raise Exception(e)
-        finally:
-            cluster.shutdown()
 
     def get_size(self, dbg, uri):
-        log.debug("%s: xcpng.librbd.sr.SROperations.sr_size: uri: %s" % (dbg, uri))
-
-        cluster = ceph_cluster(dbg, get_cluster_name_by_uri(dbg, uri))
+        debug("%s: xcpng.librbd.sr.SROperations.sr_size: uri: %s", dbg, uri)
 
         try:
-            cluster.connect()
-            stats = cluster.get_cluster_stats()
-            return stats['kb'] * 1024
+            return POOL_STATS.get(dbg, get_cluster_name_by_uri(dbg, uri), get_sr_name_by_uri(dbg, uri))['size']
         except Exception as e:
-            log.debug("%s: xcpng.librbd.sr.SROperations.get_size: uri: Failed to get size: uri: %s"
-                      % dbg, uri)
+            debug("%s: xcpng.librbd.sr.SROperations.get_size: uri: Failed to get size: uri: %s",
+                  dbg, uri)
             log.error(traceback.format_exc())
             raise Exception(e)
-        finally:
-            cluster.shutdown()
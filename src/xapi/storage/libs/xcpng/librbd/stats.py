@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+"""Per-pool capacity and usage of the SRs of a cluster, served from a host-local snapshot
+
+xapi polls SR.stat, which reads the size and free space of the SR. One refresh runs `ceph df` and
+`ceph osd pool ls detail` and keeps the result for every pool of the cluster, in memory and in
+<NBD_RUN_DIR>/<cluster>.stats so the short-lived plugin processes share it. Within
+STATS_REFRESH_INTERVAL seconds (HOST_CONFIG_FILE) callers don't contact the monitors at all. Only
+one process refreshes a stale snapshot at a time. The plugin daemon keeps the snapshot of every
+cluster of the host fresh from a background thread (PoolStatsService.start()), so the commands it
+runs, and the plugin processes reading the file, find it fresh; without the daemon the first caller
+after the interval refreshes it.
+
+The size of a pool is what it stores plus what it may still store (max_avail, which accounts for
+replication and the fullest OSD), capped by the pool's max_bytes quota.
+"""
+
+import json
+import os
+import threading
+import traceback
+
+from time import sleep, time
+from xapi.storage import log
+from xapi.storage.libs.xcpng.librbd.host import get_host_config, _lock_file
+from xapi.storage.libs.xcpng.librbd.nbd_utils import NBD_RUN_DIR
+from xapi.storage.libs.xcpng.librbd.rbd_utils import ceph_cluster
+from xapi.storage.libs.xcpng.librbd.trace import debug
+
+STATS_REFRESH_INTERVAL = 30  # seconds, see HOST_CONFIG_FILE
+MON_COMMAND_TIMEOUT = 10
+
+
+def _mon_command(cluster, command):
+    ret, outbuf, outs = cluster.mon_command(json.dumps(command), b'', timeout=MON_COMMAND_TIMEOUT)
+    if ret != 0:
+        raise Exception("ceph %s failed: %s" % (command['prefix'], outs))
+    return json.loads(outbuf)
+
+
+def query_pool_stats(dbg, cluster_name):
+    """Returns {pool: {'size', 'used', 'free', 'quota'}} in bytes for every pool of the cluster"""
+    debug("%s: xcpng.librbd.stats.query_pool_stats: Cluster: %s", dbg, cluster_name)
+
+    cluster = ceph_cluster(dbg, cluster_name)
+    try:
+        cluster.connect()
+        df = _mon_command(cluster, {'prefix': 'df', 'format': 'json'})
+        pools = _mon_command(cluster, {'prefix': 'osd pool ls', 'detail': 'detail', 'format': 'json'})
+    finally:
+        cluster.shutdown()
+
+    quotas = dict((pool['pool_name'], pool.get('quota_max_bytes', 0)) for pool in pools)
+    stats = {}
+    for pool in df['pools']:
+        # 'stored' is the data before replication, older releases only report 'bytes_used'
+        used = pool['stats'].get('stored', pool['stats'].get('bytes_used', 0))
+        size = used + pool['stats']['max_avail']
+        quota = quotas.get(pool['name'], 0)
+        if quota:
+            size = min(size, quota)
+        stats[pool['name']] = {'size': size, 'used': used, 'free': max(0, size - used), 'quota': quota}
+    return stats
+
+
+class PoolStatsService(object):
+
+    def __init__(self, run_dir=NBD_RUN_DIR):
+        self.run_dir = run_dir
+        self.refreshes = 0
+        self.__lock = threading.Lock()
+        self.__snapshots = {}  # cluster_name -> (time, stats)
+        self.__refreshers = {}
+
+    def get(self, dbg, cluster_name, pool):
+        """Returns the stats of pool, raises Exception if the pool doesn't exist"""
+        stats = self._snapshot(dbg, cluster_name)
+        if pool not in stats:
+            # Created since the last refresh
+            stats = self._snapshot(dbg, cluster_name, 0)
+        if pool not in stats:
+            raise Exception("CEPH pool %s doesn't exist" % pool)
+        return stats[pool]
+
+    def start(self, dbg, cluster_name):
+        """Refreshes the snapshot of cluster_name every interval from a daemon thread"""
+        with self.__lock:
+            if cluster_name in self.__refreshers:
+                return
+            refresher = threading.Thread(target=self._refresh_loop, args=(dbg, cluster_name))
+            refresher.daemon = True
+            self.__refreshers[cluster_name] = refresher
+        refresher.start()
+
+    def _interval(self, dbg):
+        return get_host_config(dbg, 'STATS_REFRESH_INTERVAL', STATS_REFRESH_INTERVAL)
+
+    def _path(self, cluster_name):
+        return os.path.join(self.run_dir, "%s.stats" % cluster_name)
+
+    def _snapshot(self, dbg, cluster_name, interval=None):
+        if interval is None:
+            interval = self._interval(dbg)
+        with self.__lock:
+            snapshot = self.__snapshots.get(cluster_name)
+        if snapshot is None or time() - snapshot[0] >= interval:
+            snapshot = self._load(dbg, cluster_name)
+            if snapshot is None or time() - snapshot[0] >= interval:
+                snapshot = self._refresh(dbg, cluster_name, interval)
+            with self.__lock:
+                self.__snapshots[cluster_name] = snapshot
+        return snapshot[1]
+
+    def _load(self, dbg, cluster_name):
+        try:
+            with open(self._path(cluster_name)) as f:
+                snapshot = json.load(f)
+            return snapshot['time'], snapshot['pools']
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+
+    def _refresh(self, dbg, cluster_name, interval):
+        fd = _lock_file(self.run_dir, "%s.lock" % self._path(cluster_name))
+        try:
+            # Another process may have refreshed it while we waited for the lock
+            snapshot = self._load(dbg, cluster_name)
+            if snapshot is not None and time() - snapshot[0] < interval:
+                return snapshot
+            snapshot = (time(), query_pool_stats(dbg, cluster_name))
+            self.refreshes += 1
+            path = self._path(cluster_name)
+            with open("%s.tmp" % path, 'w') as f:
+                json.dump({'time': snapshot[0], 'pools': snapshot[1]}, f)
+            os.rename("%s.tmp" % path, path)
+            return snapshot
+        finally:
+            os.close(fd)
+
+    def _refresh_loop(self, dbg, cluster_name):
+        while True:
+            # Refresh at half the interval, so callers never find the snapshot stale
+            interval = max(1.0, self._interval(dbg) / 2.0)
+            try:
+                self._snapshot(dbg, cluster_name, interval)
+            except Exception:
+                log.error("%s: xcpng.librbd.stats.PoolStatsService._refresh_loop: Failed to refresh stats of "
+                          "cluster %s" % (dbg, cluster_name))
+                log.error(traceback.format_exc())
+            sleep(interval)
+
+
+POOL_STATS = PoolStatsService()
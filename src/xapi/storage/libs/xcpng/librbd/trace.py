@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+"""Latency histograms and request traces of the plugin's cluster and datapath operations
+
+Operations are timed with the timed() decorator or the span() context manager and counted in the
+process-wide METRICS, one histogram of LATENCY_BUCKETS per operation and outcome ('ok' or 'error').
+With METRICS_DIR set in HOST_CONFIG_FILE, every process adds its counts to
+<METRICS_DIR>/rbdsr.json when it exits, and the resident daemon every METRICS_FLUSH_INTERVAL
+seconds. The totals are also written as the Prometheus text file <METRICS_DIR>/rbdsr.prom, for
+node_exporter's textfile collector.
+
+Every span is logged at debug level with the trace id of its request, a hash of the request's dbg
+string and process: all the cluster calls made for one SMAPI call share it.
+
+debug() formats its message only when LOG_DEBUG (HOST_CONFIG_FILE, default yes) is on, and fsid()
+puts off cluster.get_fsid() until then.
+"""
+
+import atexit
+import json
+import os
+import threading
+import traceback
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from hashlib import md5
+from time import time
+from xapi.storage import log
+from xapi.storage.libs.xcpng.librbd.host import get_host_config, _lock_file
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+METRICS_FILE = 'rbdsr.json'
+PROMETHEUS_FILE = 'rbdsr.prom'
+PROMETHEUS_METRIC = 'rbdsr_operation_duration_seconds'
+METRICS_FLUSH_INTERVAL = 60  # seconds between flushes of the resident daemon
+
+LOG_DEBUG = get_host_config('trace', 'LOG_DEBUG', True)
+
+
+def debug(message, *args):
+    """log.debug(message % args), formatted only if LOG_DEBUG is on"""
+    if LOG_DEBUG:
+        log.debug(message % args if args else message)
+
+
+class _Fsid(object):
+
+    def __init__(self, cluster):
+        self.cluster = cluster
+
+    def __str__(self):
+        return str(self.cluster.get_fsid())
+
+
+def fsid(cluster):
+    """The fsid of cluster as a debug() argument, asked for only if the message is formatted"""
+    return _Fsid(cluster)
+
+
+def trace_id(dbg):
+    return md5(("%s:%s" % (os.getpid(), dbg)).encode('utf-8')).hexdigest()[:12]
+
+
+class Histograms(object):
+    """Latency histograms keyed by operation and outcome
+
+    A series is [count per bucket..., count above the last bucket, sum of seconds].
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.__lock = threading.Lock()
+        self.__series = {}  # (operation, outcome) -> series
+
+    def observe(self, operation, outcome, seconds):
+        index = bisect_left(self.buckets, seconds)
+        with self.__lock:
+            series = self.__series.get((operation, outcome))
+            if series is None:
+                series = self.__series[(operation, outcome)] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += seconds
+
+    def take(self):
+        """Returns the series observed since the last take() as {'operation outcome': series}"""
+        with self.__lock:
+            series, self.__series = self.__series, {}
+        return dict(("%s %s" % key, value) for key, value in series.items())
+
+    def flush(self, dbg, metrics_dir=None):
+        """Adds the series observed since the last flush to the totals of METRICS_DIR"""
+        if metrics_dir is None:
+            metrics_dir = get_host_config(dbg, 'METRICS_DIR', '')
+        if not metrics_dir:
+            return
+        series = self.take()
+        if not series:
+            return
+        path = os.path.join(metrics_dir, METRICS_FILE)
+        fd = _lock_file(metrics_dir, "%s.lock" % path)
+        try:
+            totals = {'buckets': list(self.buckets), 'series': {}}
+            try:
+                with open(path) as f:
+                    loaded = json.load(f)
+                if loaded['buckets'] == totals['buckets']:
+                    totals = loaded
+            except (IOError, OSError, ValueError, KeyError):
+                pass
+            for key, value in series.items():
+                total = totals['series'].get(key)
+                totals['series'][key] = value if total is None else [a + b for a, b in zip(total, value)]
+            _write_file(path, json.dumps(totals, sort_keys=True))
+            _write_file(os.path.join(metrics_dir, PROMETHEUS_FILE), prometheus_text(totals))
+        finally:
+            os.close(fd)
+
+
+def _write_file(path, text):
+    with open("%s.tmp" % path, 'w') as f:
+        f.write(text)
+    os.rename("%s.tmp" % path, path)
+
+
+def prometheus_text(totals):
+    """Renders the totals of a metrics file in the Prometheus text format"""
+    lines = ["# HELP %s Latency of the RBDSR plugin operations" % PROMETHEUS_METRIC,
+             "# TYPE %s histogram" % PROMETHEUS_METRIC]
+    bounds = ["%g" % bucket for bucket in totals['buckets']] + ['+Inf']
+    for key in sorted(totals['series']):
+        operation, outcome = key.split(' ')
+        series = totals['series'][key]
+        labels = 'operation="%s",outcome="%s"' % (operation, outcome)
+        count = 0
+        for bound, bucket_count in zip(bounds, series[:-1]):
+            count += bucket_count
+            lines.append('%s_bucket{%s,le="%s"} %d' % (PROMETHEUS_METRIC, labels, bound, count))
+        lines.append("%s_sum{%s} %.6f" % (PROMETHEUS_METRIC, labels, series[-1]))
+        lines.append("%s_count{%s} %d" % (PROMETHEUS_METRIC, labels, count))
+    return '\n'.join(lines) + '\n'
+
+
+METRICS = Histograms()
+
+
+def _flush_at_exit():
+    try:
+        METRICS.flush('trace')
+    except Exception:
+        log.error("trace: xcpng.librbd.trace._flush_at_exit: Failed to write the metrics")
+        log.error(traceback.format_exc())
+
+
+atexit.register(_flush_at_exit)
+
+
+def observe(dbg, operation, outcome, seconds):
+    METRICS.observe(operation, outcome, seconds)
+    if LOG_DEBUG:
+        log.debug("%s: xcpng.librbd.trace: trace: %s span: %s %s %.1fms"
+                  % (dbg, trace_id(dbg), operation, outcome, seconds * 1000))
+
+
+@contextmanager
+def span(dbg, operation):
+    """Times the block as operation, an exception leaving it counts as an error"""
+    start = time()
+    outcome = 'error'
+    try:
+        yield
+        outcome = 'ok'
+    finally:
+        observe(dbg, operation, outcome, time() - start)
+
+
+def timed(operation):
+    """Decorator timing func(dbg, ...) as operation"""
+    def _decorator_(func):
+        @wraps(func)
+        def _timed_(dbg, *args, **kwargs):
+            start = time()
+            outcome = 'error'
+            try:
+                result = func(dbg, *args, **kwargs)
+                outcome = 'ok'
+                return result
+            finally:
+                observe(dbg, operation, outcome, time() - start)
+        return _timed_
+    return _decorator_
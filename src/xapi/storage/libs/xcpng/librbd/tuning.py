@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""Datapath tuning profile: qemu-nbd I/O options and librbd cache settings
+
+A profile is a dict of the TUNING_DEFAULTS keys. SR.create/SR.attach take it from device-config and
+persist it with the SR (see meta.set_sr_config). At attach time the VDI's own keys (Volume.set)
+override the SR profile, which overrides the defaults.
+
+Defaults: librbd write-back cache with the Ceph default size, discards passed down to RBD so freed
+space is reclaimed, zero detection off since it costs a scan of every write. benchmarks/fio has
+the fio job used to compare the qemu-nbd options against a local image file.
+
+rbd-persistent-cache isn't a librbd setting of its own: it attaches the VDI through the host's
+persistent write-back cache, see pcache.
+"""
+
+TUNING_DEFAULTS = {
+    'qemu-nbd-cache': 'writeback',
+    'qemu-nbd-aio': 'threads',
+    'qemu-nbd-discard': 'unmap',
+    'qemu-nbd-detect-zeroes': 'off',
+    'rbd-cache': 'true',
+    'rbd-cache-size': '33554432',
+    'rbd-cache-max-dirty': '25165824',
+    'rbd-readahead-max-bytes': '524288',
+    'rbd-readahead-disable-after-bytes': '52428800',
+    'rbd-persistent-cache': 'false',
+}
+
+TUNING_CHOICES = {
+    'qemu-nbd-cache': ('none', 'writeback', 'writethrough', 'directsync', 'unsafe'),
+    'qemu-nbd-aio': ('threads', 'native'),
+    'qemu-nbd-discard': ('ignore', 'unmap'),
+    'qemu-nbd-detect-zeroes': ('off', 'on', 'unmap'),
+    'rbd-cache': ('true', 'false'),
+    'rbd-persistent-cache': ('true', 'false'),
+}
+
+QEMU_NBD_OPTIONS = {
+    'qemu-nbd-cache': '--cache',
+    'qemu-nbd-aio': '--aio',
+    'qemu-nbd-discard': '--discard',
+    'qemu-nbd-detect-zeroes': '--detect-zeroes',
+}
+
+RBD_OPTIONS = {
+    'rbd-cache': 'rbd_cache',
+    'rbd-cache-size': 'rbd_cache_size',
+    'rbd-cache-max-dirty': 'rbd_cache_max_dirty',
+    'rbd-readahead-max-bytes': 'rbd_readahead_max_bytes',
+    'rbd-readahead-disable-after-bytes': 'rbd_readahead_disable_after_bytes',
+}
+
+
+def get_tuning_profile(dbg, configuration):
+    """Returns the tuning keys of configuration, raises Exception on an invalid value"""
+    profile = {}
+    for key in TUNING_DEFAULTS:
+        if key not in configuration:
+            continue
+        value = str(configuration[key]).lower()
+        if key in TUNING_CHOICES:
+            if value not in TUNING_CHOICES[key]:
+                raise Exception("Invalid %s '%s', expected one of: %s"
+                                % (key, configuration[key], ', '.join(TUNING_CHOICES[key])))
+        elif not value.isdigit():
+            raise Exception("Invalid %s '%s', expected a number of bytes" % (key, configuration[key]))
+        profile[key] = value
+    return profile
+
+
+def merge_tuning_profiles(*profiles):
+    """Returns TUNING_DEFAULTS updated with each of profiles in turn"""
+    merged = dict(TUNING_DEFAULTS)
+    for profile in profiles:
+        merged.update(profile)
+    if int(merged['rbd-cache-max-dirty']) >= int(merged['rbd-cache-size']):
+        # librbd refuses a dirty limit that isn't below the cache size
+        merged['rbd-cache-max-dirty'] = str(int(merged['rbd-cache-size']) * 3 // 4)
+    return merged
+
+
+def qemu_nbd_options(profile):
+    return ["%s=%s" % (QEMU_NBD_OPTIONS[key], profile[key]) for key in sorted(QEMU_NBD_OPTIONS)]
+
+
+def rbd_conf_options(profile):
+    """Returns (name, value) librbd settings, as used in rbd: URIs and on rbd-nbd's command line"""
+    return [(RBD_OPTIONS[key], profile[key]) for key in sorted(RBD_OPTIONS)]
+
+
+def blockdev_options(profile):
+    """Returns QMP blockdev-add options of the profile for the shared NBD server
+
+    The QAPI schema of the rbd driver takes no arbitrary librbd settings, so the rbd-* keys only
+    apply through the qemu cache mode there.
+    """
+    cache = profile['qemu-nbd-cache']
+    return {'cache': {'direct': cache in ('none', 'directsync'), 'no-flush': cache == 'unsafe'},
+            'discard': profile['qemu-nbd-discard'],
+            'detect-zeroes': profile['qemu-nbd-detect-zeroes']}
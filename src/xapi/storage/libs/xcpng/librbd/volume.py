@@ -7,75 +7,189 @@ from xapi.storage.libs.xcpng.meta import IMAGE_UUID_TAG
 from xapi.storage.libs.xcpng.utils import get_cluster_name_by_uri, get_sr_name_by_uri, get_vdi_name_by_uri, \
                                           roundup, VDI_PREFIXES, get_vdi_type_by_uri
 from xapi.storage.libs.xcpng.volume import VolumeOperations as _VolumeOperations_
-from xapi.storage.libs.xcpng.librbd.rbd_utils import VOLBLOCKSIZE, ceph_cluster, rbd_create, rbd_remove, rbd_resize, \
-                                                     rbd_utilization
+from xapi.storage.libs.xcpng.librbd.meta import VDI_KEYS_TAG, SR_CONFIG_OBJECT
+from xapi.storage.libs.xcpng.librbd.rbd_utils import VOLBLOCKSIZE, ceph_cluster, rbd_create, rbd_create_many, \
+                                                     rbd_resize, rbd_utilization, rbd_snapshot, rbd_clone, rados_omap_get
+from xapi.storage.libs.xcpng.librbd.datapath import DATAPATH_KRBD, get_datapath_by_uri, resize_device
+from xapi.storage.libs.xcpng.librbd.flatten import destroy_images, schedule_pool_worker
+from xapi.storage.libs.xcpng.librbd.layout import get_layout_profile, merge_layout_profiles, rbd_create_options
+from xapi.storage.libs.xcpng.librbd.qos import get_qos_profile, set_image_qos
+from xapi.storage.libs.xcpng.librbd.trace import debug
 
 
 class VolumeOperations(_VolumeOperations_):
 
     def create(self, dbg, uri, size):
-        log.debug("%s: xcpng.librbd.volume.VolumeOperations.create: uri: %s size: %s" % (dbg, uri, size))
+        debug("%s: xcpng.librbd.volume.VolumeOperations.create: uri: %s size: %s", dbg, uri, size)
 
         volume_meta = self.MetadataHandler.get_vdi_meta(dbg, uri)
+        qos = get_qos_profile(dbg, volume_meta.get(VDI_KEYS_TAG) or {})
         cluster = ceph_cluster(dbg, get_cluster_name_by_uri(dbg, uri))
+        pool = get_sr_name_by_uri(dbg, uri)
+        name = "%s%s" % (VDI_PREFIXES[get_vdi_type_by_uri(dbg, uri)], volume_meta[IMAGE_UUID_TAG])
 
         try:
             cluster.connect()
             rbd_create(dbg,
                        cluster,
-                       get_sr_name_by_uri(dbg, uri),
-                       "%s%s" % (VDI_PREFIXES[get_vdi_type_by_uri(dbg, uri)], volume_meta[IMAGE_UUID_TAG]), size)
+                       pool,
+                       name,
+                       size,
+                       **self._get_layout(dbg, uri, rados_omap_get(dbg, cluster, pool, SR_CONFIG_OBJECT)))
+            if qos:
+                set_image_qos(dbg, cluster, pool, name, qos)
         except Exception as e:
-            log.debug("%s: xcpng.librbd.volume.VolumeOperations.create: Failed to create volume: uri: %s"
-                      % dbg, uri)
+            debug("%s: xcpng.librbd.volume.VolumeOperations.create: Failed to create volume: uri: %s",
+                  dbg, uri)
             log.error(traceback.format_exc())
             raise Exception(e)
         finally:
             cluster.shutdown()
 
     def destroy(self, dbg, uri):
-        log.debug("%s: xcpng.librbd.volume.VolumeOperations.destroy: uri: %s" % (dbg, uri))
+        debug("%s: xcpng.librbd.volume.VolumeOperations.destroy: uri: %s", dbg, uri)
+        self.destroy_many(dbg, [uri])
+
+    def create_many(self, dbg, volumes):
+        """Creates the images of the (uri, size) volumes, concurrently per SR over one connection
+
+        SMAPIv3 has no bulk call, this is for tools creating many VDIs at once (see benchmarks/)
+        """
+        debug("%s: xcpng.librbd.volume.VolumeOperations.create_many: volumes: %s", dbg, len(volumes))
+
+        for (cluster_name, pool), images in self._group(dbg, volumes).items():
+            cluster = ceph_cluster(dbg, cluster_name)
+            try:
+                cluster.connect()
+                sr_config = rados_omap_get(dbg, cluster, pool, SR_CONFIG_OBJECT)
+                layouts = {}
+                qos = {}
+                for uri, name, size in images:
+                    layout = self._get_layout(dbg, uri, sr_config)
+                    layouts.setdefault(tuple(sorted(layout.items())), []).append((name, size))
+                    volume_meta = self.MetadataHandler.get_vdi_meta(dbg, uri)
+                    qos[name] = get_qos_profile(dbg, volume_meta.get(VDI_KEYS_TAG) or {})
+                for layout, images_ in layouts.items():
+                    rbd_create_many(dbg, cluster, pool, images_, **dict(layout))
+                for name, profile in qos.items():
+                    if profile:
+                        set_image_qos(dbg, cluster, pool, name, profile)
+            except Exception as e:
+                debug("%s: xcpng.librbd.volume.VolumeOperations.create_many: Failed to create volumes: pool: %s",
+                      dbg, pool)
+                log.error(traceback.format_exc())
+                raise Exception(e)
+            finally:
+                cluster.shutdown()
+
+    def destroy_many(self, dbg, uris):
+        """Moves the images of uris to the RBD trash, their objects are deleted in the background
+
+        Images with snapshots are trashed by the pool worker, once it has flattened their clones
+        """
+        debug("%s: xcpng.librbd.volume.VolumeOperations.destroy_many: uris: %s", dbg, uris)
+
+        for (cluster_name, pool), images in self._group(dbg, [(uri, None) for uri in uris]).items():
+            names = [name for uri, name, size in images]
+            cluster = ceph_cluster(dbg, cluster_name)
+            try:
+                cluster.connect()
+                destroy_images(dbg, cluster, pool, names)
+            except Exception as e:
+                debug("%s: xcpng.librbd.volume.VolumeOperations.destroy_many: Failed to destroy volumes: pool: %s",
+                      dbg, pool)
+                log.error(traceback.format_exc())
+                raise Exception(e)
+            finally:
+                cluster.shutdown()
+            schedule_pool_worker(dbg, cluster_name, pool)
+
+    def _group(self, dbg, volumes):
+        """Returns {(cluster name, pool): [(uri, image name, size)]} of the (uri, size) volumes"""
+        groups = {}
+        for uri, size in volumes:
+            volume_meta = self.MetadataHandler.get_vdi_meta(dbg, uri)
+            groups.setdefault((get_cluster_name_by_uri(dbg, uri), get_sr_name_by_uri(dbg, uri)), []).append(
+                (uri, "%s%s" % (VDI_PREFIXES[get_vdi_type_by_uri(dbg, uri)], volume_meta[IMAGE_UUID_TAG]), size))
+        return groups
+
+    def _get_layout_profile(self, dbg, uri, sr_config):
+        """Returns the layout profile of the VDI: defaults < SR device-config < VDI keys"""
+        volume_meta = self.MetadataHandler.get_vdi_meta(dbg, uri)
+        return merge_layout_profiles(get_layout_profile(dbg, sr_config),
+                                     get_layout_profile(dbg, volume_meta.get(VDI_KEYS_TAG) or {}))
+
+    def _get_layout(self, dbg, uri, sr_config):
+        """Returns the rbd_create()/rbd_clone() layout arguments of the VDI"""
+        return rbd_create_options(self._get_layout_profile(dbg, uri, sr_config),
+                                  get_datapath_by_uri(dbg, uri) == DATAPATH_KRBD)
+
+    def clone(self, dbg, uri, clone_uri):
+        """Makes the image of clone_uri a copy-on-write clone of the current state of the image of uri
+
+        The source image gets a protected snapshot named after the clone's image and the clone is
+        layered on it, so no data is copied. VDI.snapshot uses the same, the snapshot VDI being a clone
+        that is never written to. Clones whose chain grows too deep are flattened in the background.
+        """
+        debug("%s: xcpng.librbd.volume.VolumeOperations.clone: uri: %s clone_uri: %s", dbg, uri, clone_uri)
 
         volume_meta = self.MetadataHandler.get_vdi_meta(dbg, uri)
+        clone_meta = self.MetadataHandler.get_vdi_meta(dbg, clone_uri)
         cluster = ceph_cluster(dbg, get_cluster_name_by_uri(dbg, uri))
+        pool = get_sr_name_by_uri(dbg, uri)
+        name = "%s%s" % (VDI_PREFIXES[get_vdi_type_by_uri(dbg, uri)], volume_meta[IMAGE_UUID_TAG])
+        snapshot = clone_meta[IMAGE_UUID_TAG]
+        clone_pool = get_sr_name_by_uri(dbg, clone_uri)
+        clone_name = "%s%s" % (VDI_PREFIXES[get_vdi_type_by_uri(dbg, clone_uri)], clone_meta[IMAGE_UUID_TAG])
+        # The clone gets the image metadata of its parent, its own keys take precedence
+        qos = get_qos_profile(dbg, clone_meta.get(VDI_KEYS_TAG) or {})
 
         try:
             cluster.connect()
-            rbd_remove(dbg,
-                       cluster,
-                       get_sr_name_by_uri(dbg, uri),
-                       "%s%s" % (VDI_PREFIXES[get_vdi_type_by_uri(dbg, uri)], volume_meta[IMAGE_UUID_TAG]))
+            layout = self._get_layout(dbg, clone_uri, rados_omap_get(dbg, cluster, clone_pool, SR_CONFIG_OBJECT))
+            rbd_snapshot(dbg, cluster, pool, name, snapshot)
+            rbd_clone(dbg, cluster, pool, name, snapshot, clone_pool, clone_name, **layout)
+            if qos:
+                set_image_qos(dbg, cluster, clone_pool, clone_name, qos)
         except Exception as e:
-            log.debug("%s: xcpng.librbd.volume.VolumeOperations.create: Failed to create volume: uri: %s"
-                      % dbg, uri)
+            debug("%s: xcpng.librbd.volume.VolumeOperations.clone: Failed to clone volume: uri: %s clone_uri: %s",
+                  dbg, uri, clone_uri)
             log.error(traceback.format_exc())
             raise Exception(e)
         finally:
             cluster.shutdown()
 
+        schedule_pool_worker(dbg, get_cluster_name_by_uri(dbg, clone_uri), get_sr_name_by_uri(dbg, clone_uri))
+
+    def snapshot(self, dbg, uri, snap_uri):
+        debug("%s: xcpng.librbd.volume.VolumeOperations.snapshot: uri: %s snap_uri: %s", dbg, uri, snap_uri)
+        self.clone(dbg, uri, snap_uri)
+
     def resize(self, dbg, uri, new_size):
-        log.debug("%s: xcpng.librbd.volume.VolumeOperations.resize: uri: %s new_size: %s" % (dbg, uri, new_size))
+        """Resizes the image, online if the VDI is attached: its device grows in place, see resize_device()"""
+        debug("%s: xcpng.librbd.volume.VolumeOperations.resize: uri: %s new_size: %s", dbg, uri, new_size)
 
         volume_meta = self.MetadataHandler.get_vdi_meta(dbg, uri)
         cluster = ceph_cluster(dbg, get_cluster_name_by_uri(dbg, uri))
+        pool = get_sr_name_by_uri(dbg, uri)
+        name = "%s%s" % (VDI_PREFIXES[get_vdi_type_by_uri(dbg, uri)], volume_meta[IMAGE_UUID_TAG])
 
         try:
             cluster.connect()
-            rbd_resize(dbg,
-                       cluster,
-                       get_sr_name_by_uri(dbg, uri),
-                       "%s%s" % (VDI_PREFIXES[get_vdi_type_by_uri(dbg, uri)], volume_meta[IMAGE_UUID_TAG]),
-                       new_size)
+            rbd_resize(dbg, cluster, pool, name, new_size)
         except Exception as e:
-            log.debug("%s: xcpng.librbd.volume.VolumeOperations.resize: Failed to create volume: uri: %s new_size: %s"
-                      % dbg, uri, new_size)
+            debug("%s: xcpng.librbd.volume.VolumeOperations.resize: Failed to resize volume: uri: %s new_size: %s",
+                  dbg, uri, new_size)
             log.error(traceback.format_exc())
             raise Exception(e)
         finally:
             cluster.shutdown()
 
+        if volume_meta.get('nbd_dev'):
+            resize_device(dbg, uri, volume_meta['nbd_dev'], "%s/%s" % (pool, name), new_size)
+
     def get_phisical_utilization(self, dbg, uri):
-        log.debug("%s: xcpng.librbd.volume.VolumeOperations.get_phisical_utilization: uri: %s" % (dbg, uri))
+        debug("%s: xcpng.librbd.volume.VolumeOperations.get_phisical_utilization: uri: %s", dbg, uri)
 
         volume_meta = self.MetadataHandler.get_vdi_meta(dbg, uri)
         cluster = ceph_cluster(dbg, get_cluster_name_by_uri(dbg, uri))
@@ -87,8 +201,8 @@ class VolumeOperations(_VolumeOperations_):
                                    get_sr_name_by_uri(dbg, uri),
                                    "%s%s" % (VDI_PREFIXES[get_vdi_type_by_uri(dbg, uri)], volume_meta[IMAGE_UUID_TAG]))
         except Exception as e:
-            log.debug("%s: xcpng.librbd.volume.VolumeOperations.resize: Failed to create volume: uri: %s new_size: %s"
-                      % dbg, uri. new_size)
+            debug("%s: xcpng.librbd.volume.VolumeOperations.get_phisical_utilization: Failed to get utilization: uri: %s",
+                  dbg, uri)
             log.error(traceback.format_exc())
             raise Exception(e)
         finally: